@@ -17,6 +17,7 @@ import sys
 import os
 import numpy as np
 import logging
+from density import matrix as mtx
 
 from matplotlib import rc
 
@@ -136,7 +137,8 @@ def main(argv=None):  # IGNORE:C0111
         "--input",
         dest="i",
         required=True,
-        help='input matrix',
+        help='input matrix (csv, or an .npz intermediate. Use '
+             'file.npz:name to choose a matrix other than normed_matrix)',
         nargs='+',
     )
     parser.add_argument(
@@ -188,7 +190,7 @@ def main(argv=None):  # IGNORE:C0111
     logger.info("************************************************************")
     try:
         for arg in input_matrices_files:
-            heatmaps.append(pd.read_table(arg, index_col=0, sep=','))
+            heatmaps.append(mtx.read_intermediate(arg))
             logger.info("processing: {}".format(arg))
         f, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(20, 10))
         axes = [ax1, ax2, ax3, ax4]
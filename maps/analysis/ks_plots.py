@@ -12,6 +12,7 @@ import sys
 import os
 import numpy as np
 from scipy.stats import ks_2samp
+from density import matrix as mtx
 
 import numpy as np
 
@@ -82,13 +83,14 @@ def main(argv=None):  # IGNORE:C0111
         "--input",
         dest="i",
         required=True,
-        help='input normed matrix',
+        help='input normed matrix (csv, or an .npz intermediate. Use '
+             'file.npz:name to choose a matrix other than normed_matrix)',
     )
     parser.add_argument(
         "--control",
         dest="c",
         required=True,
-        help='control normed matrix',
+        help='control normed matrix (csv or .npz intermediate)',
     )
     parser.add_argument(
         "--p-output",
@@ -110,8 +112,8 @@ def main(argv=None):  # IGNORE:C0111
     p_output_file = args.p
     d_output_file = args.d
 
-    i = pd.read_table(input_file, index_col=0, sep=',')
-    c = pd.read_table(control_file, index_col=0, sep=',')
+    i = mtx.read_intermediate(input_file)
+    c = mtx.read_intermediate(control_file)
 
     p_values, d_values = calculate_signed_ks_l10p(i, c)
 
@@ -11,7 +11,8 @@ Created on May 3, 2017
 """
 
 import normalization_functions as norm
-from scipy import stats
+import matrix as mtx
+import significance
 import sys
 import os
 import numpy as np
@@ -32,7 +33,10 @@ class LineObject():
         color:
         min_event_threshold: int
         divide_hist: boolean
-        num_events: list
+        num_events: list or numpy.ndarray
+            number of events at each position (see: matrix.count_events()).
+            Labels and dimming use the number of events (rows) instead, as
+            padded positions count fewer events.
         """
         # TODO: change this entire piece of code
         self.event_matrix = event_matrix # normalized matrix of density or peak values.
@@ -44,10 +48,10 @@ class LineObject():
         self.file_label = self._parse_filename() if label is None else label# cleans up the text for legend labels
 
         # print("number of events (avg for all positions) found for {}: {}".format(
-        #     self.file_label, sum(self.num_events)/len(self.num_events))
+        #     self.file_label, len(self.event_matrix))
         # )
 
-        self.dim = False if sum(self.num_events)/len(self.num_events) > min_event_threshold else True # Dims the line. True if the number of events falls below some minimum event threshold
+        self.dim = False if len(self.event_matrix) > min_event_threshold else True # Dims the line. True if the number of events falls below some minimum event threshold
         self.p_values = []
         self.color = color
         self.values = list(event_matrix.sum())
@@ -107,7 +111,7 @@ class LineObject():
             '-', ' ').replace(
             '_', ' ').replace(
             '.tpm1','').replace('hg19_v19_','') + " ({} events)".format(
-            (sum(self.num_events) / len(self.num_events))
+            len(self.event_matrix)
         )
         firstparsed_string = '{}{}'.format(
             firstparsed_string[0].upper(), firstparsed_string[1:]
@@ -170,7 +174,7 @@ class LineObject():
         -------
 
         """
-        mean_events = sum(self.num_events) / len(self.num_events)
+        mean_events = len(self.event_matrix)
         plus = [x + y * mean_events for x, y in zip(
             values, norm.std_error(
                 values, self.num_events)
@@ -257,33 +261,43 @@ class PeakLine(LineObject):
                     self.hist, self.num_events)
             )]
         else:  # just multiply by the number of events to get the true error
-            plus = [x + y * self.num_events for x, y in zip(
+            plus = [x + y * n for x, y, n in zip(
                 values, norm.std_error(
-                    values, self.num_events)
+                    values, self.num_events), self.num_events
             )]
-            minus = [x - y * self.num_events for x, y in zip(
+            minus = [x - y * n for x, y, n in zip(
                 values, norm.std_error(
-                    values, self.num_events)
+                    values, self.num_events), self.num_events
             )]
         return plus, minus, max(plus), min(minus)
 
     def calculate_fisher(self, bg_matrix):
-        p_values = []
-        bg_num_events = bg_matrix.shape[0]
-        bg_hist = list(bg_matrix.sum())
-        for i in range(0, len(self.hist)):
-            total_peak = self.hist[i]  # total peaks at position i
-            total_without_peak = sum(self.num_events)/len(self.num_events) - total_peak
-            bg_total_peak = bg_hist[i]
-            bg_total_without_peak = bg_num_events - bg_total_peak
-            contingency_table = [
-                [total_peak, total_without_peak],
-                [bg_total_peak, bg_total_without_peak]
-            ]
-
-            odds, p = stats.fisher_exact(contingency_table)
-            p_values.append(-1 * np.log10(p))
-        return p_values
+        """
+        Given a background event matrix, calculate the Fisher exact test of
+        the number of events with and without a peak at each position
+        (out of the number of events at that position, see: num_events and
+        significance.fisher_exact())
+
+        Parameters
+        ----------
+        bg_matrix : pandas.DataFrame()
+            a position matrix (event = row, positon = col)
+
+        Returns
+        -------
+        list of -log10 p-values for each position
+        """
+        bg_num_events = mtx.count_events(bg_matrix)
+        bg_hist = bg_matrix.sum().values
+        hist = np.asarray(self.hist)
+        num_events = np.asarray(self.num_events)
+        contingency_tables = np.array([
+            [hist, num_events - hist],
+            [bg_hist, bg_num_events - bg_hist]
+        ]).transpose(2, 0, 1)
+
+        _, p = significance.fisher_exact(contingency_tables)
+        return list(-1 * np.log10(p))
 
     def calculate_and_set_significance(self, bg_matrix, test='fisher'):
         if test == 'fisher':
@@ -316,10 +330,11 @@ class DensityLine(LineObject):
         LineObject.__init__(self, event_matrix, annotation_src_file, conf,
                             color, min_event_threshold, num_events, label)
         self.hist = []
+        self._outlier_mask = None  # see: get_outlier_mask()
         self.means, \
         self.sems, \
         self.std, \
-        self.outlier_removed_matrix = self._get_means_and_sems()  # 3 lists, 1 dataframe
+        _ = self._get_means_and_sems()  # 3 lists
         self.error_pos, self.error_neg, self.max, self.min = self._get_std_error_boundaries()  # upper and lower boundaries for error
         self.values = self.means
 
@@ -361,6 +376,32 @@ class DensityLine(LineObject):
                 std_deviation[i] = 0
         return means, sems, std_deviation, outlier_removed_df
 
+    def get_outlier_mask(self):
+        """
+        Returns which values of the event matrix are kept after outlier
+        removal (see: norm.outlier_mask()). The mask is only computed once,
+        and is shared by the significance tests and outlier_removed_matrix.
+
+        Returns
+        -------
+        mask : numpy.ndarray
+            (events x positions) boolean mask, False for outliers and NaNs
+        """
+        if self._outlier_mask is None:
+            self._outlier_mask = norm.outlier_mask(
+                self.event_matrix.values, self.conf
+            )
+        return self._outlier_mask
+
+    @property
+    def outlier_removed_matrix(self):
+        """
+        The event matrix values with outliers (and NaNs) masked out, as a
+        numpy masked array over the event matrix (no copy is made).
+        """
+        return np.ma.masked_array(
+            self.event_matrix.values, mask=~self.get_outlier_mask()
+        )
 
     def _get_std_error_boundaries(self):
         """
@@ -402,27 +443,18 @@ class DensityLine(LineObject):
         list of -log10 p-values for each position
 
         """
-        p_values = []
-        _, _, _, test_matrix = norm.get_means_and_sems_with_merged(self.event_matrix, conf=self.conf)
-        _, _, _, bg_matrix = norm.get_means_and_sems_with_merged(bg_matrix, conf=self.conf)
-
-        for position in self.event_matrix.columns:
-            _, p = stats.ks_2samp(
-                test_matrix[position], bg_matrix[position]
-            )
-            p_values.append(-1 * np.log10(p))
-        return p_values
+        _, p = significance.ks_2samp(
+            self.event_matrix, bg_matrix, conf=self.conf,
+            test_mask=self.get_outlier_mask()
+        )
+        return list(-1 * np.log10(p))
 
     def calculate_zscore(self, bg_matrix):
 
         bg_means, bg_sems, bg_dev, _ = norm.get_means_and_sems(
             bg_matrix, self.conf
         )
-        p_values = []
-        for i in range(0, len(self.means)):
-            z_score = (self.means[i] - bg_means[i]) / bg_dev[i]
-            p_values.append(z_score)
-        return p_values
+        return list(significance.zscores(self.means, bg_means, bg_dev))
 
     def calculate_mannwhitneyu(self, bg_matrix):
         """
@@ -439,16 +471,11 @@ class DensityLine(LineObject):
         list of -log10 p-values for each position
 
         """
-        p_values = []
-        _, _, _, test_matrix = norm.get_means_and_sems_with_merged(self.event_matrix, conf=self.conf)
-        _, _, _, bg_matrix = norm.get_means_and_sems_with_merged(bg_matrix, conf=self.conf)
-        for position in test_matrix.columns:
-            _, p = stats.mannwhitneyu(
-                test_matrix[position], bg_matrix[position],
-                alternative='greater'
-            )
-            p_values.append(-1 * np.log10(p))
-        return p_values
+        _, p = significance.mannwhitneyu(
+            self.event_matrix, bg_matrix, conf=self.conf,
+            alternative='greater', test_mask=self.get_outlier_mask()
+        )
+        return list(-1 * np.log10(p))
 
     def has_hist(self):
         """
@@ -29,6 +29,7 @@ matplotlib.rcParams['svg.fonttype'] = 'none'
 rc('font', **{'family': 'sans-serif', 'sans-serif': ['Helvetica']})
 import seaborn as sns
 import os
+import multiprocessing
 import matplotlib.pyplot as plt
 import gzip
 from collections import defaultdict, OrderedDict
@@ -45,9 +46,12 @@ from tqdm import trange
 import numpy as np
 
 SEP = '.'  # file delimiter
+INTERMEDIATE_FORMATS = ['csv', 'npz']  # see: Map.write_intermediates()
 
 MIN_EVENT_THRESHOLD=100 # number of events required to not grey the line out
 
+EVENTS_PER_CHUNK = 5000  # max number of events a worker builds a matrix for at once
+
 COLOR_PALETTE = sns.color_palette("hls", 8)
 
 BG1_COLOR = 'black' # COLOR_PALETTE['black']
@@ -69,10 +73,126 @@ GREEN = COLOR_PALETTE[3]
 MAX_VAL = 100000000
 MIN_VAL = -100000000
 
+def _build_matrix(job):
+    """
+    Calls a matrix builder with its arguments, through
+    matrix.build_with_plan() so that the number of events at each position
+    is counted as the matrix is built. This is module-level so that it can
+    be sent to worker processes (see: Map.build_matrices())
+    """
+    builder, kwargs = job
+    if builder is mtx.build_with_plan:
+        return builder(**kwargs)
+    kwargs = dict(kwargs)
+    density = kwargs.pop('density')
+    return mtx.build_with_plan(builder, [density], **kwargs)[0]
+
+
+def _same_job(job, other, ignore=()):
+    """
+    Returns True if two (builder, kwargs) jobs would build the same matrix:
+    they call the same builder with the same arguments (other than those
+    in ignore), and density arguments are the very same object.
+    """
+    builder, kwargs = job
+    other_builder, other_kwargs = other
+    if builder is not other_builder or set(kwargs) != set(other_kwargs):
+        return False
+    for key, value in kwargs.iteritems():
+        if key in ignore:
+            continue
+        if isinstance(value, ReadDensity.Density):
+            if value is not other_kwargs[key]:
+                return False
+        elif value != other_kwargs[key]:
+            return False
+    return True
+
+
+def _group_by_plan(jobs):
+    """
+    Groups jobs whose builder has a plan (see: matrix.PLANS) and that only
+    differ by their density (ie. the ip and input of a map) into one
+    matrix.build_with_plan() job, so that the windows of each annotation
+    are only computed once.
+
+    Parameters
+    ----------
+    jobs : collections.OrderedDict
+        {key: (builder, kwargs)} see: Map.build_matrices()
+
+    Returns
+    -------
+    groups : list
+        list of (keys, job) tuples. Jobs of more than one key return a list
+        of (matrix, events, num_events), one for each key.
+    """
+    groups = []
+    for key, job in jobs.iteritems():
+        builder, kwargs = job
+        if builder in mtx.PLANS and 'density' in kwargs:
+            for keys, jobs_of_group in groups:
+                if _same_job(job, jobs_of_group[0], ignore=('density', )):
+                    keys.append(key)
+                    jobs_of_group.append(job)
+                    break
+            else:
+                groups.append(([key], [job]))
+        else:
+            groups.append(([key], [job]))
+
+    grouped = []
+    for keys, jobs_of_group in groups:
+        if len(keys) == 1:
+            grouped.append((keys, jobs_of_group[0]))
+            continue
+        builder, kwargs = jobs_of_group[0]
+        plan_kwargs = dict(kwargs)
+        del plan_kwargs['density']
+        plan_kwargs['builder'] = builder
+        plan_kwargs['densities'] = [
+            job_kwargs['density'] for _, job_kwargs in jobs_of_group
+        ]
+        grouped.append((keys, (mtx.build_with_plan, plan_kwargs)))
+    return grouped
+
+
+def _chunk_job(job, events_per_chunk):
+    """
+    Splits a matrix builder job into jobs over consecutive chunks of (at
+    most events_per_chunk) events.
+
+    Parameters
+    ----------
+    job : tuple
+        (builder, kwargs) see: Map.build_matrices()
+    events_per_chunk : int
+
+    Returns
+    -------
+    chunks : list
+        list of ((builder, kwargs), number of events) tuples
+    """
+    builder, kwargs = job
+    events = mtx.read_events(kwargs['annotation'])
+    # meta() groups lines by gene, so its annotations can't be split by line.
+    if len(events) <= events_per_chunk or builder is mtx.meta:
+        return [(job, len(events))]
+    chunks = []
+    for start in range(0, len(events), events_per_chunk):
+        chunk_kwargs = dict(kwargs)
+        chunk_kwargs['annotation'] = events[start:start + events_per_chunk]
+        chunks.append(
+            ((builder, chunk_kwargs), len(chunk_kwargs['annotation']))
+        )
+    return chunks
+
+
 class Map:
     def __init__(self, ip, output_filename, norm_function,
                  annotation, upstream_offset=0, downstream_offset=0,
-                 min_density_threshold=0, conf=0.95, scale=False):
+                 min_density_threshold=0, conf=0.95, scale=False, cores=1,
+                 cache_dir=None):
         """
 
         Parameters
@@ -95,6 +215,12 @@ class Map:
             Minimum density sum across an event to use
         conf : float
             Representing percentage of events to keep (default .95)
+        cores : int
+            Number of processes used to build matrices (default 1).
+            See: build_matrices()
+        cache_dir : basestring
+            Directory to cache the parsed annotation files in (see:
+            annotations.RegionCache), or None to parse them every time.
         raw_matrices : collections.defaultdict(dict)
             raw_matrices are structured as: [clip][filename] whose keys refer to:
                 clip : 'ip' or 'input' depending on the experimental variable
@@ -114,8 +240,11 @@ class Map:
                 ip and input raw matrices for each key in both dictionaries.
 
         num_events : collections.defaultdict(dict)
-            This is a LIST containing the number of events at each position.
-            I made this a list due to some positions on a map being associated
+            This is an int32 array containing the number of events at each
+            position, counted as each matrix is built (see:
+            matrix.build_with_plan(), events whose region is padded or
+            missing at a position don't count there).
+            I made this per position due to some positions on a map being associated
             with different numbers of events. For example, the meta maps will
             calculate the first 10 positions as having being from the 5'UTR,
             of which 100 genes are considered. The next 50 positions refer to
@@ -130,9 +259,15 @@ class Map:
                 filename : the filename of the annotation which was overlapped
                     by the clip.
             And whose values refer to:
-                A list containing the number of events that are considered
+                An array containing the number of events that are considered
                 when performing certain normalizations (see above list example).
 
+        events : dict
+            {filename: event table} describing each event (row) of the
+            raw_matrices/norm_matrices built from filename. Matrices are
+            indexed by event id, and only joined to event names when
+            written out. See: matrix.event_table
+
         """
         self.ip = ip
         self.map_type = self.get_map_type()
@@ -148,10 +283,13 @@ class Map:
         self.raw_matrices = defaultdict(dict)
         self.norm_matrices = defaultdict(dict)
         self.num_events = defaultdict(dict)
+        self.events = {}
 
         self.lines = []
 
         self.scale = scale
+        self.cores = cores
+        self.cache_dir = cache_dir
 
     def get_map_type(self):
         """
@@ -168,6 +306,109 @@ class Map:
         elif(isinstance(self.ip, ReadDensity.Phastcon)):
             return 'phastcon'
 
+    def build_matrices(self, jobs):
+        """
+        Runs each matrix builder (ie. matrix.skipped_exon) in jobs. If
+        self.cores > 1, jobs are run at the same time in separate
+        processes, each of which reopens its own copy of the
+        bigwig/bigbed files. Annotations with more than EVENTS_PER_CHUNK
+        events are also split into chunks of consecutive events, which are
+        built separately and joined back together in their original order.
+        Jobs that only differ by their density (ie. the ip and input of an
+        annotation) are built together from one set of windows
+        (see: matrix.FetchPlan).
+
+        Parameters
+        ----------
+        jobs : collections.OrderedDict
+            {key: (builder, kwargs)} where builder is a function in
+            matrix.py and kwargs are its arguments.
+
+        Returns
+        -------
+        matrices : collections.OrderedDict
+            {key: (pandas.DataFrame, events, num_events)} the matrix and
+            event table returned by each builder, and the number of events
+            at each position of the matrix (see: matrix.build_with_plan())
+        """
+        # jobs that would build the same matrix (ie. the ip and input of a
+        # peak map, which are the same Peak object) are only built once.
+        unique_jobs = OrderedDict()
+        duplicates = {}
+        for key, job in jobs.iteritems():
+            for other_key, other_job in unique_jobs.iteritems():
+                if _same_job(job, other_job):
+                    duplicates[key] = other_key
+                    break
+            else:
+                unique_jobs[key] = job
+
+        # jobs that only differ by their density share their windows.
+        groups = _group_by_plan(unique_jobs)
+        results = self._run_jobs(
+            OrderedDict((keys[0], job) for keys, job in groups)
+        )
+        matrices = OrderedDict()
+        for keys, _ in groups:
+            if len(keys) == 1:
+                matrices[keys[0]] = results[keys[0]]
+            else:
+                matrices.update(zip(keys, results[keys[0]]))
+        for key in duplicates:
+            matrix, events, num_events = matrices[duplicates[key]]
+            matrices[key] = (matrix.copy(), events, num_events.copy())
+        return OrderedDict((key, matrices[key]) for key in jobs)
+
+    def _run_jobs(self, jobs):
+        """
+        Runs each job of build_matrices(), in separate processes if
+        self.cores > 1.
+        """
+        if self.cores <= 1:
+            return OrderedDict(
+                (key, _build_matrix(job)) for key, job in jobs.iteritems()
+            )
+
+        chunks = OrderedDict(
+            (key, _chunk_job(job, EVENTS_PER_CHUNK))
+            for key, job in jobs.iteritems()
+        )
+        num_chunks = sum([len(c) for c in chunks.values()])
+        pool = multiprocessing.Pool(min(self.cores, num_chunks))
+        try:
+            progress = trange(
+                sum([num_events for c in chunks.values() for _, num_events in c]),
+                desc='building matrices'
+            )
+            results = OrderedDict()
+            for key, key_chunks in chunks.iteritems():
+                results[key] = [
+                    pool.apply_async(
+                        _build_matrix, (job, ),
+                        callback=lambda _, n=num_events: progress.update(n)
+                    ) for job, num_events in key_chunks
+                ]
+            pool.close()
+            matrices = OrderedDict()
+            for key, key_results in results.iteritems():
+                if len(key_results) == 1:
+                    matrices[key] = key_results[0].get()
+                    continue
+                key_results = [result.get() for result in key_results]
+                if isinstance(key_results[0], list):
+                    # matrix.build_with_plan() chunks, one matrix per density
+                    matrices[key] = [
+                        mtx.concat_chunks(list(chunks))
+                        for chunks in zip(*key_results)
+                    ]
+                else:
+                    matrices[key] = mtx.concat_chunks(key_results)
+            progress.close()
+            return matrices
+        finally:
+            pool.terminate()
+            pool.join()
+
     def create_matrix(self):
         """
         Creates a stacked density matrix for each event in each annotation_src_file file
@@ -186,13 +427,20 @@ class Map:
         matrices = defaultdict(dict)
         num_events = defaultdict(dict)
 
+        jobs = OrderedDict()
         for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.same_length_region(
-                filename, self.ip, filetype,
-                self.upstream_offset, self.downstream_offset,
-                self.scale
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * matrices['ip'][filename].shape[1]
+            jobs[filename] = (mtx.same_length_region, dict(
+                annotation=filename, density=self.ip,
+                annotation_type=filetype,
+                upstream_offset=self.upstream_offset,
+                downstream_offset=self.downstream_offset,
+                scale=self.scale
+            ))
+        built = self.build_matrices(jobs)
+        for filename, (matrix, events, counts) in built.iteritems():
+            matrices['ip'][filename] = matrix
+            self.events[filename] = events
+            num_events['ip'][filename] = counts
 
         self.raw_matrices = matrices
 
@@ -233,7 +481,9 @@ class Map:
                                  (os.path.basename(filename)) + '.{}.raw_density.txt'.format(key)
                 # output_file_input = self.output_base + SEP + \
                 #                     (os.path.basename(filename)) + '.input.raw_density.txt'
-                self.raw_matrices[key][filename].to_csv(
+                mtx.label_events(
+                    self.raw_matrices[key][filename], self.events[filename]
+                ).to_csv(
                     output_file_ip
                 )
 
@@ -278,6 +528,62 @@ class Map:
         self.write_intermediate_means_to_csv()
         # self.write_intermediate_sems_to_csv()
 
+    def intermediate_matrices(self):
+        """
+        Returns the matrices written as intermediates for each
+        annotation_src_file, named as their csv files are.
+
+        Returns
+        -------
+        matrices : collections.defaultdict(OrderedDict)
+            {filename: {name: matrix}}, ie.
+            matrices['condition1.rmats']['ip.raw_density']
+        """
+        matrices = defaultdict(OrderedDict)
+        for filename, filetype in self.annotation.iteritems():
+            for key in self.raw_matrices.keys():
+                matrices[filename]['{}.raw_density'.format(key)] = \
+                    self.raw_matrices[key][filename]
+        return matrices
+
+    def write_intermediates_to_npz(self):
+        """
+        Writes the intermediate matrices of each annotation_src_file to
+        output_base + annotation_src_file + intermediates.npz, storing its
+        events once (see: matrix.write_intermediates), and the per-position
+        values to text as write_intermediates_to_csv() does.
+        """
+        for filename, matrices in self.intermediate_matrices().items():
+            output_file = self.output_base + SEP + \
+                          os.path.basename(filename) + '.intermediates' + \
+                          mtx.INTERMEDIATE_EXTENSION
+            mtx.write_intermediates(
+                output_file, matrices, self.events[filename]
+            )
+        self.write_intermediate_means_to_csv()
+
+    def write_intermediates(self, intermediate_format='csv'):
+        """
+        Writes all intermediate files.
+
+        Parameters
+        ----------
+        intermediate_format : basestring
+            one of INTERMEDIATE_FORMATS: 'csv' writes each matrix as text,
+            'npz' writes the matrices of each annotation_src_file to one
+            compressed numpy file (see: matrix.read_intermediate)
+        """
+        if intermediate_format == 'csv':
+            self.write_intermediates_to_csv()
+        elif intermediate_format == 'npz':
+            self.write_intermediates_to_npz()
+        else:
+            raise ValueError(
+                "intermediate_format must be one of {}, not {}".format(
+                    INTERMEDIATE_FORMATS, intermediate_format
+                )
+            )
+
     def plot(self, condition_list):
         Plotter.plot_bed(self.lines, self.output_filename, self.map_type, condition_list)
 
@@ -285,19 +591,22 @@ class Map:
 class WithInput(Map):
     def __init__(self, ip, inp, output_filename, norm_function,
                  annotation=None, upstream_offset=0, downstream_offset=0,
-                 min_density_threshold=0, conf=0.95, scale=False):
+                 min_density_threshold=0, conf=0.95, scale=False, cores=1,
+                 cache_dir=None):
         Map.__init__(self, ip=ip, output_filename=output_filename,
                      norm_function=norm_function, annotation=annotation,
                      upstream_offset=upstream_offset,
                      downstream_offset=downstream_offset,
                      min_density_threshold=min_density_threshold,
-                     conf=conf, scale=scale)
+                     conf=conf, scale=scale, cores=cores,
+                     cache_dir=cache_dir)
 
         self.inp = inp
         self.lines = []
 
     def set_background_and_calculate_significance(
-            self, cond_file_names, bg_file_name, test='mannwhitneyu', num_permutations=1000, boundary_percent=0.5
+            self, cond_file_names, bg_file_name, test='mannwhitneyu', num_permutations=1000, boundary_percent=0.5,
+            seed=None, intermediate_format='csv'
     ):
         """
         AFTER creation of all LineObjects, we can specify a condition
@@ -322,46 +631,50 @@ class WithInput(Map):
             number of iterations we choose to randomly sample bg
         boundary_percent : float
             the extreme % value from which to (out of 1000 values, take the top and bottom 0.5%, or 5)
+        seed : int
+            seed for the random samples of bg, which are drawn one condition
+            after the other (see: norm.permutation_bounds())
+        intermediate_format : basestring
+            write the random samples as a tsv ('csv') or as a compressed
+            numpy file ('npz', see: matrix.read_intermediate())
         """
 
         if test == 'permutation':
             # choose starting values for top and bottom median values
             top_values = [MIN_VAL]*len(self.num_events['ip'][bg_file_name])
             bottom_values = [MAX_VAL]*len(self.num_events['ip'][bg_file_name])
+            # one stream of samples for all conditions, so that conditions
+            # with as many events aren't compared to the same samples
+            random_state = np.random.RandomState(seed)
 
             for condition in cond_file_names:
                 # select output filename TODO: move out
-                tsv = os.path.join(
+                randsample = os.path.join(
                     os.path.dirname(self.output_filename),
-                    '{}.{}.{}.randsample.tsv'.format(
+                    '{}.{}.{}.randsample'.format(
                         os.path.basename(self.output_filename),
                         os.path.basename(bg_file_name),
                         os.path.basename(condition)
                     )
                 )
 
-                subset_iterations = []
-                iterations = num_permutations  # how many random samplings to take.
-                percentile = boundary_percent  # the extreme % value from which to (out of 1000 values, take the top and bottom 0.5%, or 5)
-                progress = trange(iterations)
-                for i in range(0, iterations):
-                    # since event_num is reported as a list across all positions, simply get the average for now.
-                    mean_event_num = int(
-                        sum(self.num_events['ip'][condition]) / float(len(self.num_events['ip'][condition]))
+                # sample as many events as the condition has (not its
+                # num_events, which doesn't count padded/missing positions)
+                condition_event_num = len(self.raw_matrices['ip'][condition])
+                # get the outlier-removed means of n random events (where n is the number of events in incl/excl)
+                bottom_values_condition, top_values_condition, df = norm.permutation_bounds(
+                    self.norm_matrices[bg_file_name], condition_event_num,
+                    num_permutations=num_permutations, conf=self.conf,
+                    boundary_percent=boundary_percent, seed=random_state,
+                    cores=self.cores
+                )
+                if intermediate_format == 'npz':
+                    mtx.write_intermediates(
+                        randsample + mtx.INTERMEDIATE_EXTENSION,
+                        {'randsample': df}
                     )
-                    # get n random events where n is the number of events in incl/excl
-                    rand_subset = Feature.get_random_sample(self.norm_matrices[bg_file_name], mean_event_num)
-                    ## print("random subset: {}".format(rand_subset[:5]))
-                    # remove outliers
-                    means, _, _, _ = norm.get_means_and_sems(rand_subset, conf=self.conf)
-                    # print("means after outlier removal: {}".format(means[:5]))
-                    subset_iterations.append(pd.Series(means))
-
-                    progress.update(1)
-                # concatenate all "lines" (means of outlier-removed normalized data)
-                df = pd.concat(subset_iterations, axis=1).T
-                df.to_csv(tsv, sep='\t')
-                bottom_values_condition, top_values_condition = norm.bottom_top_values_from_dataframe(df, percentile, percentile)
+                else:
+                    df.to_csv(randsample + '.tsv', sep='\t')
 
                 # get the min "bottom values" and max "top_values" among each condition
                 for position in range(0, len(bottom_values_condition)):
@@ -406,7 +719,9 @@ class WithInput(Map):
             output_file = self.output_base + SEP + \
                           line.file_label + '.normed_matrix.txt'
 
-            line.event_matrix.to_csv(output_file)
+            mtx.label_events(
+                line.event_matrix, self.events[line.annotation_src_file]
+            ).to_csv(output_file)
 
     def write_intermediate_hist_to_csv(self):
         """
@@ -454,6 +769,32 @@ class WithInput(Map):
         # self.export_as_deeptool_matrix()
         self.write_sum_coverage_to_csv()
 
+    def intermediate_matrices(self):
+        """
+        Returns the raw, normalized and sum coverage matrices written as
+        intermediates for each annotation_src_file.
+        See: Map.intermediate_matrices()
+        """
+        matrices = Map.intermediate_matrices(self)
+        for line in self.lines:
+            matrices[line.annotation_src_file]['normed_matrix'] = \
+                line.event_matrix
+        for filename, filetype in self.annotation.iteritems():
+            for key in self.raw_matrices.keys():
+                matrices[filename]['{}.sum_coverage'.format(key)] = \
+                    self.sum_coverage(key, filename)
+        return matrices
+
+    def write_intermediates_to_npz(self):
+        """
+        Writes all intermediate matrices of each annotation_src_file to one
+        compressed numpy file, and the per-position values to text.
+        See: Map.write_intermediates_to_npz()
+        """
+        Map.write_intermediates_to_npz(self)
+        self.write_intermediate_pvalues_to_csv()
+        self.write_intermediate_hist_to_csv()
+
     def create_matrices(self):
         """
         Creates a stacked density matrix for each event in each annotation_src_file file
@@ -464,24 +805,75 @@ class WithInput(Map):
         raw_matrices['ip']['condition1.rmats'] = matrix of density values for
         this RBP intersected with the events described by condition1.rmats
         """
+        self.create_matrices_from(
+            mtx.same_length_region,
+            upstream_offset=self.upstream_offset,
+            downstream_offset=self.downstream_offset, scale=self.scale
+        )
+
+    def create_matrices_from(self, builder, **kwargs):
+        """
+        Builds the ip and input matrices of every annotation file with
+        builder (see: build_matrices()), and sets self.raw_matrices and
+        self.num_events.
+
+        Parameters
+        ----------
+        builder : function
+            function in matrix.py that takes an annotation, density and
+            annotation_type (ie. matrix.skipped_exon)
+        kwargs :
+            any other arguments to builder (ie. exon_offset, intron_offset)
+        """
         matrices = defaultdict(dict)
         num_events = defaultdict(dict)
 
+        jobs = OrderedDict()
         for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.same_length_region(
-                filename, self.ip, filetype,
-                self.upstream_offset, self.downstream_offset, self.scale,
-            )
-            matrices['input'][filename] = mtx.same_length_region(
-                filename, self.inp, filetype,
-                self.upstream_offset, self.downstream_offset, self.scale,
-            )
-            # TODO: maybe do this by position? Currently we just multiple the positions by the matrix shape, but it would be 'cleaner' if we calculated number of events at every position instead.
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * matrices['ip'][filename].shape[1]
+            for clip, density in [('ip', self.ip), ('input', self.inp)]:
+                job_kwargs = dict(
+                    annotation=filename, density=density,
+                    annotation_type=filetype
+                )
+                job_kwargs.update(kwargs)
+                jobs[(clip, filename)] = (builder, job_kwargs)
+
+        self.set_aligned_matrices(
+            matrices, self.build_matrices(jobs), num_events
+        )
 
         self.raw_matrices = matrices
         self.num_events = num_events
 
+    def set_aligned_matrices(self, matrices, built, num_events=None):
+        """
+        Puts the ip and input matrices of every annotation file into
+        matrices, with the input matrix rows aligned to the ip events
+        (see: matrix.align_rows()), and sets self.events.
+
+        Parameters
+        ----------
+        matrices : dict
+            {'ip': {filename: matrix}, 'input': {filename: matrix}}
+        built : dict
+            {(clip, filename): (matrix, events, num_events)}
+            (see: build_matrices())
+        num_events : dict
+            if given, {'ip': {filename: num_events}} is set from the counts
+            of each ip matrix
+        """
+        for (clip, filename), (matrix, events, counts) in built.iteritems():
+            if clip == 'ip':
+                matrices[clip][filename] = matrix
+                self.events[filename] = events
+                if num_events is not None:
+                    num_events[clip][filename] = counts
+        for (clip, filename), (matrix, events, _) in built.iteritems():
+            if clip == 'input':
+                matrices[clip][filename] = mtx.align_rows(
+                    matrix, events, self.events[filename]
+                )
+
     def normalize_matrix(self):
         """
         For each annotation_src_file we have to parse, scale the ip
@@ -535,7 +927,10 @@ class WithInput(Map):
         if you wanted to visualize using their tools.
         """
         for filename, matrix in self.norm_matrices.iteritems():
-            df = misc.deeptoolify(norm.mask(matrix), self.annotation[filename])
+            df = misc.deeptoolify(
+                mtx.label_events(norm.mask(matrix), self.events[filename]),
+                self.annotation[filename]
+            )
             header = misc.create_deeptool_header(
                 sample_labels=[self.output_base],
                 downstream=matrix.shape[0]/2,
@@ -554,6 +949,27 @@ class WithInput(Map):
             o.close()
 
 
+    def sum_coverage(self, key, filename):
+        """
+        Returns the sum of the raw density across each event (row) of a
+        raw matrix, ignoring padding.
+
+        Parameters
+        ----------
+        key : basestring
+            'ip' or 'input'
+        filename : basestring
+            annotation_src_file the matrix was built from
+
+        Returns
+        -------
+        pandas.Series
+            indexed by event id
+        """
+        raw_matrix = self.raw_matrices[key][filename]
+        raw_matrix = raw_matrix.replace(-1, 0)
+        return pd.Series(raw_matrix.sum(axis=1))
+
     def write_sum_coverage_to_csv(self):
         """
         Writes sum coverages across each event to csv.
@@ -564,9 +980,9 @@ class WithInput(Map):
                                  (os.path.basename(filename)) + '.{}.sum_coverage.txt'.format(key)
                 # output_file_input = self.output_base + SEP + \
                 #                     (os.path.basename(filename)) + '.input.raw_density.txt'
-                raw_matrix = self.raw_matrices[key][filename]
-                raw_matrix = raw_matrix.replace(-1, 0)
-                sum_cov = pd.Series(raw_matrix.sum(axis=1))
+                sum_cov = mtx.label_events(
+                    self.sum_coverage(key, filename), self.events[filename]
+                )
                 sum_cov.to_csv(
                     output_file_cov
                 )
@@ -576,21 +992,22 @@ class Bed(WithInput):
     def __init__(
         self, ip, inp, output_filename, norm_function,
         annotation=None, upstream_offset=0, downstream_offset=0,
-        min_density_threshold=0, conf=0.95, scale=False
+        min_density_threshold=0, conf=0.95, scale=False, cores=1,
+        cache_dir=None
     ):
         WithInput.__init__(
             self, ip, inp, output_filename, norm_function,
             annotation=annotation, upstream_offset=upstream_offset,
             downstream_offset=downstream_offset,
             min_density_threshold=min_density_threshold, conf=conf,
-            scale=scale
+            scale=scale, cores=cores, cache_dir=cache_dir
         )
 
 class MultiLengthBed(Bed):
     def __init__(
         self, ip, inp, output_filename, norm_function,
         annotation=None, upstream_offset=50, downstream_offset=50,
-        min_density_threshold=0, conf=0.95
+        min_density_threshold=0, conf=0.95, cores=1, cache_dir=None
     ):
         """
 
@@ -611,7 +1028,7 @@ class MultiLengthBed(Bed):
             annotation=annotation, upstream_offset=upstream_offset,
             downstream_offset=downstream_offset,
             min_density_threshold=min_density_threshold, conf=conf,
-            scale=False
+            scale=False, cores=cores, cache_dir=cache_dir
         )
 
     def create_matrices(self):
@@ -628,27 +1045,12 @@ class MultiLengthBed(Bed):
         -------
 
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.multi_length_regions(
-                annotation=filename, density=self.ip,
-                upstream_offset=self.upstream_offset,
-                downstream_offset=self.downstream_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.multi_length_regions(
-                annotation=filename, density=self.inp,
-                upstream_offset=self.upstream_offset,
-                downstream_offset=self.downstream_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.multi_length_regions,
+            upstream_offset=self.upstream_offset,
+            downstream_offset=self.downstream_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         Plotter.plot_multi_length_bed(self.lines, self.output_filename, self.map_type, condition_list)
@@ -656,7 +1058,8 @@ class MultiLengthBed(Bed):
 class SkippedExon(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, exon_offset=50,
-                 intron_offset=300, min_density_threshold=0, conf=0.95):
+                 intron_offset=300, min_density_threshold=0, conf=0.95,
+                 cores=1, cache_dir=None):
         """
 
         Parameters
@@ -676,7 +1079,7 @@ class SkippedExon(WithInput):
                            norm_function=norm_function, annotation=annotation,
                            upstream_offset=0, downstream_offset=0,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores, cache_dir=cache_dir)
 
         self.exon_offset = exon_offset
         self.intron_offset = intron_offset
@@ -691,25 +1094,11 @@ class SkippedExon(WithInput):
         raw_matrices['ip']['condition1.rmats'] = matrix of density values for
         this RBP intersected with the events described by condition1.rmats
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.skipped_exon(
-                annotation=filename, density=self.ip,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.skipped_exon(
-                annotation=filename, density=self.inp,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.skipped_exon,
+            exon_offset=self.exon_offset, intron_offset=self.intron_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         """
@@ -725,7 +1114,8 @@ class MutuallyExclusiveExon(WithInput):
     def __init__(
             self, ip, inp, output_filename,
             norm_function, annotation=None, exon_offset=50,
-            intron_offset=300, min_density_threshold=0, conf=0.95
+            intron_offset=300, min_density_threshold=0, conf=0.95, cores=1,
+            cache_dir=None
     ):
         """
 
@@ -747,7 +1137,7 @@ class MutuallyExclusiveExon(WithInput):
             norm_function=norm_function, annotation=annotation,
             upstream_offset=0, downstream_offset=0,
             min_density_threshold=min_density_threshold,
-            conf=conf
+            conf=conf, cores=cores, cache_dir=cache_dir
         )
 
         self.exon_offset = exon_offset
@@ -767,24 +1157,11 @@ class MutuallyExclusiveExon(WithInput):
         -------
 
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.mutually_exc_exon(
-                annotation=filename, density=self.ip,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.mutually_exc_exon(
-                annotation=filename, density=self.inp,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.mutually_exc_exon,
+            exon_offset=self.exon_offset, intron_offset=self.intron_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         """
@@ -798,7 +1175,8 @@ class MutuallyExclusiveExon(WithInput):
 class Alt3PSpliceSite(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, exon_offset=50,
-                 intron_offset=300, min_density_threshold=0, conf=0.95):
+                 intron_offset=300, min_density_threshold=0, conf=0.95,
+                 cores=1, cache_dir=None):
         """
 
         Parameters
@@ -818,7 +1196,7 @@ class Alt3PSpliceSite(WithInput):
                            norm_function=norm_function, annotation=annotation,
                            upstream_offset=0, downstream_offset=0,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores, cache_dir=cache_dir)
 
         self.exon_offset = exon_offset
         self.intron_offset = intron_offset
@@ -838,25 +1216,11 @@ class Alt3PSpliceSite(WithInput):
         -------
 
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.alt_3p_splice_site(
-                annotation=filename, density=self.ip,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.alt_3p_splice_site(
-                annotation=filename, density=self.inp,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.alt_3p_splice_site,
+            exon_offset=self.exon_offset, intron_offset=self.intron_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         Plotter.plot_a3ss(self.lines, self.output_filename, self.map_type, condition_list)
@@ -865,7 +1229,8 @@ class Alt3PSpliceSite(WithInput):
 class Alt5PSpliceSite(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, exon_offset=50,
-                 intron_offset=300, min_density_threshold=0, conf=0.95):
+                 intron_offset=300, min_density_threshold=0, conf=0.95,
+                 cores=1, cache_dir=None):
         """
 
         Parameters
@@ -885,7 +1250,7 @@ class Alt5PSpliceSite(WithInput):
                            norm_function=norm_function, annotation=annotation,
                            upstream_offset=0, downstream_offset=0,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores, cache_dir=cache_dir)
 
         self.exon_offset = exon_offset
         self.intron_offset = intron_offset
@@ -904,25 +1269,11 @@ class Alt5PSpliceSite(WithInput):
         -------
 
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.alt_5p_splice_site(
-                annotation=filename, density=self.ip,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.alt_5p_splice_site(
-                annotation=filename, density=self.inp,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.alt_5p_splice_site,
+            exon_offset=self.exon_offset, intron_offset=self.intron_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         Plotter.plot_a5ss(self.lines, self.output_filename, self.map_type, condition_list)
@@ -930,7 +1281,8 @@ class Alt5PSpliceSite(WithInput):
 class RetainedIntron(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, exon_offset=50,
-                 intron_offset=300, min_density_threshold=0, conf=0.95):
+                 intron_offset=300, min_density_threshold=0, conf=0.95,
+                 cores=1, cache_dir=None):
         """
 
         Parameters
@@ -950,7 +1302,7 @@ class RetainedIntron(WithInput):
                            norm_function=norm_function, annotation=annotation,
                            upstream_offset=0, downstream_offset=0,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores, cache_dir=cache_dir)
 
         self.exon_offset = exon_offset
         self.intron_offset = intron_offset
@@ -969,24 +1321,11 @@ class RetainedIntron(WithInput):
         -------
 
         """
-        matrices = defaultdict(dict)
-        num_events = defaultdict(dict)
-        for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.retained_intron(
-                annotation=filename, density=self.ip,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.retained_intron(
-                annotation=filename, density=self.inp,
-                exon_offset=self.exon_offset, intron_offset=self.intron_offset,
-                annotation_type=filetype
-            )
-            num_events['ip'][filename] = [matrices['ip'][filename].shape[0]] * \
-                                         matrices['ip'][filename].shape[1]
-
-        self.raw_matrices = matrices
-        self.num_events = num_events
+        self.create_matrices_from(
+            mtx.retained_intron,
+            exon_offset=self.exon_offset, intron_offset=self.intron_offset,
+            cache_dir=self.cache_dir
+        )
 
     def plot(self, condition_list):
         Plotter.plot_ri(self.lines, self.output_filename, self.map_type, condition_list)
@@ -996,7 +1335,8 @@ class RetainedIntron(WithInput):
 class Metagene(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, upstream_offset=0,
-                 downstream_offset=0, min_density_threshold=0, conf=0.95):
+                 downstream_offset=0, min_density_threshold=0, conf=0.95,
+                 cores=1):
         """
 
         Parameters
@@ -1018,7 +1358,7 @@ class Metagene(WithInput):
                            upstream_offset=upstream_offset,
                            downstream_offset=downstream_offset,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores)
 
 
     def create_matrices(self):
@@ -1026,103 +1366,45 @@ class Metagene(WithInput):
         five_utr_ratio = 7 # 17
         cds_ratio = 52
 
-        matrices = defaultdict()
-        num_events = defaultdict()
-
+        jobs = OrderedDict()
         for filename, filetype in self.annotation.iteritems():
             if filetype == '3utr' or filetype == 'utr3':
-                matrices["three_prime_utr_ip"] = mtx.meta(
-                    annotation=filename, density=self.ip,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=three_utr_ratio
-                )
-
-                matrices["three_prime_utr_input"] = mtx.meta(
-                    annotation=filename, density=self.inp,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=three_utr_ratio
-                )
-
-                num_events["three_prime_utr_ip"] = [
-                    matrices["three_prime_utr_ip"].shape[0]
-                ] * matrices["three_prime_utr_ip"].shape[1]
-
+                region, scale_to = "three_prime_utr", three_utr_ratio
             elif filetype == '5utr' or filetype == 'utr5':
-                matrices["five_prime_utr_ip"] = mtx.meta(
-                    annotation=filename, density=self.ip,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=five_utr_ratio
-                )
-
-                matrices["five_prime_utr_input"] = mtx.meta(
-                    annotation=filename, density=self.inp,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=five_utr_ratio
-                )
-
-                num_events["five_prime_utr_ip"] = [
-                   matrices["five_prime_utr_ip"].shape[0]
-                ] * matrices["five_prime_utr_ip"].shape[1]
-
+                region, scale_to = "five_prime_utr", five_utr_ratio
             elif filetype == 'cds':
-                matrices["cds_ip"] = mtx.meta(
-                    annotation=filename, density=self.ip,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=cds_ratio
-                )
-
-                matrices["cds_input"] = mtx.meta(
-                    annotation=filename, density=self.inp,
-                    upstream_offset=self.upstream_offset,
-                    downstream_offset=self.downstream_offset,
-                    annotation_type='bed', scale_to=cds_ratio
-                )
-
-                num_events["cds_ip"] = [
-                    matrices["cds_ip"].shape[0]
-                ] * matrices["cds_ip"].shape[1]
-
+                region, scale_to = "cds", cds_ratio
             else:
                 print('unknown filetype! for metagene!')
-
-        # combine/merge all regions
-        self.raw_matrices['ip']['meta'] = pd.merge(
-            matrices['five_prime_utr_ip'],
-            matrices['cds_ip'],
-            how='outer', left_index=True, right_index=True
-        ).merge(
-            matrices['three_prime_utr_ip'],
-            how='outer', left_index=True, right_index=True
-        )
-
-        self.raw_matrices['input']['meta'] = pd.merge(
+                continue
+            for clip, density in [('ip', self.ip), ('input', self.inp)]:
+                jobs["{}_{}".format(region, clip)] = (mtx.meta, dict(
+                    annotation=filename, density=density,
+                    upstream_offset=self.upstream_offset,
+                    downstream_offset=self.downstream_offset,
+                    annotation_type='bed', scale_to=scale_to
+                ))
+        matrices = self.build_matrices(jobs)
+
+        # combine/merge all regions (by gene name)
+        # genes without a region aren't counted across its positions
+        self.raw_matrices['ip']['meta'], self.events['meta'], \
+            self.num_events['ip']['meta'] = mtx.join_regions([
+                matrices['five_prime_utr_ip'],
+                matrices['cds_ip'],
+                matrices['three_prime_utr_ip']
+            ])
+
+        input_meta, input_events, _ = mtx.join_regions([
             matrices['five_prime_utr_input'],
             matrices['cds_input'],
-            how='outer', left_index=True, right_index=True
-        ).merge(
-            matrices['three_prime_utr_input'],
-            how='outer', left_index=True, right_index=True
+            matrices['three_prime_utr_input']
+        ])
+        self.raw_matrices['input']['meta'] = mtx.align_rows(
+            input_meta, input_events, self.events['meta']
         )
 
-        self.raw_matrices['ip']['meta'].columns = range(
-            five_utr_ratio + cds_ratio + three_utr_ratio
-        )
-        self.raw_matrices['input']['meta'].columns = range(
-            five_utr_ratio + cds_ratio + three_utr_ratio
-        )
         self.annotation = {'meta':'metagene'}
-        self.num_events['ip']['meta'] = num_events['five_prime_utr_ip'] + \
-                                        num_events['cds_ip'] + \
-                                        num_events['three_prime_utr_ip']
-
-        # self.num_events['input']['meta'] = num_events['five_prime_utr_input'] + \
-        #                                 num_events['cds_input'] + \
-        #                                 num_events['three_prime_utr_input']
 
     def plot(self, condition_list):
         """
@@ -1136,7 +1418,8 @@ class Metagene(WithInput):
 class CDS(WithInput):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, upstream_offset=0,
-                 downstream_offset=0, min_density_threshold=0, conf=0.95):
+                 downstream_offset=0, min_density_threshold=0, conf=0.95,
+                 cores=1):
         """
 
         Parameters
@@ -1158,7 +1441,7 @@ class CDS(WithInput):
                            upstream_offset=upstream_offset,
                            downstream_offset=downstream_offset,
                            min_density_threshold=min_density_threshold,
-                           conf=conf)
+                           conf=conf, cores=cores)
 
 
     def create_matrices(self):
@@ -1172,19 +1455,18 @@ class CDS(WithInput):
         this RBP intersected with the events described by condition1.rmats
         """
         matrices = defaultdict(dict)
+        jobs = OrderedDict()
         for filename, filetype in self.annotation.iteritems():
-            matrices['ip'][filename] = mtx.meta(
-                annotation=filename, density=self.ip,
-                upstream_offset=self.upstream_offset,
-                downstream_offset=self.downstream_offset,
-                annotation_type=filetype
-            )
-            matrices['input'][filename] = mtx.meta(
-                annotation=filename, density=self.inp,
-                upstream_offset=self.upstream_offset,
-                downstream_offset=self.downstream_offset,
-                annotation_type=filetype
-            )
+            for clip, density in [('ip', self.ip), ('input', self.inp)]:
+                jobs[(clip, filename)] = (mtx.meta, dict(
+                    annotation=filename, density=density,
+                    upstream_offset=self.upstream_offset,
+                    downstream_offset=self.downstream_offset,
+                    annotation_type=filetype
+                ))
+        self.set_aligned_matrices(
+            matrices, self.build_matrices(jobs), self.num_events
+        )
         self.raw_matrices = matrices
 
     def plot(self, condition_list):
@@ -1199,11 +1481,12 @@ class CDS(WithInput):
 class ATACIntron(RetainedIntron):
     def __init__(self, ip, inp, output_filename,
                  norm_function, annotation=None, exon_offset=50,
-                 intron_offset=300, min_density_threshold=0, conf=0.95):
+                 intron_offset=300, min_density_threshold=0, conf=0.95,
+                 cores=1, cache_dir=None):
         RetainedIntron.__init__(
             self, ip, inp, output_filename,
             norm_function, annotation, exon_offset,
-            intron_offset, min_density_threshold, conf
+            intron_offset, min_density_threshold, conf, cores, cache_dir
         )
 
 
@@ -1232,15 +1515,15 @@ class PhastconMap(Map):
         num_events = defaultdict(dict)
 
         for filename, filetype in self.annotation.iteritems():
-            matrices['phastcon'][filename] = mtx.meta(
+            matrices['phastcon'][filename], self.events[filename] = mtx.meta(
                 annotation=filename, density=self.ip,
                 upstream_offset=self.upstream_offset,
                 downstream_offset=self.downstream_offset,
                 annotation_type=filetype
             )
-            num_events['phastcon'][filename] = [
-                matrices['phastcon'][filename].shape[0]
-            ] * matrices['phastcon'][filename].shape[1]
+            num_events['phastcon'][filename] = mtx.count_events(
+                matrices['phastcon'][filename]
+            )
         self.raw_matrices = matrices
         self.num_events = num_events
 
@@ -1260,7 +1543,7 @@ class PhastconMap(Map):
 
         for filename, filetype in self.annotation.iteritems():
             if filename == self.masked_file:
-                matrices['phastcon'][filename] = mtx.phastcon_region(
+                matrices['phastcon'][filename], self.events[filename] = mtx.phastcon_region(
                     annotation=filename, density=self.ip,
                     exon_offset=self.upstream_offset,
                     intron_offset=self.downstream_offset,
@@ -1271,7 +1554,7 @@ class PhastconMap(Map):
             else:
                 # Don't mask the background file, leave for all
 
-                matrices['phastcon'][filename] = mtx.phastcon_region(
+                matrices['phastcon'][filename], self.events[filename] = mtx.phastcon_region(
                     annotation=filename, density=self.ip,
                     exon_offset=self.upstream_offset,
                     intron_offset=self.downstream_offset,
@@ -1279,9 +1562,9 @@ class PhastconMap(Map):
                     peak=self.peak,
                     mask_df=False
                 )
-            num_events['phastcon'][filename] = [
-                matrices['phastcon'][filename].shape[0]
-            ] * matrices['phastcon'][filename].shape[1]
+            num_events['phastcon'][filename] = mtx.count_events(
+                matrices['phastcon'][filename]
+            )
             ct += 1
 
         self.raw_matrices = matrices
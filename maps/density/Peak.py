@@ -7,12 +7,17 @@ Module that helps containerize the CLIP peak information.
 
 @author: Brian
 """
+import numpy as np
 import pandas as pd
-import pybedtools
 import pyBigWig
-from . import intervals
+from .ReadDensity import Density, _prepare_batch
 
-class Peak():
+# how each overlapping peak is scored, see: intervals.score()
+SCORE_TYPES = ['simple', 'fraction_region', 'fraction_peak', 'region_name']
+# how the scores of peaks overlapping the same position are combined
+FLATTEN_TYPES = ['sum', 'min', 'max']
+
+class Peak(Density):
     """
     ReadDensity class
     Attributes:
@@ -20,16 +25,72 @@ class Peak():
         self.neg(negative *.bw file)
     """
 
-    def __init__(self, peaks, name=None):
+    def __init__(self, peaks, name=None, preload=False, score_type='simple',
+                 flatten=False):
+        """
+
+        Parameters
+        ----------
+        peaks : basestring
+            bigbed file of (stranded, BED6) peaks
+        name : basestring
+        preload : bool
+            if True, every peak in the bigbed is read into memory up front
+            (see: preload()) instead of one chromosome at a time as they're
+            needed. Preloaded peaks are also sent along (instead of being
+            re-read from the bigbed) when this object is pickled.
+        score_type : str
+            default score of each position a peak overlaps (see: values())
+        flatten : bool or str
+            default way to combine the scores of overlapping peaks
+            (see: values())
+        """
+        self.peaks_file = peaks
+        self.score_type = score_type
+        self.flatten = flatten
+        self.preloaded = False
+        # (chrom, strand) : sorted peak arrays, see _index()
+        self._peak_index = {}
         try:
             self.peaks = pyBigWig.open(peaks)
             self.name = name if name is not None else ''
-
+            if preload:
+                self.preload()
 
         except Exception as e:
             print("couldn't open the peak files!")
             print(e)
 
+    def __getstate__(self):
+        """
+        Open bigbed handles can't be pickled (ie. sent to a worker process),
+        so only the filename (and any preloaded peaks) is, and is reopened by
+        __setstate__().
+        """
+        state = self.__dict__.copy()
+        state.pop('peaks', None)
+        if not self.preloaded:
+            state['_peak_index'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.peaks = pyBigWig.open(self.peaks_file)
+
+    def preload(self):
+        """
+        Reads every entry of the bigbed file once into the per-(chrom,
+        strand) peak index (see: _index()), so that no later query has to go
+        back to the bigbed file.
+        """
+        for chrom, length in self.peaks.chroms().iteritems():
+            entries = self.peaks.entries(chrom, 0, length)
+            for strand in ['+', '-']:
+                self._peak_index[(chrom, strand)] = _index_entries(
+                    entries, strand
+                )
+        self.preloaded = True
+
     def overlaps(self, chrom, start, end, strand, flatten=False):
         """
         Returns true if there is a peak that overlaps the defined region.
@@ -47,25 +108,83 @@ class Peak():
         -------
 
         """
-        region = pybedtools.create_interval_from_list(
-            [
-                chrom, str(start), str(end), '.', '0', strand
-            ]
-        )
-        series = pd.Series(data=0, index=range(len(region)))
         try:
-            overlapped_peaks = self.peaks.entries(chrom, start, end, strand)
+            # like the bigbed query this replaces, peaks on either strand count
+            for s in ['+', '-']:
+                if len(self._overlapping(chrom, start, end, s)[0]) > 0:
+                    return True
         except RuntimeError as e:
             print(
             "weird entry (this can happen if the peak bb does not contain this chromosome, or if the region is invalid)"
             ": {}:{}-{}:{}".format(chrom, start, end, strand), e)
-            return False
-        if overlapped_peaks is None:
-            return False
-        else:
-            return True
+        return False
+
+    def _index(self, chrom, strand):
+        """
+        Returns every peak of one chromosome and strand as start-sorted
+        numpy arrays, reading them from the bigbed the first time they're
+        asked for. Raises RuntimeError if the chromosome isn't in the
+        bigbed file.
+
+        Parameters
+        ----------
+        chrom : basestring
+            (eg. chr1)
+        strand : str
+            either '+' or '-'
+
+        Returns
+        -------
+        starts : numpy.array
+            0-based start of each peak (sorted)
+        ends : numpy.array
+            1-based end of each peak
+        names : numpy.array
+            name (4th bed column) of each peak as a number, NaN if it
+            isn't one. Used by 'region_name' scoring.
+        max_length : int
+            length of the longest peak, which bounds how far upstream of a
+            window an overlapping peak can start.
+        """
+        key = (chrom, strand)
+        if key not in self._peak_index:
+            length = self.peaks.chroms(chrom)
+            if length is None:
+                raise RuntimeError("{} not in {}".format(chrom, self.peaks_file))
+            entries = self.peaks.entries(chrom, 0, length)
+            for s in ['+', '-']:
+                self._peak_index[(chrom, s)] = _index_entries(entries, s)
+        if key not in self._peak_index:
+            # no peaks are on a strand that's neither + or -
+            return _index_entries(None, strand)
+        return self._peak_index[key]
+
+    def _overlapping(self, chrom, start, end, strand):
+        """
+        Returns the peaks of one strand that overlap a region. Raises
+        RuntimeError like pyBigWig does if the chromosome doesn't exist or
+        the region runs off of it.
+
+        Returns
+        -------
+        starts : numpy.array
+        ends : numpy.array
+        names : numpy.array
+            the start, end and (numeric) name of each overlapping peak
+        """
+        starts, ends, names, max_length = self._index(chrom, strand)
+        if start < 0 or end > self.peaks.chroms(chrom) or end < start:
+            raise RuntimeError("Invalid interval bounds!")
+        # peaks are sorted by start, so only those starting between
+        # (start - longest peak) and end can overlap the region.
+        lo = np.searchsorted(starts, start - max_length, side='right')
+        hi = np.searchsorted(starts, end, side='left')
+        overlapping = ends[lo:hi] > start
+        return (starts[lo:hi][overlapping], ends[lo:hi][overlapping],
+                names[lo:hi][overlapping])
 
-    def values(self, chrom, start, end, strand, flatten=False):
+    def values(self, chrom, start, end, strand, flatten=None,
+               score_type=None):
         """
 
         Parameters
@@ -78,43 +197,211 @@ class Peak():
             1-based end (last position is not included)
         strand : str
             either '+' or '-'
-        flatten : bool
+        flatten : bool or str
             in the case where multiple peaks overlap a region,
-            scores will be summed over these regions. If flatten = True,
-            scores will be the minimum of the multiple peaks.
+            scores will be summed over these regions (False or 'sum').
+            If flatten = True or 'min', scores will be the minimum of the
+            multiple peaks, if 'max' the maximum. (default: self.flatten)
+        score_type : str
+            score of each position a peak overlaps (default: self.score_type)
+            if 'simple', 1
+            if 'fraction_region', 1/length of the region
+            if 'fraction_peak', 1/length of the peak
+            if 'region_name', the name (4th bed column) of the peak, ie. the
+            -log10(p) of input-normalized eCLIP peaks.
 
         Returns
         -------
-        densities : list
+        densities : pandas.Series
             values corresponding to density over specified positions.
         """
-
-        # Get all overlapping values
-        region = pybedtools.create_interval_from_list(
-            [
-                chrom, str(start), str(end), '.', '0', strand
-            ]
-        )
-        series = pd.Series(data=0, index=range(len(region)))
+        flatten = self.flatten if flatten is None else flatten
+        score_type = self.score_type if score_type is None else score_type
         try:
-            overlapped_peaks = self.peaks.entries(chrom, start, end, strand)
+            index = self._index(chrom, strand)
+            if start < 0 or end > self.peaks.chroms(chrom) or end < start:
+                raise RuntimeError("Invalid interval bounds!")
         except RuntimeError as e:
             print("weird entry (this can happen if the peak bb does not contain this chromosome, or if the region is invalid)"
                   ": {}:{}-{}:{}".format(chrom, start, end, strand), e)
-            return series
-
-        if overlapped_peaks is None:
-            return series
-        else:
-            for p in overlapped_peaks:
-                bed_list = [chrom, str(p[0]), str(p[1])] + p[2].split('\t')
-                if bed_list[5] == strand:
-                    peak = pybedtools.create_interval_from_list(bed_list)
-                    if flatten:
-                        print('not implemented or important yet')  # TODO: implement flatten
-                    else:
-                        series += intervals.get_overlap(peak, region)
-            return series
+            return pd.Series(data=0, index=range(max(end - start, 0)))
+        wiggle = _score_windows(
+            index, np.array([start]), np.array([end]), strand == '-',
+            score_type, flatten
+        )
+        return pd.Series(data=wiggle, index=range(len(wiggle)))
+
+    def values_batch(self, chroms, starts, ends, strands,
+                     out=None, offsets=None, rows=None):
+        """
+        Fills a matrix with the peak scores (see: values(), using
+        self.score_type and self.flatten) of many windows at once. All
+        windows of a chromosome and strand are scored together.
+        See: Density.values_batch()
+        """
+        chroms, starts, ends, strands, out, offsets, rows = _prepare_batch(
+            chroms, starts, ends, strands, out, offsets, rows
+        )
+        lengths = np.maximum(ends - starts, 0)
+        windows = np.where(lengths > 0)[0]
+        # windows that can't be scored are all 0, like in values()
+        skipped = []
+        for chrom, strand in sorted(set(zip(chroms[windows], strands[windows]))):
+            members = windows[
+                (chroms[windows] == chrom) & (strands[windows] == strand)
+            ]
+            try:
+                index = self._index(chrom, strand)
+            except RuntimeError as e:
+                print("weird entry (this can happen if the peak bb does not contain this chromosome)"
+                      ": {}:{}".format(chrom, strand), e)
+                skipped.append(members)
+                continue
+            valid = (starts[members] >= 0) & \
+                    (ends[members] <= self.peaks.chroms(chrom))
+            if not np.all(valid):
+                print("{} regions run off of {}".format(
+                    np.sum(~valid), chrom
+                ))
+                skipped.append(members[~valid])
+                members = members[valid]
+            wiggles = _score_windows(
+                index, starts[members], ends[members], strand == '-',
+                self.score_type, self.flatten
+            )
+            out[np.repeat(rows[members], lengths[members]),
+                _ranges(offsets[members], lengths[members])] = wiggles
+        if len(skipped) > 0:
+            skipped = np.concatenate(skipped)
+            out[np.repeat(rows[skipped], lengths[skipped]),
+                _ranges(offsets[skipped], lengths[skipped])] = 0
+        return out
 
     def pseudocount(self):
-        return 0
\ No newline at end of file
+        return 0
+
+
+def _index_entries(entries, strand):
+    """
+    Turns the (start, end, rest of the bed line) tuples returned by
+    pyBigWig's entries() into start-sorted arrays of the peaks on one
+    strand. See: Peak._index()
+    """
+    fields = [e[2].split('\t') for e in entries] if entries else []
+    on_strand = [i for i, f in enumerate(fields)
+                 if len(f) > 2 and f[2] == strand]
+    starts = np.array([entries[i][0] for i in on_strand], dtype=np.int64)
+    ends = np.array([entries[i][1] for i in on_strand], dtype=np.int64)
+    names = np.array(
+        [_to_float(fields[i][0]) for i in on_strand], dtype=np.float64
+    )
+    order = np.argsort(starts, kind='mergesort')
+    max_length = int(np.max(ends - starts)) if len(starts) > 0 else 0
+    return starts[order], ends[order], names[order], max_length
+
+
+def _to_float(score):
+    try:
+        return float(score)
+    except ValueError:
+        return np.nan
+
+
+def _ranges(firsts, lengths):
+    """
+    Returns the concatenation of arange(first, first + length) for each
+    first and length.
+    """
+    return np.repeat(firsts - (np.cumsum(lengths) - lengths), lengths) + \
+        np.arange(np.sum(lengths))
+
+
+def _score_windows(index, starts, ends, reverse, score_type='simple',
+                   flatten=False):
+    """
+    Scores every position of many windows on the same chromosome and strand
+    with the peaks that overlap them. Each (window, overlapping peak) pair
+    is found with searchsorted and expanded into the positions it covers,
+    so no per-window or per-peak python loop is needed.
+
+    Parameters
+    ----------
+    index : tuple
+        start-sorted peak arrays of a chromosome and strand
+        (see: Peak._index())
+    starts : numpy.array
+        0-based start of each window
+    ends : numpy.array
+        1-based end of each window (windows must not be empty)
+    reverse : bool
+        if True, each window's scores are returned 3' -> 5' in genomic
+        terms, ie. in the orientation of the (-) strand.
+    score_type : str
+        see: Peak.values()
+    flatten : bool or str
+        see: Peak.values()
+
+    Returns
+    -------
+    scores : numpy.array
+        the scores of each window's positions, one window after the other.
+        'simple' scores are integers, the others are floats.
+    """
+    if flatten is True:
+        flatten = 'min'
+    elif flatten is False or flatten is None:
+        flatten = 'sum'
+    if score_type not in SCORE_TYPES:
+        raise ValueError("score_type must be one of {}".format(SCORE_TYPES))
+    if flatten not in FLATTEN_TYPES:
+        raise ValueError("flatten must be one of {}".format(FLATTEN_TYPES))
+
+    peak_starts, peak_ends, peak_names, max_length = index
+    lengths = ends - starts
+    # every peak starting between (start - longest peak) and end of a window
+    lo = np.searchsorted(peak_starts, starts - max_length, side='right')
+    hi = np.searchsorted(peak_starts, ends, side='left')
+    window = np.repeat(np.arange(len(starts)), hi - lo)
+    peak = _ranges(lo, hi - lo)
+    overlapping = peak_ends[peak] > starts[window]
+    window = window[overlapping]
+    peak = peak[overlapping]
+
+    # positions each peak covers, relative to the start of its window
+    first = np.maximum(peak_starts[peak], starts[window]) - starts[window]
+    last = np.minimum(peak_ends[peak], ends[window]) - starts[window]
+    if reverse:
+        first, last = lengths[window] - last, lengths[window] - first
+
+    if score_type == 'simple':
+        weights = np.ones(len(peak), dtype=np.int64)
+    elif score_type == 'fraction_region':
+        weights = 1.0 / lengths[window]
+    elif score_type == 'fraction_peak':
+        weights = 1.0 / (peak_ends[peak] - peak_starts[peak])
+    else:
+        weights = peak_names[peak]
+
+    covered = last - first
+    positions = _ranges(first + np.cumsum(lengths)[window] - lengths[window],
+                        covered)
+    weights = np.repeat(weights, covered)
+    if flatten == 'sum':
+        if score_type == 'simple':
+            return np.bincount(positions, minlength=np.sum(lengths))
+        # (bincount returns integers when there's nothing to count)
+        return np.bincount(positions, weights=weights,
+                           minlength=np.sum(lengths)).astype(np.float64)
+    # sorted by position, then score: the first (min) or last (max) score
+    # of each position is kept.
+    order = np.lexsort((weights, positions))
+    positions = positions[order]
+    weights = weights[order]
+    keep = np.ones(len(positions), dtype=bool)
+    if flatten == 'min':
+        keep[1:] = positions[1:] != positions[:-1]
+    else:
+        keep[:-1] = positions[1:] != positions[:-1]
+    scores = np.zeros(np.sum(lengths), dtype=weights.dtype)
+    scores[positions[keep]] = weights[keep]
+    return scores
@@ -12,12 +12,179 @@ import numpy as np
 import pyBigWig
 import pysam
 import os
+import hashlib
+import tempfile
+import time
 
 
 class Density:
     def values(self, chrom, start, end, strand):
         return 0
 
+    def values_batch(self, chroms, starts, ends, strands,
+                     out=None, offsets=None, rows=None):
+        """
+        Fills a matrix with the values of many windows at once.
+        This is the generic version that just calls values() once
+        for every window. Subclasses backed by bigwig files override this
+        to read all windows of a chromosome in as few calls as possible.
+
+        Parameters
+        ----------
+        chroms : list
+            (eg. chr1) for each window
+        starts : numpy.array
+            0-based start for each window
+        ends : numpy.array
+            1-based end for each window
+        strands : list
+            either '+' or '-' for each window
+        out : numpy.ndarray
+            (n windows x width) matrix to fill. If None, a NaN-filled matrix
+            as wide as the widest window (+ its offset) is created.
+        offsets : numpy.array
+            column at which each row's values should begin (default 0).
+            Values are always written in the strand-specific (5' -> 3')
+            orientation.
+        rows : numpy.array
+            row of out that each window is written to (default: one row per
+            window, in order). Several windows may share a row, ie. to join
+            the exons of a transcript.
+
+        Returns
+        -------
+        out : numpy.ndarray
+            matrix of values, one row per window. Positions not covered by
+            any window are left untouched.
+        """
+        chroms, starts, ends, strands, out, offsets, rows = _prepare_batch(
+            chroms, starts, ends, strands, out, offsets, rows
+        )
+        for row in range(len(starts)):
+            length = ends[row] - starts[row]
+            if length <= 0:
+                continue
+            wiggle = self.values(
+                chroms[row], starts[row], ends[row], strands[row]
+            )
+            out[rows[row], offsets[row]:offsets[row] + length] = wiggle
+        return out
+
+
+def _prepare_batch(chroms, starts, ends, strands, out=None, offsets=None,
+                   rows=None):
+    """
+    Coerces the window descriptions for values_batch() into arrays and
+    allocates the output matrix if one isn't supplied.
+    """
+    chroms = np.asarray(chroms)
+    strands = np.asarray(strands)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if offsets is None:
+        offsets = np.zeros(len(starts), dtype=np.int64)
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+    if rows is None:
+        rows = np.arange(len(starts))
+    else:
+        rows = np.asarray(rows, dtype=np.int64)
+    if out is None:
+        width = np.max(offsets + np.maximum(ends - starts, 0)) \
+            if len(starts) > 0 else 0
+        out = np.empty((np.max(rows) + 1 if len(rows) > 0 else 0, width))
+        out.fill(np.nan)
+    return chroms, starts, ends, strands, out, offsets, rows
+
+
+def _merge_windows(starts, ends):
+    """
+    Given windows sorted by start, returns where each merged block begins
+    such that overlapping and adjacent (touching) windows share a block.
+
+    Parameters
+    ----------
+    starts : numpy.array
+        sorted 0-based starts
+    ends : numpy.array
+        1-based ends (same order as starts)
+
+    Returns
+    -------
+    boundaries : numpy.array
+        index of the first window of each block, followed by len(starts).
+    """
+    furthest_end = np.maximum.accumulate(ends)
+    new_block = np.ones(len(starts), dtype=bool)
+    new_block[1:] = starts[1:] > furthest_end[:-1]
+    return np.append(np.where(new_block)[0], len(starts))
+
+
+def _fill_batch(density, chroms, starts, ends, strands, out, offsets, rows):
+    """
+    Groups windows by chromosome and strand, merges overlapping/adjacent
+    windows and reads each merged block once with density._block_values().
+    Each window is then copied out of its block (reversed by a view for
+    the (-) strand).
+    """
+    valid = (ends - starts) > 0
+    stranded = (strands == '+') | (strands == '-')
+    if not np.all(stranded[valid]):
+        print("Strand neither + or -")
+    windows = np.where(valid & stranded)[0]
+
+    # sort by chrom, then strand, then start position
+    windows = windows[np.lexsort(
+        (starts[windows], strands[windows], chroms[windows])
+    )]
+    if len(windows) == 0:
+        return out
+    key_change = np.ones(len(windows), dtype=bool)
+    key_change[1:] = (chroms[windows][1:] != chroms[windows][:-1]) | \
+                     (strands[windows][1:] != strands[windows][:-1])
+    group_starts = np.append(np.where(key_change)[0], len(windows))
+
+    for g in range(len(group_starts) - 1):
+        group = windows[group_starts[g]:group_starts[g + 1]]
+        chrom = chroms[group[0]]
+        strand = strands[group[0]]
+        boundaries = _merge_windows(starts[group], ends[group])
+        for b in range(len(boundaries) - 1):
+            members = group[boundaries[b]:boundaries[b + 1]]
+            block_start = starts[members].min()
+            block_end = ends[members].max()
+            try:
+                block = density._block_values(
+                    chrom, block_start, block_end, strand
+                )
+            except RuntimeError:
+                # usually occurs when no chromosome exists in the bigwig
+                # file, or a window runs off the chromosome. Read each
+                # window on its own so only the bad windows are NaN
+                # (like values(), so they're cleaned to 0 rather than
+                # keeping whatever out was filled with).
+                block = None
+            for window in members:
+                length = ends[window] - starts[window]
+                if block is not None:
+                    wiggle = block[
+                        starts[window] - block_start:ends[window] - block_start
+                    ]
+                else:
+                    try:
+                        wiggle = density._block_values(
+                            chrom, starts[window], ends[window], strand
+                        )
+                    except RuntimeError:
+                        out[rows[window],
+                            offsets[window]:offsets[window] + length] = np.nan
+                        continue
+                if strand == '-':
+                    wiggle = wiggle[::-1]
+                out[rows[window],
+                    offsets[window]:offsets[window] + length] = wiggle
+    return out
+
 
 class ReadDensity(Density):
     """
@@ -28,6 +195,9 @@ class ReadDensity(Density):
     """
 
     def __init__(self, pos, neg, name=None, bam=None):
+        self.pos_file = pos
+        self.neg_file = neg
+        self.bam_file = bam
         try:
             self.pos = pyBigWig.open(pos)
             self.neg = pyBigWig.open(neg)
@@ -45,6 +215,26 @@ class ReadDensity(Density):
             print("couldn't open the bigwig files!")
             print(e)
 
+    def __getstate__(self):
+        """
+        Open bigwig/bam handles can't be pickled (ie. sent to a worker
+        process), so only their filenames are. See: __setstate__()
+        """
+        state = self.__dict__.copy()
+        for handle in ['pos', 'neg', 'bam']:
+            state.pop(handle, None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Reopens the bigwig/bam files in whichever process unpickles this.
+        """
+        self.__dict__.update(state)
+        self.pos = pyBigWig.open(self.pos_file)
+        self.neg = pyBigWig.open(self.neg_file)
+        if self.bam_file is not None:
+            self.bam = pysam.AlignmentFile(self.bam_file)
+
     def pseudocount(self):
         """
         Returns the minimum normalized pseudocount of 1 read.
@@ -111,10 +301,316 @@ class ReadDensity(Density):
             # usually occurs when no chromosome exists in the bigwig file
             return [np.NaN] * abs(start - end)
 
+    def _block_values(self, chrom, start, end, strand):
+        """
+        Returns the unreversed (genomic order) values over a region as a
+        numpy array. Raises RuntimeError like pyBigWig does.
+        """
+        return _bigwig_values(self.pos if strand == '+' else self.neg,
+                              chrom, start, end)
+
+    def values_batch(self, chroms, starts, ends, strands,
+                     out=None, offsets=None, rows=None):
+        """
+        Fills a matrix with the density values of many windows at once.
+        Windows are grouped by chromosome and strand, and overlapping or
+        adjacent windows are merged so that each merged block is read
+        from the bigwig file just once.
+
+        Parameters
+        ----------
+        chroms : list
+            (eg. chr1) for each window
+        starts : numpy.array
+            0-based start for each window
+        ends : numpy.array
+            1-based end for each window
+        strands : list
+            either '+' or '-' for each window
+        out : numpy.ndarray
+            (n windows x width) matrix to fill. If None, a NaN-filled matrix
+            as wide as the widest window (+ its offset) is created.
+        offsets : numpy.array
+            column at which each row's values should begin (default 0).
+        rows : numpy.array
+            row of out that each window is written to (default: one row per
+            window, in order).
+
+        Returns
+        -------
+        out : numpy.ndarray
+            matrix of densities, one row per window, ordered by strand
+            (ie. the same as values() would return for each window).
+        """
+        chroms, starts, ends, strands, out, offsets, rows = _prepare_batch(
+            chroms, starts, ends, strands, out, offsets, rows
+        )
+        return _fill_batch(
+            self, chroms, starts, ends, strands, out, offsets, rows
+        )
+
+
+def _bigwig_values(bigwig, chrom, start, end):
+    """
+    Returns values from an open pyBigWig file as a numpy array, using
+    pyBigWig's numpy support if it was compiled with it.
+    """
+    if pyBigWig.numpy:
+        return bigwig.values(chrom, int(start), int(end), numpy=True)
+    return np.array(bigwig.values(chrom, int(start), int(end)))
+
+
+def _bigwig_chunk(bigwig, chrom, start, end):
+    """
+    Returns the same values as _bigwig_values(), but builds them from the
+    (usually sparse) intervals stored in the bigwig instead of asking for
+    every position, which is much faster for large regions.
+    """
+    chunk = np.empty(end - start, dtype=np.float32)
+    chunk.fill(np.nan)
+    entries = bigwig.intervals(chrom, int(start), int(end))
+    if not entries:
+        return chunk
+    entries = np.array(entries)
+    starts = np.maximum(entries[:, 0].astype(np.int64), start) - start
+    ends = np.minimum(entries[:, 1].astype(np.int64), end) - start
+    lengths = ends - starts
+    # position of every covered base, relative to start
+    positions = np.arange(lengths.sum()) + np.repeat(
+        starts - (np.cumsum(lengths) - lengths), lengths
+    )
+    chunk[positions] = np.repeat(entries[:, 2], lengths)
+    return chunk
+
+
+class ChromosomeCache:
+    """
+    On-disk cache of whole-chromosome bigwig values.
+
+    Each chromosome of a bigwig file is decoded once into a float32 *.npy
+    file named after the bigwig path, its modification time and the
+    chromosome, and is memory-mapped from then on. Since the key includes
+    the mtime, a rewritten bigwig is never served stale values. Once the
+    cache grows past max_size bytes, the least recently used chromosomes
+    (across all bigwigs sharing this cache_dir) are deleted, except those
+    used in the last min_age seconds (which another process, ie. another
+    --cores worker, may be about to load).
+
+    Attributes:
+        self.cache_dir (directory holding the *.npy files)
+        self.max_size (maximum size of the cache in bytes)
+    """
+    # number of positions decoded from the bigwig at a time
+    chunk_size = 10000000
+    # seconds after it's used that a chromosome can't be evicted
+    min_age = 10
+
+    def __init__(self, cache_dir, max_size=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._arrays = {}
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # another process may have just made it
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def __getstate__(self):
+        # memory-mapped arrays are remapped by each process, not copied.
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _cache_file(self, filename, chrom):
+        """
+        Returns the *.npy filename for a bigwig's chromosome.
+        """
+        filename = os.path.abspath(filename)
+        key = hashlib.md5(
+            "{}:{}:{}".format(filename, os.path.getmtime(filename), chrom)
+        ).hexdigest()
+        return os.path.join(
+            self.cache_dir,
+            "{}.{}.{}.npy".format(os.path.basename(filename), chrom, key)
+        )
+
+    def array(self, bigwig, filename, chrom):
+        """
+        Returns the values of an entire chromosome as a read-only,
+        memory-mapped float32 array, decoding them first if they
+        aren't already cached.
+
+        Parameters
+        ----------
+        bigwig : pyBigWig
+            open bigwig file
+        filename : basestring
+            path of the bigwig file (used as part of the cache key)
+        chrom : basestring
+            (eg. chr1)
+
+        Returns
+        -------
+        values : numpy.memmap
+            values (nan where there is no coverage) from position 0 to the
+            end of the chromosome, or None if the chromosome isn't in the
+            bigwig file.
+        """
+        if (filename, chrom) in self._arrays:
+            return self._arrays[(filename, chrom)][1]
+        if chrom not in bigwig.chroms():
+            return None
+        cache_file = self._cache_file(filename, chrom)
+        if not os.path.exists(cache_file):
+            self._decode(bigwig, chrom, cache_file)
+        try:
+            values = self._load(cache_file)
+        except (OSError, IOError):
+            # evicted by another process since we checked for it
+            self._decode(bigwig, chrom, cache_file)
+            values = self._load(cache_file)
+        self._evict(keep=cache_file)
+        self._arrays[(filename, chrom)] = (cache_file, values)
+        return values
+
+    def _load(self, cache_file):
+        """
+        Marks cache_file as the most recently used and memory-maps it.
+        Raises OSError/IOError if it no longer exists.
+        """
+        os.utime(cache_file, None)
+        return np.load(cache_file, mmap_mode='r')
+
+    def _decode(self, bigwig, chrom, cache_file):
+        """
+        Writes a chromosome's values to cache_file. The values are written
+        to a temporary file first and renamed, so concurrent runs never
+        see a partially written cache.
+        """
+        length = bigwig.chroms(chrom)
+        handle, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(handle)
+        try:
+            values = np.lib.format.open_memmap(
+                tmp, mode='w+', dtype=np.float32, shape=(length,)
+            )
+            for start in range(0, length, self.chunk_size):
+                end = min(start + self.chunk_size, length)
+                values[start:end] = _bigwig_chunk(bigwig, chrom, start, end)
+            values.flush()
+            del values
+            os.rename(tmp, cache_file)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _evict(self, keep=None):
+        """
+        Removes the least recently used *.npy files until the cache is no
+        bigger than max_size (never removing keep, or files used in the
+        last min_age seconds).
+        """
+        recent = time.time() - self.min_age
+        cached = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npy'):
+                f = os.path.join(self.cache_dir, f)
+                try:
+                    cached.append((os.path.getmtime(f), os.path.getsize(f), f))
+                except OSError:  # removed by another process
+                    continue
+        total = sum([size for _, size, _ in cached])
+        for mtime, size, f in sorted(cached):
+            if total <= self.max_size:
+                break
+            if f == keep or mtime > recent:
+                continue
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            # already mapped arrays stay readable until they're released
+            for key, (cache_file, _) in list(self._arrays.items()):
+                if cache_file == f:
+                    del self._arrays[key]
+            total -= size
+
+
+class CachedReadDensity(ReadDensity):
+    """
+    ReadDensity whose values are served from whole-chromosome,
+    memory-mapped caches of the pos and neg bigwigs (see: ChromosomeCache),
+    so that repeated runs over the same bigwigs skip bigwig decompression.
+    values() returns (zero-copy) numpy array views instead of lists.
+
+    Attributes:
+        self.pos(positive *.bw file)
+        self.neg(negative *.bw file)
+        self.cache(ChromosomeCache)
+    """
+
+    def __init__(self, pos, neg, name=None, bam=None, cache_dir=None,
+                 max_cache_size=20 * 1024 ** 3):
+        ReadDensity.__init__(self, pos, neg, name, bam)
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.path.dirname(os.path.abspath(pos)), '.density_cache'
+            )
+        self.cache = ChromosomeCache(cache_dir, max_cache_size)
+
+    def _chromosome(self, chrom, strand):
+        if strand == '+':
+            return self.cache.array(self.pos, self.pos_file, chrom)
+        return self.cache.array(self.neg, self.neg_file, chrom)
+
+    def values(self, chrom, start, end, strand):
+        """
+
+        Parameters
+        ----------
+        chrom : basestring
+            (eg. chr1)
+        start : int
+            0-based start (first position in chromosome is 0)
+        end : int
+            1-based end (last position is not included)
+        strand : str
+            either '+' or '-'
+
+        Returns
+        -------
+        densites : numpy.array
+            values corresponding to density over specified positions.
+        """
+        if strand != "+" and strand != "-":
+            print("Strand neither + or -")
+            return 1
+        try:
+            wiggle = self._block_values(chrom, start, end, strand)
+        except RuntimeError:
+            # usually occurs when no chromosome exists in the bigwig file
+            return [np.NaN] * abs(start - end)
+        return wiggle if strand == '+' else wiggle[::-1]
+
+    def _block_values(self, chrom, start, end, strand):
+        """
+        Returns the unreversed (genomic order) values over a region as a
+        view of the cached chromosome. Raises RuntimeError (like pyBigWig)
+        if the chromosome doesn't exist or the region runs off of it.
+        """
+        values = self._chromosome(chrom, strand)
+        if values is None or start < 0 or end > len(values) or start >= end:
+            raise RuntimeError(
+                "Invalid interval bounds! {}:{}-{}".format(chrom, start, end)
+            )
+        return values[start:end]
 
 class Phastcon(Density):
 
     def __init__(self, phastcon, name=None):
+        self.phastcon_file = phastcon
         try:
             self.phastcon = pyBigWig.open(phastcon)
             self.name = name if name is not None else os.path.basename(phastcon)
@@ -122,6 +618,18 @@ class Phastcon(Density):
             print("couldn't open the bigwig files!")
             print(e)
 
+    def __getstate__(self):
+        """
+        Only the phastcon filename is pickled (see: ReadDensity)
+        """
+        state = self.__dict__.copy()
+        state.pop('phastcon', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.phastcon = pyBigWig.open(self.phastcon_file)
+
     def values(self, chrom, start, end, strand):
         """
 
@@ -153,3 +661,23 @@ class Phastcon(Density):
         except RuntimeError:
             # usually occurs when no chromosome exists in the bigwig file
             return [np.NaN] * abs(start - end)
+
+    def _block_values(self, chrom, start, end, strand):
+        """
+        Returns the unreversed (genomic order) values over a region as a
+        numpy array. Raises RuntimeError like pyBigWig does.
+        """
+        return _bigwig_values(self.phastcon, chrom, start, end)
+
+    def values_batch(self, chroms, starts, ends, strands,
+                     out=None, offsets=None, rows=None):
+        """
+        Fills a matrix with the phastcon scores of many windows at once.
+        See: ReadDensity.values_batch()
+        """
+        chroms, starts, ends, strands, out, offsets, rows = _prepare_batch(
+            chroms, starts, ends, strands, out, offsets, rows
+        )
+        return _fill_batch(
+            self, chroms, starts, ends, strands, out, offsets, rows
+        )
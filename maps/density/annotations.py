@@ -0,0 +1,656 @@
+#!/bin/env python
+
+"""
+Created on May 20, 2019
+
+Module that reads a whole annotation file (rmats, miso, eric/tab, xintao,
+bed, bed12 or twobed) at once into tables of region coordinates, instead of
+creating a Feature (and its pybedtools intervals) for every event.
+
+Main Functions
+--------------
+read_table : reads the unique events of an annotation file
+read_regions : reads the regions (ie. upstream, skipped, downstream exons)
+    of every event as columns of coordinates, from a cached *.npz sidecar
+    if given a cache_dir the annotation file has been read into before
+"""
+import csv
+import hashlib
+import os
+import re
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+import numpy as np
+import pandas as pd
+import Feature
+
+REGION_COLUMNS = ['chrom', 'start', 'end', 'strand']
+CACHE_VERSION = 1  # bump whenever parsing changes, to ignore old sidecars
+HEADERS = ('event_name', 'ID', 'annotation')  # first words of header lines
+
+# regions of each event type, in the order Feature.get_bedtools() returns them
+REGIONS = {
+    'se': ['upstream', 'skipped', 'downstream'],
+    'a3ss': ['upstream', 'alt1', 'alt2'],
+    'a5ss': ['alt1', 'alt2', 'downstream'],
+    'ri': ['upstream', 'downstream'],
+    'mxe': ['upstream', 'up_mxe', 'down_mxe', 'downstream'],
+    'bed': ['region'],
+}
+
+
+def read_table(annotation):
+    """
+    Reads every unique event (line) of an annotation file, and splits all
+    of them into fields with a single pandas.read_csv() call. Lines
+    starting with 'event_name', 'ID' or 'annotation' are assumed to be
+    headers (see: matrix.read_events).
+
+    Parameters
+    ----------
+    annotation : basestring or list
+        filename of the annotation file, or a list of its lines (ie. one
+        chunk of a file)
+
+    Returns
+    -------
+    names : numpy.array
+        each unique (stripped) line, in the order they appear
+    table : pandas.DataFrame
+        the tab-separated fields of each line (as strings) with columns
+        numbered from 0, and '' for missing fields.
+    """
+    if isinstance(annotation, list):
+        lines = annotation
+    else:
+        with open(annotation) as f:
+            lines = f.read().splitlines()
+    names = pd.Series([
+        line.rstrip() for line in lines
+        if line.strip() and not line.startswith(HEADERS)
+    ], dtype=object)
+    names = names[~names.duplicated()].values
+    if len(names) == 0:
+        return names, pd.DataFrame(columns=[0])
+    try:
+        table = pd.read_csv(
+            StringIO('\n'.join(names)), sep='\t', header=None, dtype=str,
+            quoting=csv.QUOTE_NONE, na_filter=False
+        )
+    except pd.errors.ParserError:
+        # lines have more fields than the first one
+        table = pd.DataFrame([name.split('\t') for name in names]).fillna('')
+    return names, table
+
+
+def read_regions(annotation, event, annotation_type, cache_dir=None):
+    """
+    Reads the coordinates of every region of every (unique) event in an
+    annotation file. If cache_dir is given, the parsed regions of a file
+    are saved to a sidecar there (see: RegionCache) and read back from it
+    the next time the same file is read as the same event and
+    annotation_type.
+
+    Parameters
+    ----------
+    annotation : basestring or list
+        filename of the annotation file, or a list of its lines
+    event : basestring
+        one of REGIONS (ie. 'se')
+    annotation_type : basestring
+        format of the annotation file (ie. 'rmats', 'miso', 'eric')
+    cache_dir : basestring
+        directory of the sidecar cache, or None to always parse the file
+        (lists of lines are never cached)
+
+    Returns
+    -------
+    names : numpy.array
+        name of each event (its annotation line)
+    regions : list
+        one region table (see: region_table) per region of REGIONS[event],
+        with one row per event.
+    """
+    if cache_dir is not None and not isinstance(annotation, list):
+        return RegionCache(annotation, cache_dir).regions(
+            event, annotation_type
+        )
+    names, table = read_table(annotation)
+    return names, parse_regions(names, table, event, annotation_type)
+
+
+class RegionCache:
+    """
+    Sidecar cache of the parsed regions of an annotation file.
+
+    The regions of each event type and annotation_type a file is read as
+    are saved to cache_dir as a *.npz named after the file (its name and
+    the md5 of its path), the event, the annotation_type and the md5 of
+    the file's contents, so that a changed file is parsed again instead of
+    being served stale regions. Sidecars of older contents are removed
+    once the new one is written.
+
+    Attributes:
+        self.annotation (annotation filename)
+        self.cache_dir (directory holding the *.npz files)
+    """
+
+    def __init__(self, annotation, cache_dir):
+        self.annotation = annotation
+        self.cache_dir = cache_dir
+
+    def _prefix(self, event, annotation_type):
+        # files of the same name in different directories share cache_dir
+        path = hashlib.md5(os.path.abspath(self.annotation)).hexdigest()
+        return "{}.{}.{}.{}.".format(
+            os.path.basename(self.annotation), path, event, annotation_type
+        )
+
+    def _cache_file(self, event, annotation_type):
+        """
+        Returns the *.npz filename for the current contents of the file.
+        """
+        md5 = hashlib.md5()
+        with open(self.annotation, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                md5.update(block)
+        return os.path.join(self.cache_dir, "{}{}.npz".format(
+            self._prefix(event, annotation_type), md5.hexdigest()
+        ))
+
+    def regions(self, event, annotation_type):
+        """
+        Returns the (names, regions) of the file (see: read_regions),
+        parsing the file and writing its sidecar if there isn't one yet.
+        """
+        cache_file = self._cache_file(event, annotation_type)
+        if os.path.exists(cache_file):
+            try:
+                return _load_regions(cache_file)
+            except (IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+                print("couldn't read cached regions {}, reading {} again "
+                      "({})".format(cache_file, self.annotation, e))
+        names, regions = read_regions(
+            self.annotation, event, annotation_type
+        )
+        try:
+            self._write(
+                cache_file, self._prefix(event, annotation_type),
+                names, regions
+            )
+        except (IOError, OSError) as e:
+            print("couldn't cache the regions of {} ({})".format(
+                self.annotation, e
+            ))
+        return names, regions
+
+    def _write(self, cache_file, prefix, names, regions):
+        """
+        Writes the regions to cache_file, and removes the other sidecars
+        named prefix + md5 + '.npz' (ie. of older contents of the same
+        file, but not of files whose names start with prefix). As
+        in ChromosomeCache, the sidecar is written to a temporary file
+        first and renamed, so concurrent runs never see a partially
+        written cache.
+        """
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:  # another process may have just made it
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        handle, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **_region_arrays(names, regions))
+            os.rename(tmp, cache_file)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        stale = re.compile(re.escape(prefix) + r'[0-9a-f]{32}\.npz$')
+        for f in os.listdir(self.cache_dir):
+            if stale.match(f) and f != os.path.basename(cache_file):
+                try:
+                    os.remove(os.path.join(self.cache_dir, f))
+                except OSError:  # removed by another process
+                    pass
+
+
+def _region_arrays(names, regions):
+    """
+    Returns the (names, regions) of read_regions as arrays for np.savez:
+    names joined by newlines and, for each region, its chroms and strands
+    as codes into their unique values.
+    """
+    arrays = {
+        'version': np.array(CACHE_VERSION),
+        'num_events': np.array(len(names)),
+        'num_regions': np.array(len(regions)),
+        'names': np.array('\n'.join(names)),
+    }
+    for i, region in enumerate(regions):
+        for column in ('chrom', 'strand'):
+            codes, uniques = pd.factorize(region[column])
+            arrays['{}{}_codes'.format(column, i)] = codes.astype(np.int32)
+            arrays['{}{}'.format(column, i)] = np.array(
+                list(uniques), dtype=str
+            )
+        arrays['start{}'.format(i)] = region['start'].values
+        arrays['end{}'.format(i)] = region['end'].values
+    return arrays
+
+
+def _load_regions(cache_file):
+    """
+    Reads the (names, regions) written by RegionCache._write().
+    """
+    with np.load(cache_file) as arrays:
+        if int(arrays['version']) != CACHE_VERSION:
+            raise ValueError("cache version {}".format(arrays['version']))
+        num_events = int(arrays['num_events'])
+        names = np.array(
+            arrays['names'].item().split('\n') if num_events > 0 else [],
+            dtype=object
+        )
+        regions = []
+        for i in range(int(arrays['num_regions'])):
+            columns = {}
+            for column in ('chrom', 'strand'):
+                uniques = arrays['{}{}'.format(column, i)].astype(object)
+                columns[column] = uniques[
+                    arrays['{}{}_codes'.format(column, i)]
+                ] if num_events > 0 else []
+            regions.append(region_table(
+                columns['chrom'], arrays['start{}'.format(i)],
+                arrays['end{}'.format(i)], columns['strand']
+            ))
+    if len(names) != num_events:
+        raise ValueError("expected {} events".format(num_events))
+    return names, regions
+
+
+def parse_regions(names, table, event, annotation_type):
+    """
+    Derives the coordinates of each region of an event type from the fields
+    of an annotation (see: read_table). Formats without a column parser are
+    read one line at a time with the matching Feature class, as are files
+    the column parser can't make sense of.
+
+    Returns
+    -------
+    regions : list
+        one region table (see: region_table) per region of REGIONS[event]
+    """
+    parser = _PARSERS.get((event, annotation_type))
+    if parser is not None and len(names) > 0:
+        try:
+            regions = parser(table, names)
+            return [regions[region] for region in REGIONS[event]]
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            print("couldn't read {} events as {}, reading them one at a "
+                  "time ({})".format(event, annotation_type, e))
+    return _feature_regions(names, event, annotation_type)
+
+
+def region_table(chroms, starts, ends, strands):
+    """
+    Returns a table of REGION_COLUMNS: one region (0-based start, 1-based
+    end) per row.
+    """
+    return pd.DataFrame({
+        'chrom': np.asarray(chroms, dtype=object),
+        'start': np.asarray(starts, dtype=np.int64),
+        'end': np.asarray(ends, dtype=np.int64),
+        'strand': np.asarray(strands, dtype=object)
+    }, columns=REGION_COLUMNS)
+
+
+def _feature_regions(names, event, annotation_type):
+    """
+    Reads each event with the Feature class of its event type (the slow
+    way), for formats that don't have a column parser.
+    """
+    rows = [[] for _ in REGIONS[event]]
+    for name in names:
+        if event == 'bed':
+            intervals = [
+                Feature.Feature(name, annotation_type).get_bedtool()
+            ]
+        else:
+            try:
+                intervals = _FEATURES[event](
+                    name, annotation_type
+                ).get_bedtools()
+            except Exception as e:
+                print("Having trouble parsing event: \
+                {} (assumed type: {})".format(name, annotation_type))
+                raise e
+        for region, interval in zip(rows, intervals):
+            region.append((interval.chrom, interval.start, interval.end,
+                           interval.strand))
+    return [
+        region_table(*zip(*region)) if len(region) > 0
+        else region_table([], [], [], []) for region in rows
+    ]
+
+
+def _ints(column):
+    return column.astype(np.int64).values
+
+
+def _split(column, sep, n):
+    """
+    Splits a column of strings into (exactly) n columns.
+    """
+    columns = column.str.split(sep, expand=True)
+    if columns.shape[1] != n or columns.isnull().values.any():
+        raise ValueError("expected {} fields separated by '{}'".format(n, sep))
+    return [columns[i] for i in range(n)]
+
+
+def _swap_on_minus(strands, plus, minus):
+    """
+    Returns plus where strands are '+' and minus where they are '-'. Other
+    strands are treated like '+', with a warning.
+    """
+    if not np.all((strands == '+') | (strands == '-')):
+        print("Warning, strand not correct!")
+    return np.where(strands == '-', minus, plus)
+
+
+def _miso_region(column):
+    """ chrom:start:end:strand (1-based start) """
+    chrom, start, end, strand = _split(column, ':', 4)
+    return region_table(chrom, _ints(start) - 1, _ints(end), strand)
+
+
+def _se_miso(table, names):
+    upstream, skipped, downstream = _split(table[0], '@', 3)
+    return {
+        'upstream': _miso_region(upstream),
+        'skipped': _miso_region(skipped),
+        'downstream': _miso_region(downstream)
+    }
+
+
+def _se_eric(table, names):
+    chrom, strand, _, _, _ = _split(table[0], '|', 5)
+    strand = strand.values
+    low_start, low_end = [_ints(c) for c in _split(table[1], '-', 2)]
+    se_start, se_end = [_ints(c) for c in _split(table[2], '-', 2)]
+    high_start, high_end = [_ints(c) for c in _split(table[3], '-', 2)]
+    # these are coord-based not *stream-based.
+    return {
+        'upstream': region_table(
+            chrom, _swap_on_minus(strand, low_start, high_start),
+            _swap_on_minus(strand, low_end, high_end), strand
+        ),
+        'skipped': region_table(chrom, se_start, se_end, strand),
+        'downstream': region_table(
+            chrom, _swap_on_minus(strand, high_start, low_start),
+            _swap_on_minus(strand, high_end, low_end), strand
+        )
+    }
+
+
+def _rmats_flanks(table):
+    """
+    Returns the upstream and downstream exons of rmats SE/RI events, whose
+    upstreamES/EE and downstreamES/EE columns are coord-based.
+    """
+    chrom, strand = table[3], table[4].values
+    low_start, low_end = _ints(table[7]), _ints(table[8])
+    high_start, high_end = _ints(table[9]), _ints(table[10])
+    return (
+        region_table(
+            chrom, _swap_on_minus(strand, low_start, high_start),
+            _swap_on_minus(strand, low_end, high_end), strand
+        ),
+        region_table(
+            chrom, _swap_on_minus(strand, high_start, low_start),
+            _swap_on_minus(strand, high_end, low_end), strand
+        )
+    )
+
+
+def _se_rmats(table, names):
+    upstream, downstream = _rmats_flanks(table)
+    return {
+        'upstream': upstream,
+        'skipped': region_table(
+            table[3], _ints(table[5]), _ints(table[6]), table[4]
+        ),
+        'downstream': downstream
+    }
+
+
+def _se_bed12(table, names):
+    chrom, start, strand = table[0], _ints(table[1]), table[5].values
+    sizes = [_ints(c) for c in _split(table[10], ',', 3)]
+    starts = [_ints(c) + start for c in _split(table[11], ',', 3)]
+    assert np.all(_ints(table[2]) == starts[2] + sizes[2])
+    return {
+        'upstream': region_table(
+            chrom, _swap_on_minus(strand, starts[0], starts[2]),
+            _swap_on_minus(strand, starts[0] + sizes[0], starts[2] + sizes[2]),
+            strand
+        ),
+        'skipped': region_table(chrom, starts[1], starts[1] + sizes[1], strand),
+        'downstream': region_table(
+            chrom, _swap_on_minus(strand, starts[2], starts[0]),
+            _swap_on_minus(strand, starts[2] + sizes[2], starts[0] + sizes[0]),
+            strand
+        )
+    }
+
+
+def _rmats_alt_exons(table):
+    """ long (alt1), short (alt2) and flanking exons of rmats A3SS/A5SS """
+    chrom, strand = table[3], table[4]
+    return (
+        region_table(chrom, _ints(table[5]), _ints(table[6]), strand),
+        region_table(chrom, _ints(table[7]), _ints(table[8]), strand),
+        region_table(chrom, _ints(table[9]), _ints(table[10]), strand)
+    )
+
+
+def _a3ss_miso(table, names):
+    upstream, alt = _split(table[0], '@', 2)
+    chrom, start, end, strand = _split(alt, ':', 4)
+    strand = strand.values
+    start1, start2 = [_ints(c) for c in _split(start, '|', 2)]
+    end = _ints(end)
+    return {
+        'upstream': _miso_region(upstream),
+        'alt1': region_table(  # the longer one
+            chrom, np.where(strand == '+', start1, end) - 1,
+            np.where(strand == '+', end, start2), strand
+        ),
+        'alt2': region_table(  # the shorter one
+            chrom, np.where(strand == '+', start2, end) - 1,
+            np.where(strand == '+', end, start1), strand
+        )
+    }
+
+
+def _a3ss_rmats(table, names):
+    alt1, alt2, flanking = _rmats_alt_exons(table)
+    return {'upstream': flanking, 'alt1': alt1, 'alt2': alt2}
+
+
+def _eric_exon(column, chrom, strand):
+    start, end = _split(column, '-', 2)
+    return region_table(chrom, _ints(start), _ints(end), strand)
+
+
+def _a3ss_eric(table, names):
+    chrom, strand, _, _, _ = _split(table[0], '|', 5)
+    return {
+        'upstream': _eric_exon(table[1], chrom, strand),
+        'alt1': _eric_exon(table[2], chrom, strand),
+        'alt2': _eric_exon(table[3], chrom, strand)
+    }
+
+
+def _a5ss_miso(table, names):
+    alt, downstream = _split(table[0], '@', 2)
+    chrom, start, end, strand = _split(alt, ':', 4)
+    strand = strand.values
+    end1, end2 = [_ints(c) for c in _split(end, '|', 2)]
+    start = _ints(start)
+    plus = strand == '+'
+    return {
+        'alt1': region_table(
+            chrom, np.where(plus, start, end2) - 1,
+            np.where(plus, end1, start), strand
+        ),
+        'alt2': region_table(  # middle
+            chrom, np.where(plus, start, end1) - 1,
+            np.where(plus, end2, start), strand
+        ),
+        'downstream': _miso_region(downstream)
+    }
+
+
+def _a5ss_rmats(table, names):
+    alt1, alt2, flanking = _rmats_alt_exons(table)
+    return {'alt1': alt1, 'alt2': alt2, 'downstream': flanking}
+
+
+def _a5ss_eric(table, names):
+    chrom, strand, _, _, _ = _split(table[0], '|', 5)
+    return {
+        'alt1': _eric_exon(table[2], chrom, strand),
+        'alt2': _eric_exon(table[1], chrom, strand),
+        'downstream': _eric_exon(table[3], chrom, strand)
+    }
+
+
+def _ri_xintao(table, names):
+    _, chrom, first, middle, last, strand = _split(
+        pd.Series(names), ':', 6
+    )
+    strand = strand.values
+    middle_end, middle_start = [_ints(c) for c in _split(middle, '-', 2)]
+    first, last = _ints(first), _ints(last)
+    if not np.all((strand == '+') | (strand == '-')):
+        print("invalid strand information, defaulting to +")
+    minus = strand == '-'
+    return {
+        'upstream': region_table(
+            chrom, np.where(minus, middle_start, first),
+            np.where(minus, last, middle_end), strand
+        ),
+        'downstream': region_table(
+            chrom, np.where(minus, first, middle_start),
+            np.where(minus, middle_end, last), strand
+        )
+    }
+
+
+def _ri_eric(table, names):
+    chrom, strand, low, high = _split(pd.Series(names), '|', 4)
+    strand = strand.values
+    if not np.all((strand == '+') | (strand == '-')):
+        raise ValueError("strand not correct")
+    low_start, low_end = [
+        _ints(c) for c in _split(_split(low, ':', 3)[2], '-', 2)
+    ]
+    high_start, high_end = [
+        _ints(c) for c in _split(_split(high, ':', 2)[0], '-', 2)
+    ]
+    return {
+        'upstream': region_table(
+            chrom, _swap_on_minus(strand, low_start, high_start),
+            _swap_on_minus(strand, low_end, high_end), strand
+        ),
+        'downstream': region_table(
+            chrom, _swap_on_minus(strand, high_start, low_start),
+            _swap_on_minus(strand, high_end, low_end), strand
+        )
+    }
+
+
+def _ri_rmats(table, names):
+    upstream, downstream = _rmats_flanks(table)
+    return {'upstream': upstream, 'downstream': downstream}
+
+
+def _ri_twobed(table, names):
+    lower = region_table(
+        table[0], _ints(table[1]), _ints(table[2]), table[5]
+    )
+    upper = region_table(
+        table[6], _ints(table[7]), _ints(table[8]), table[11]
+    )
+    plus = (lower['strand'] == '+') & (upper['strand'] == '+')
+    minus = (lower['strand'] == '-') & (upper['strand'] == '-')
+    if not np.all(plus | minus):
+        raise ValueError("strand not correct")
+    return {
+        'upstream': lower.where(plus, upper).astype(lower.dtypes),
+        'downstream': upper.where(plus, lower).astype(lower.dtypes)
+    }
+
+
+def _mxe_rmats(table, names):
+    chrom, strand = table[3], table[4].values
+    first = [_ints(table[5]), _ints(table[6])]
+    second = [_ints(table[7]), _ints(table[8])]
+    low = [_ints(table[9]), _ints(table[10])]
+    high = [_ints(table[11]), _ints(table[12])]
+
+    def region(plus, minus):
+        # upstream/downstream is flipped for rmats (-) events
+        return region_table(
+            chrom, _swap_on_minus(strand, plus[0], minus[0]),
+            _swap_on_minus(strand, plus[1], minus[1]), strand
+        )
+    return {
+        'upstream': region(low, high),
+        'up_mxe': region(first, second),
+        'down_mxe': region(second, first),
+        'downstream': region(high, low)
+    }
+
+
+def _bed(table, names):
+    return {'region': region_table(
+        table[0], _ints(table[1]), _ints(table[2]), table[5]
+    )}
+
+
+_PARSERS = {
+    ('se', 'miso'): _se_miso,
+    ('se', 'eric'): _se_eric,
+    ('se', 'tab'): _se_eric,
+    ('se', 'rmats'): _se_rmats,
+    ('se', 'bed12'): _se_bed12,
+    ('a3ss', 'miso'): _a3ss_miso,
+    ('a3ss', 'rmats'): _a3ss_rmats,
+    ('a3ss', 'eric'): _a3ss_eric,
+    ('a3ss', 'tab'): _a3ss_eric,
+    ('a5ss', 'miso'): _a5ss_miso,
+    ('a5ss', 'rmats'): _a5ss_rmats,
+    ('a5ss', 'eric'): _a5ss_eric,
+    ('a5ss', 'tab'): _a5ss_eric,
+    ('ri', 'xintao'): _ri_xintao,
+    ('ri', 'eric'): _ri_eric,
+    ('ri', 'tab'): _ri_eric,
+    ('ri', 'rmats'): _ri_rmats,
+    ('ri', 'twobed'): _ri_twobed,
+    ('ri', '2bed'): _ri_twobed,
+    ('mxe', 'rmats'): _mxe_rmats,
+    ('bed', 'bed'): _bed,
+}
+
+_FEATURES = {
+    'se': Feature.Skipped_exon,
+    'a3ss': Feature.Alt_3p_splice_site,
+    'a5ss': Feature.Alt_5p_splice_site,
+    'ri': Feature.Retained_intron,
+    'mxe': Feature.Mutually_exclusive_exon,
+}
@@ -304,10 +304,6 @@ def get_scale(wiggle, scale_to=100):
     -------
         Series of values that is scale (length is always 100).
     """
-
-    # Need to adjust series such that it has at least 100 parts.
-    # Required since stepper will iterate from 0.01..1 and x will
-    # iterate from 0..99.
     if len(wiggle) == scale_to:  # no need to do any calculating.
         return wiggle
     elif len(wiggle) == 1:  # return 100/n of these values
@@ -318,45 +314,154 @@ def get_scale(wiggle, scale_to=100):
                 )
             )
         )
-    elif len(wiggle) < scale_to:  # multiply everything by scaling factor, this guarantees it is divisible by scaling factor
-        wiggle = pd.Series(
-            list(
-                itertools.chain.from_iterable(
-                    [multiply_by_x(w, x=scale_to) for w in wiggle]
-                )
-            )
-        )
+    return pd.Series(get_scales([wiggle], scale_to=scale_to)[0])
 
-    dist = [0] * scale_to  # final series length
-    x = 0  # iterate through dist list
-    step = 1 / float(scale_to)  # stepper, increments increase by this number
-    y = 0  # number of values in each stepwise bin
-
-    # iterate through each value until it reaches next step, then averages
-    # (step = 1% -> 2%, or 2% -> 3%, etc. if we are trying to scale to 100%)
-    for pos, value in enumerate(wiggle):
-        if (float(pos + 1) / len(wiggle)) < step:  # if we haven't reached the next step, add value to bin (dist[x])
-            # print("{} < {}, dist[{}] = {}".format((float(pos + 1) / len(wiggle)), step, x, value))
-            y = y + 1
-            dist[x] = dist[x] + value
-        elif (float(pos + 1) / len(wiggle) == 1):  # if we have reached the last step, break loop
-            y = y + 1
-            dist[x] = dist[x] + value
-            break
-        else:  # if we have passed the next step, divide total value in dist[x] by y (number of values) to get average of bin, then move on (iterate x)
-            dist[x] = dist[x] / float(y)
-            step = step + 1 / float(scale_to)
-            x = x + 1
-            dist[x] = value
-            y = 1
-
-    try:
-        dist[x] = dist[x] / float(y)
-    except ZeroDivisionError as e:
-        print("Got zero series, won't scale.", e, wiggle)
-    except IndexError as e:
-        pass
-    return pd.Series(dist)
+
+def _first_position_reaching(steps, lengths):
+    """
+    For every (float) step and every wiggle length n, returns the first
+    0-based position p such that float(p + 1) / n >= step. This is where
+    get_scale() moves on to the next bin.
+
+    Parameters
+    ----------
+    steps : numpy.array
+        (k) ascending step thresholds
+    lengths : numpy.array
+        (r) wiggle lengths
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        (r x k) matrix of positions
+    """
+    n = lengths.astype(np.float64)[:, np.newaxis]
+    positions = np.ceil(steps[np.newaxis, :] * n).astype(np.int64) - 1
+    positions = np.maximum(positions, 0)
+    # ceil() may be off by one from the float division; nudge it back.
+    for _ in range(2):
+        positions += (positions + 1) / n < steps
+    for _ in range(2):
+        positions -= (positions >= 1) & (positions / n >= steps)
+    return positions
+
+
+def _segment_sums(values, starts, counts):
+    """
+    Sums each segment (values[starts[i]:starts[i] + counts[i]]) adding
+    one value at a time, left to right. Unlike np.add.reduceat (which sums
+    pairwise), this gives the exact same float result as a python loop.
+    All segments are summed together, position by position, longest first.
+
+    Parameters
+    ----------
+    values : numpy.array
+    starts : numpy.array
+        start of each (non-empty) segment
+    counts : numpy.array
+        length of each segment
+
+    Returns
+    -------
+    sums : numpy.array
+    """
+    order = np.argsort(-counts, kind='mergesort')
+    starts = starts[order]
+    # number of segments that are longer than j, for each position j
+    active = np.searchsorted(-counts[order], -np.arange(counts.max()),
+                             side='left')
+    sums = values[starts].astype(np.float64)
+    for j in range(1, len(active)):
+        k = active[j]
+        sums[:k] += values[starts[:k] + j]
+    unsorted = np.empty(len(sums))
+    unsorted[order] = sums
+    return unsorted
+
+
+def get_scales(wiggles, lengths=None, scale_to=100):
+    """
+    Scales a batch of (different length) wiggles to scale_to bins each,
+    in one pass. Every row is identical to get_scale() of that wiggle:
+    positions are assigned to bins wherever their cumulative fraction of
+    the wiggle crosses the next (1/scale_to) step, and each bin is the
+    mean of its positions. Wiggles shorter than scale_to are first
+    stretched by repeating each value scale_to times.
+
+    Parameters
+    ----------
+    wiggles : list or numpy.ndarray
+        list of 1D wiggles, or a (r x c) matrix whose rows are left-aligned
+        wiggles (see: lengths)
+    lengths : numpy.array
+        if wiggles is a matrix, the length of each row's wiggle
+        (default: every row is c long)
+    scale_to : int
+        number of bins to scale each wiggle to
+
+    Returns
+    -------
+    scaled : numpy.ndarray
+        (r x scale_to) matrix of scaled wiggles
+    """
+    if lengths is None:
+        wiggles = [np.asarray(wiggle, dtype=np.float64) for wiggle in wiggles]
+        lengths = np.array([len(wiggle) for wiggle in wiggles], dtype=np.int64)
+    else:
+        wiggles = np.asarray(wiggles, dtype=np.float64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        wiggles = [wiggles[i, :lengths[i]] for i in range(len(lengths))]
+    scaled = np.zeros((len(lengths), scale_to))
+
+    as_is = np.where(lengths == scale_to)[0]
+    for row in as_is:
+        scaled[row] = wiggles[row]
+    repeated = np.where(lengths == 1)[0]
+    for row in repeated:
+        scaled[row] = wiggles[row][0]
+    for row in np.where(lengths == 0)[0]:
+        print("Got zero series, won't scale.", wiggles[row])
+
+    rows = np.where(
+        (lengths != scale_to) & (lengths != 1) & (lengths != 0)
+    )[0]
+    if len(rows) == 0:
+        return scaled
+
+    # stretch short wiggles so they have at least scale_to positions.
+    values = []
+    for row in rows:
+        if lengths[row] < scale_to:
+            values.append(np.repeat(wiggles[row], scale_to))
+        else:
+            values.append(wiggles[row])
+    n = np.array([len(v) for v in values], dtype=np.int64)
+
+    # steps (1/scale_to, 2/scale_to, ...) accumulated the same way as
+    # get_scale() does, so that float rounding is identical.
+    steps = np.cumsum(np.repeat(1 / float(scale_to), scale_to - 1))
+    # position that would start each bin after the first, and make sure
+    # every bin gets at least one position (bins only move on one at a time)
+    bin_starts = np.zeros((len(rows), scale_to), dtype=np.int64)
+    bin_starts[:, 1:] = _first_position_reaching(steps, n) - \
+        np.arange(1, scale_to)
+    bin_starts = np.maximum.accumulate(bin_starts, axis=1) + \
+        np.arange(scale_to)
+    # the last position is always added to the current bin, so bins that
+    # would start there (or beyond) are never filled.
+    filled = np.ones((len(rows), scale_to), dtype=bool)
+    filled[:, 1:] = bin_starts[:, 1:] < (n - 1)[:, np.newaxis]
+
+    row_offsets = np.cumsum(n) - n
+    edges = (bin_starts + row_offsets[:, np.newaxis])[filled]
+    flat = np.concatenate(values)
+    counts = np.diff(np.append(edges, len(flat)))
+    sums = _segment_sums(flat, edges, counts)
+
+    means = np.zeros((len(rows), scale_to))
+    means[filled] = sums / counts.astype(np.float64)
+    scaled[rows] = means
+    return scaled
 
 
 def flip_strand(strand):
@@ -615,6 +720,43 @@ def _junction_site(rbp, next_interval, current_interval, exon_offset,
     right_pad : int
         The downstream padding (+) or upstream padding (-)
     """
+    left_pad, start, end, right_pad = _junction_site_coords(
+        next_interval, current_interval, exon_offset, intron_offset,
+        exon_junction_site, stop_at_midpoint
+    )
+    wiggle = rbp.values(
+        current_interval.chrom, start, end, current_interval.strand
+    )
+    return left_pad, wiggle, right_pad
+
+
+def _junction_site_coords(next_interval, current_interval, exon_offset,
+                          intron_offset, exon_junction_site,
+                          stop_at_midpoint=False):
+    """
+    Returns the genomic window and padding that _junction_site() would
+    fetch, without fetching anything.
+
+    Parameters
+    ----------
+    next_interval : pybedtools.BedTool.Interval
+    current_interval : pybedtools.BedTool.Interval
+    exon_offset : int
+    intron_offset : int
+    exon_junction_site : str
+        '3p' or '5p' depending on the orientation of the exon/intron junction.
+
+    Returns
+    -------
+    left_pad : int
+        The upstream padding (+) or downstream padding (-)
+    start : int
+        absolute genomic start of the window
+    end : int
+        absolute genomic end of the window
+    right_pad : int
+        The downstream padding (+) or upstream padding (-)
+    """
     anchor, upper_boundary, upper_offset, lower_boundary, lower_offset = \
         _get_boundaries(
             next_interval, current_interval, exon_offset, intron_offset,
@@ -624,16 +766,88 @@ def _junction_site(rbp, next_interval, current_interval, exon_offset,
     left_pad, start, end, right_pad = _get_absolute_coords_and_pad(
         anchor, upper_boundary, upper_offset, lower_boundary, lower_offset
     )
-    wiggle = rbp.values(
-        current_interval.chrom, start, end, current_interval.strand
-    )
     if current_interval.strand == '+':
-        return left_pad, wiggle, right_pad
+        return left_pad, start, end, right_pad
     else:
-        return right_pad, wiggle, left_pad
+        return right_pad, start, end, left_pad
 
 
-def _clean_and_add_padding(wiggle, left_pad=0, right_pad=0, fill_pads_with=-1):
+def _junction_sites_coords(next_intervals, current_intervals, exon_offset,
+                           intron_offset, exon_junction_site,
+                           stop_at_midpoint=False):
+    """
+    Batch version of _junction_site_coords(): computes the genomic window
+    and padding of every interval at once with array operations, following
+    the same boundaries as _get_boundaries(), _get_lower_boundary(),
+    _get_upper_boundary() and _get_absolute_coords_and_pad().
+
+    Parameters
+    ----------
+    next_intervals : list
+        list of pybedtools.BedTool.Interval (or None) neighboring intervals,
+        or a region table (see: annotations.region_table), or None if no
+        interval has a neighbor.
+    current_intervals : list
+        list of pybedtools.BedTool.Interval or a region table
+    exon_offset : int
+    intron_offset : int
+    exon_junction_site : str
+        '3p' or '5p' depending on the orientation of the exon/intron junction.
+    stop_at_midpoint : Boolean
+        True if we want to stop at the middle of the exon rather than the end.
+
+    Returns
+    -------
+    left_pad : numpy.array
+        The upstream padding (+) or downstream padding (-) of each interval
+    start : numpy.array
+        absolute genomic start of each window
+    end : numpy.array
+        absolute genomic end of each window
+    right_pad : numpy.array
+        The downstream padding (+) or upstream padding (-) of each interval
+    """
+    n = len(current_intervals)
+    _, starts, ends, strands = _interval_columns(current_intervals)
+    next_starts, next_ends, has_next = _neighbor_columns(next_intervals, n)
+    starts = starts.astype(np.int64)
+    ends = ends.astype(np.int64)
+    plus = strands == '+'
+    if not np.all(plus | (strands == '-')):
+        print("strand neither + or -")
+
+    # strand_or_5p is '+' for (+) 3p sites and (-) 5p sites (flip_strand()
+    # doesn't give '+' for anything but '-', so other strands act as '-')
+    if exon_junction_site == '5p':
+        strand_or_5p = strands == '-'
+    else:
+        strand_or_5p = plus
+    if stop_at_midpoint:
+        midpoints = (ends + starts) // 2
+        lower_exon, upper_exon = midpoints, midpoints
+    else:
+        lower_exon, upper_exon = starts, ends
+
+    anchor = np.where(strand_or_5p, ends, starts)
+    upper_offset = np.where(strand_or_5p, intron_offset, exon_offset)
+    lower_offset = np.where(strand_or_5p, exon_offset, intron_offset)
+    lower_boundary = np.where(
+        strand_or_5p, lower_exon, np.where(has_next, next_ends, 0)
+    )
+    upper_boundary = np.where(
+        strand_or_5p, np.where(has_next, next_starts, MAX), upper_exon
+    )
+
+    left_pad = np.maximum(lower_boundary - (anchor - lower_offset), 0)
+    right_pad = np.maximum((anchor + upper_offset) - upper_boundary, 0)
+    start = anchor - lower_offset + left_pad
+    end = anchor + upper_offset - right_pad
+    return (np.where(plus, left_pad, right_pad), start, end,
+            np.where(plus, right_pad, left_pad))
+
+
+def _clean_and_add_padding(wiggle, left_pad=0, right_pad=0, fill_pads_with=-1,
+                           out=None):
     """
     Removes nans from a list (replaces with 0), and appends padding to ensure
     that the list will always be of length len(wiggle) + left_pad + right_pad.
@@ -648,24 +862,28 @@ def _clean_and_add_padding(wiggle, left_pad=0, right_pad=0, fill_pads_with=-1):
         length of padding to add to the right (> wiggle[len(wiggle)-1]) of list
     fill_pads_with : int
         fill missing flank regions with this number (CANNOT BE NAN)
+    out : numpy.ndarray
+        array (ie. a row or slice of a matrix) of length
+        len(wiggle) + left_pad + right_pad to write into, rather than
+        allocating a new one.
 
     Returns
     -------
-    wiggle: pandas.Series
-        series of values of a fixed length
+    wiggle: numpy.ndarray
+        array of values of a fixed length
         (length of wiggle + left_pad + right_pad)
         with flanked ends padded with fill_pads_with
     """
-    wiggle = pd.Series(wiggle)
-    wiggle = abs(wiggle)
-    wiggle = np.pad(
-        wiggle,
-        (left_pad, right_pad),
-        'constant',
-        constant_values=fill_pads_with
-    )
-    wiggle = np.nan_to_num(wiggle)
-    return wiggle
+    if left_pad < 0 or right_pad < 0:
+        raise ValueError("index can't contain negative values")
+    wiggle = np.asarray(wiggle, dtype=np.float64)
+    end = left_pad + wiggle.shape[0]
+    if out is None:
+        out = np.empty(end + right_pad)
+    out[:left_pad] = fill_pads_with
+    np.abs(wiggle, out=out[left_pad:end])
+    out[end:] = fill_pads_with
+    return np.nan_to_num(out, copy=False)
 
 
 def five_prime_site(rbp, upstream_interval, interval, exon_offset,
@@ -779,6 +997,370 @@ def generic_site(rbp, interval, upstream_offset=0, downstream_offset=0, fill_pad
     return _clean_and_add_padding(wiggle, 0, 0, fill_pads_with)
 
 
+def _clean_batch(wiggles, offsets, lengths, fill_pads_with=-1):
+    """
+    Batch version of _clean_and_add_padding(). Takes the absolute value of
+    every fetched position and replaces nans with 0. Pads (positions
+    outside of [offset, offset + length) for each row) should already
+    contain fill_pads_with.
+
+    Parameters
+    ----------
+    wiggles : numpy.ndarray
+        (n x width) matrix of values
+    offsets : numpy.array
+        column at which each row's fetched values begin
+    lengths : numpy.array
+        number of fetched values in each row
+    fill_pads_with : int
+        number the pads were filled with (CANNOT BE NAN)
+
+    Returns
+    -------
+    wiggles : numpy.ndarray
+        the same matrix, cleaned in place.
+    """
+    columns = np.arange(wiggles.shape[1])
+    pads = (columns < offsets[:, np.newaxis]) | \
+           (columns >= (offsets + lengths)[:, np.newaxis])
+    np.abs(wiggles, out=wiggles)
+    np.putmask(wiggles, pads, fill_pads_with)
+    return np.nan_to_num(wiggles, copy=False)
+
+
+class Windows:
+    """
+    The genomic windows behind a block of matrix columns, one window per
+    row: everything in a row outside of [offset, offset + window length)
+    is padding. Computing windows is separate from reading them, so that
+    the same windows can be fetched from several densities (ie. the ip and
+    input of a map).
+
+    Attributes:
+        self.chroms, self.starts, self.ends, self.strands (window of each row)
+        self.offsets (column at which each row's values begin)
+        self.width (number of columns)
+        self.unread (value positions that can't be read start as, ie. on a
+            chromosome missing from the density. None for the pad value)
+    """
+
+    def __init__(self, chroms, starts, ends, strands, offsets, width,
+                 unread=None):
+        self.chroms = chroms
+        self.starts = starts
+        self.ends = ends
+        self.strands = strands
+        self.offsets = offsets
+        self.width = width
+        self.unread = unread
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lengths(self):
+        """
+        Returns the number of fetched values in each row.
+        """
+        return np.maximum(self.ends - self.starts, 0)
+
+    def count_events(self):
+        """
+        Returns the number of rows that fetch() gives a value (rather than
+        a pad) at each column, from the windows alone. Windows that can't
+        be read are cleaned to 0, so they still count.
+
+        Returns
+        -------
+        num_events : numpy.ndarray
+            int32 number of rows at each of self.width columns
+        """
+        lengths = self.lengths()
+        offsets = np.asarray(self.offsets, dtype=np.int64)[lengths > 0]
+        starts = np.minimum(offsets, self.width)
+        ends = np.minimum(offsets + lengths[lengths > 0], self.width)
+        changes = np.bincount(starts, minlength=self.width + 1) - \
+            np.bincount(ends, minlength=self.width + 1)
+        return np.cumsum(changes[:self.width]).astype(np.int32)
+
+    def fetch(self, rbp, out=None, fill_pads_with=-1, dtype=np.float64):
+        """
+        Reads every window from rbp (with rbp.values_batch()) and cleans
+        the rows like _clean_and_add_padding() does.
+
+        Parameters
+        ----------
+        rbp : density.ReadDensity
+        out : numpy.ndarray
+            (n windows x self.width) matrix (or a slice of one) to write
+            into. If None, a new dtype matrix is returned.
+        fill_pads_with : int
+            fill missing flank regions with this number (CANNOT BE NAN)
+        dtype : numpy.dtype
+            type of the returned matrix (if out is None)
+
+        Returns
+        -------
+        wiggles : numpy.ndarray
+            (n windows x self.width) matrix
+        """
+        if out is None:
+            out = np.empty((len(self), self.width), dtype=dtype)
+        out.fill(fill_pads_with if self.unread is None else self.unread)
+        rbp.values_batch(
+            self.chroms, self.starts, self.ends, self.strands,
+            out=out, offsets=self.offsets
+        )
+        return _clean_batch(out, self.offsets, self.lengths(), fill_pads_with)
+
+
+def _neighbor_columns(intervals, n):
+    """
+    Returns the start and end of each of n neighboring intervals as arrays,
+    and whether each interval has a neighbor at all, given either a list of
+    pybedtools.BedTool.Interval (or None), a region table (see:
+    annotations.region_table) or None (no neighbors at all).
+    """
+    if intervals is None:
+        return (np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64),
+                np.zeros(n, dtype=bool))
+    if isinstance(intervals, pd.DataFrame):
+        return (intervals['start'].values, intervals['end'].values,
+                np.ones(n, dtype=bool))
+    found = np.array([interval is not None for interval in intervals],
+                     dtype=bool)
+    return (
+        np.array([interval.start if interval is not None else 0
+                  for interval in intervals], dtype=np.int64),
+        np.array([interval.end if interval is not None else 0
+                  for interval in intervals], dtype=np.int64),
+        found
+    )
+
+
+def _interval_columns(intervals):
+    """
+    Returns the chrom, start, end and strand of each interval as arrays,
+    given either a list of pybedtools.BedTool.Interval or a region table
+    (see: annotations.region_table).
+    """
+    if isinstance(intervals, pd.DataFrame):
+        return (intervals['chrom'].values, intervals['start'].values,
+                intervals['end'].values, intervals['strand'].values)
+    return (
+        np.array([interval.chrom for interval in intervals], dtype=object),
+        np.array([interval.start for interval in intervals], dtype=np.int64),
+        np.array([interval.end for interval in intervals], dtype=np.int64),
+        np.array([interval.strand for interval in intervals], dtype=object)
+    )
+
+
+def _junction_sites(rbp, next_intervals, current_intervals, exon_offset,
+                    intron_offset, exon_junction_site, stop_at_midpoint=False,
+                    fill_pads_with=-1, out=None):
+    """
+    Batch version of _junction_site() + _clean_and_add_padding().
+    Computes every window first, then fetches all of them with
+    rbp.values_batch() instead of one rbp.values() call per interval.
+
+    Parameters
+    ----------
+    rbp : density.ReadDensity
+    next_intervals : list
+        list of pybedtools.BedTool.Interval (or None) neighboring intervals,
+        or a region table (see: annotations.region_table), or None if no
+        interval has a neighbor.
+    current_intervals : list
+        list of pybedtools.BedTool.Interval or a region table
+    exon_offset : int
+    intron_offset : int
+    exon_junction_site : str
+        '3p' or '5p' depending on the orientation of the exon/intron junction.
+    stop_at_midpoint : Boolean
+        True if we want to stop at the middle of the exon rather than the end.
+    fill_pads_with : int
+        fill missing flank regions with this number (CANNOT BE NAN)
+    out : numpy.ndarray
+        (n intervals x exon_offset + intron_offset) matrix (or a slice of
+        one) to write into. If None, a new float matrix is returned.
+
+    Returns
+    -------
+    wiggles : numpy.ndarray
+        (n intervals x exon_offset + intron_offset) matrix
+    """
+    return _junction_site_windows(
+        next_intervals, current_intervals, exon_offset, intron_offset,
+        exon_junction_site, stop_at_midpoint
+    ).fetch(rbp, out, fill_pads_with)
+
+
+def _junction_site_windows(next_intervals, current_intervals, exon_offset,
+                           intron_offset, exon_junction_site,
+                           stop_at_midpoint=False):
+    """
+    Returns the Windows (exon_offset + intron_offset columns wide) that
+    _junction_sites() fetches. See: _junction_sites_coords()
+    """
+    chroms, _, _, strands = _interval_columns(current_intervals)
+    offsets, starts, ends, _ = _junction_sites_coords(
+        next_intervals, current_intervals, exon_offset, intron_offset,
+        exon_junction_site, stop_at_midpoint
+    )
+    return Windows(
+        chroms, starts, ends, strands, offsets, exon_offset + intron_offset
+    )
+
+
+def five_prime_windows(upstream_intervals, intervals, exon_offset,
+                       intron_offset, stop_at_midpoint=False):
+    """
+    Returns the Windows that five_prime_sites() fetches, so that they can
+    be fetched from any number of densities (see: Windows.fetch()).
+    """
+    return _junction_site_windows(
+        upstream_intervals, intervals, exon_offset, intron_offset, '5p',
+        stop_at_midpoint
+    )
+
+
+def three_prime_windows(downstream_intervals, intervals, exon_offset,
+                        intron_offset, stop_at_midpoint=False):
+    """
+    Returns the Windows that three_prime_sites() fetches, so that they can
+    be fetched from any number of densities (see: Windows.fetch()).
+    """
+    return _junction_site_windows(
+        downstream_intervals, intervals, exon_offset, intron_offset, '3p',
+        stop_at_midpoint
+    )
+
+
+def five_prime_sites(rbp, upstream_intervals, intervals, exon_offset,
+                     intron_offset, stop_at_midpoint=False, fill_pads_with=-1,
+                     out=None):
+    """
+    Batch version of five_prime_site(): returns one row for each interval.
+
+    Parameters
+    ----------
+    rbp : density.ReadDensity
+        Object containing density values
+    upstream_intervals : list
+        pybedtools.BedTool.Interval (or None) neighboring intervals
+    intervals : list
+        pybedtools.BedTool.Interval containing our regions of interest.
+    exon_offset : int
+        Number of bases into the exon to return
+    intron_offset : int
+        Number of bases into the intron to return
+    stop_at_midpoint : Boolean
+        True if we want to stop at the middle of the exon rather than the end.
+
+    out : numpy.ndarray
+        matrix (or slice of one) to write the rows into (see: _junction_sites)
+
+    Returns
+    -------
+    wiggles : numpy.ndarray
+        (n intervals x exon_offset + intron_offset) matrix describing
+        the 5p exon-intron site of each interval.
+    """
+    return _junction_sites(
+        rbp, upstream_intervals, intervals, exon_offset, intron_offset,
+        '5p', stop_at_midpoint, fill_pads_with, out
+    )
+
+
+def three_prime_sites(rbp, downstream_intervals, intervals, exon_offset,
+                      intron_offset, stop_at_midpoint=False, fill_pads_with=-1,
+                      out=None):
+    """
+    Batch version of three_prime_site(): returns one row for each interval.
+
+    Parameters
+    ----------
+    rbp : density.ReadDensity
+        Object containing density values
+    downstream_intervals : list
+        pybedtools.BedTool.Interval (or None) neighboring intervals
+    intervals : list
+        pybedtools.BedTool.Interval containing our regions of interest.
+    exon_offset : int
+        Number of bases into the exon to return
+    intron_offset : int
+        Number of bases into the intron to return
+    stop_at_midpoint : Boolean
+        True if we want to stop at the middle of the exon rather than the end.
+
+    out : numpy.ndarray
+        matrix (or slice of one) to write the rows into (see: _junction_sites)
+
+    Returns
+    -------
+    wiggles : numpy.ndarray
+        (n intervals x exon_offset + intron_offset) matrix describing
+        the 3p exon-intron site of each interval.
+    """
+    return _junction_sites(
+        rbp, downstream_intervals, intervals, exon_offset, intron_offset,
+        '3p', stop_at_midpoint, fill_pads_with, out
+    )
+
+
+def generic_sites(rbp, intervals, upstream_offset=0, downstream_offset=0,
+                  fill_pads_with=-1, dtype=np.float64):
+    """
+    Batch version of generic_site(). Since intervals may be of different
+    lengths, rows are left-aligned and the length of each is also returned.
+
+    Parameters
+    ----------
+    rbp : density.ReadDensity
+        Object containing positive and negative density *.bw for a given rbp
+    intervals : list
+        pybedtools.cbedtools.Interval (or a region table, see:
+        annotations.region_table) describing the intervals to get density
+        values for.
+    upstream_offset : int
+        Number representing the number of bases left of the interval to get.
+    downstream_offset : int
+        Number representing the number of bases right of the interval to get.
+    dtype : numpy.dtype
+        type of the returned matrix
+
+    Returns
+    -------
+    wiggles : numpy.ndarray
+        (n intervals x longest window) matrix of densities.
+    lengths : numpy.array
+        number of valid positions in each row of wiggles.
+    """
+    windows = generic_windows(intervals, upstream_offset, downstream_offset)
+    return (windows.fetch(rbp, fill_pads_with=fill_pads_with, dtype=dtype),
+            windows.lengths())
+
+
+def generic_windows(intervals, upstream_offset=0, downstream_offset=0):
+    """
+    Returns the (left-aligned) Windows that generic_sites() fetches, so
+    that they can be fetched from any number of densities
+    (see: Windows.fetch()).
+    """
+    n = len(intervals)
+    chroms, starts, ends, strands = _interval_columns(intervals)
+    plus = strands == "+"
+    if not np.all(plus | (strands == "-")):
+        print "Strand not correct", strands[~plus & (strands != "-")][0]
+        raise ValueError("Strand not correct")
+    starts = starts - np.where(plus, upstream_offset, downstream_offset)
+    ends = ends + np.where(plus, downstream_offset, upstream_offset)
+    lengths = np.maximum(ends - starts, 0)
+    return Windows(
+        chroms, starts, ends, strands, np.zeros(n, dtype=np.int64),
+        lengths.max() if n > 0 else 0, unread=np.nan
+    )
+
+
 def get_overlap(peak, region, score_type='simple'):
     """
     Returns the score of a region with peak overlaps as a series.
@@ -26,11 +26,508 @@ import sys
 import numpy as np
 import pandas as pd
 import Feature
+import annotations
 import intervals
 from tqdm import trange
 import tqdm
 tqdm.monitor_interval = 0  # workaround for issue 481
 
+EVENT_COLUMNS = ['chrom', 'start', 'end', 'strand', 'name']
+MATRIX_DTYPE = np.float32  # densities are float32 in bigwigs
+COUNT_ROWS = 4096  # rows compared at a time by count_events()
+INTERMEDIATE_EXTENSION = '.npz'
+DEFAULT_INTERMEDIATE = 'normed_matrix'  # matrix read from an .npz by default
+
+
+def read_events(annotation):
+    """
+    Returns each unique event (line) in an annotation file, in the order
+    they appear. Assumes headers start with 'event_name', 'ID'
+    or 'annotation'.
+
+    Parameters
+    ----------
+    annotation : basestring or list
+        filename of the annotation file to use, or a list of events that
+        have already been read (ie. one chunk of a file), which is
+        returned as-is.
+
+    Returns
+    -------
+    events : list
+        list of stripped lines, one per event
+    """
+    if isinstance(annotation, list):
+        return annotation
+    events = []
+    seen = set()
+    with open(annotation) as f:
+        for line in f:
+            if not line.startswith('event_name') and not \
+                    line.startswith('ID') and not \
+                    line.startswith('annotation'):  # assume there is a header
+                event = line.rstrip()
+                if event not in seen:
+                    seen.add(event)
+                    events.append(event)
+    return events
+
+
+def event_table(names, chroms, starts, ends, strands):
+    """
+    Returns a table describing each event of a matrix. Matrices are indexed
+    by event id (0, 1, 2...), which is the row of this table describing the
+    event; event names (the long strings that used to label each row) are
+    only looked up when writing outputs (see: label_events).
+
+    Parameters
+    ----------
+    names : list
+        name of each event (ie. its annotation line)
+    chroms : list
+    starts : list
+    ends : list
+    strands : list
+        coordinates spanned by each event
+
+    Returns
+    -------
+    events : pandas.DataFrame
+        table of EVENT_COLUMNS, with chrom and strand stored as categories.
+    """
+    return pd.DataFrame({
+        'chrom': pd.Categorical(chroms),
+        'start': np.asarray(starts, dtype=int),
+        'end': np.asarray(ends, dtype=int),
+        'strand': pd.Categorical(strands),
+        'name': names
+    }, columns=EVENT_COLUMNS)
+
+
+def _renumbered(events):
+    """
+    Returns a copy of an event table (ie. a subset or concatenation of
+    tables) whose events are numbered again from 0.
+    """
+    return event_table(
+        events['name'].values, events['chrom'].values,
+        events['start'].values, events['end'].values,
+        events['strand'].values
+    )
+
+
+def _event_spans(names, *regions):
+    """
+    Returns an event table (see: event_table) whose coordinates span
+    every interval that makes up each event.
+
+    Parameters
+    ----------
+    names : list
+        name of each event
+    regions : list
+        region tables (see: annotations.region_table) or lists of
+        pybedtools.Interval, one interval per event for each region
+        (ie. upstream exons, skipped exons, downstream exons)
+    """
+    columns = [intervals._interval_columns(region) for region in regions]
+    return event_table(
+        names,
+        columns[0][0],
+        np.min([c[1] for c in columns], axis=0),
+        np.max([c[2] for c in columns], axis=0),
+        columns[0][3]
+    )
+
+
+def label_events(matrix, events):
+    """
+    Returns a copy of matrix whose rows are labeled by event name rather
+    than event id.
+
+    Parameters
+    ----------
+    matrix : pandas.DataFrame or pandas.Series
+        indexed by event id
+    events : pandas.DataFrame
+        see: event_table
+
+    Returns
+    -------
+    pandas.DataFrame or pandas.Series
+    """
+    labeled = matrix.copy(deep=False)
+    labeled.index = events['name'].values[np.asarray(matrix.index, dtype=int)]
+    return labeled
+
+
+def align_rows(matrix, events, other_events):
+    """
+    Moves the rows of a matrix built for events onto the event ids of
+    other_events (ie. an input matrix onto the rows of its ip matrix), so
+    that row i of both matrices is the same event. Events without a row
+    in matrix are NaN, which the normalizations clean to 0 (no density),
+    as they did when matrices were reindexed by event name.
+
+    Parameters
+    ----------
+    matrix : pandas.DataFrame
+        indexed by event id (of events)
+    events : pandas.DataFrame
+        see: event_table
+    other_events : pandas.DataFrame
+        event table whose event ids the returned matrix is indexed by
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per event of other_events, all NaN for events that aren't
+        in matrix
+    """
+    names = events['name'].values[np.asarray(matrix.index, dtype=int)]
+    other_names = other_events['name'].values
+    if matrix.index.equals(pd.RangeIndex(len(other_names))) and (
+            events is other_events or np.array_equal(names, other_names)
+    ):
+        return matrix
+    rows = pd.Index(names).get_indexer(other_names)
+    present = rows >= 0
+    ra = np.empty(
+        (len(other_names), matrix.shape[1]),
+        dtype=np.promote_types(matrix.values.dtype, MATRIX_DTYPE)
+    )
+    ra.fill(np.nan)
+    ra[present] = matrix.values[rows[present]]
+    return pd.DataFrame(ra, columns=matrix.columns)
+
+
+def count_events(matrix):
+    """
+    Returns the number of events (rows) that have a value at each position
+    (column) of a matrix, ie. that are neither padding (-1, the event's
+    region is shorter than the matrix) nor missing (NaN, ie. events without
+    this region, see: join_regions(), or without input, see: align_rows()).
+
+    This is a separate pass over the matrix (COUNT_ROWS rows at a time).
+    Matrices built by build_with_plan() are counted as they're built
+    instead, so this is only needed for matrices built some other way
+    (ie. the phastcon maps, or PeakLine's normalized background).
+
+    Parameters
+    ----------
+    matrix : pandas.DataFrame
+
+    Returns
+    -------
+    num_events : numpy.ndarray
+        int32 number of events at each position
+    """
+    values = matrix.values
+    num_events = np.zeros(values.shape[1], dtype=np.int32)
+    for start in range(0, values.shape[0], COUNT_ROWS):
+        block = values[start:start + COUNT_ROWS]
+        with np.errstate(invalid='ignore'):
+            valid = block != -1
+        valid &= ~np.isnan(block)
+        num_events += valid.sum(axis=0, dtype=np.int32)
+    return num_events
+
+
+def _savable(values):
+    """
+    Returns values as an array that np.savez can store without pickling
+    (ie. event names and categories as strings).
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def write_intermediates(output_file, matrices, events=None):
+    """
+    Writes matrices (ie. the raw and normalized matrices of one annotation)
+    to one compressed numpy (.npz) file, along with the table of events
+    they're indexed by. Unlike the csv intermediates, event names are only
+    stored once rather than as the row labels of every matrix.
+    See: read_intermediate()
+
+    Parameters
+    ----------
+    output_file : basestring
+        .npz file to write
+    matrices : dict
+        {name: pandas.DataFrame or pandas.Series} of matrices indexed by
+        event id (or by anything else, if events is None)
+    events : pandas.DataFrame
+        see: event_table
+    """
+    arrays = {}
+    if events is not None:
+        for column in EVENT_COLUMNS:
+            arrays['events.' + column] = _savable(events[column])
+    for name, matrix in matrices.items():
+        arrays[name + '.values'] = matrix.values
+        arrays[name + '.index'] = _savable(matrix.index)
+        if isinstance(matrix, pd.DataFrame):
+            arrays[name + '.columns'] = _savable(matrix.columns)
+    np.savez_compressed(output_file, **arrays)
+
+
+def _split_intermediate(filename, name):
+    """
+    Returns the file and matrix name of 'file.npz:name' (or filename and
+    name as-is if no matrix is chosen).
+    """
+    if INTERMEDIATE_EXTENSION + ':' in filename:
+        return filename.rsplit(':', 1)
+    return filename, name
+
+
+def read_intermediate(filename, name=DEFAULT_INTERMEDIATE):
+    """
+    Returns one matrix of an intermediate file, with rows labeled by event
+    name (as they are in the csv intermediates).
+
+    Parameters
+    ----------
+    filename : basestring
+        either a csv intermediate (ie. *.normed_matrix.txt), an .npz file
+        written by write_intermediates(), or 'file.npz:name' to choose
+        which of its matrices to read
+    name : basestring
+        matrix to read from an .npz file (ie. 'ip.raw_density')
+
+    Returns
+    -------
+    pandas.DataFrame or pandas.Series
+    """
+    filename, name = _split_intermediate(filename, name)
+    if not filename.endswith(INTERMEDIATE_EXTENSION):
+        return pd.read_csv(filename, index_col=0)
+    with np.load(filename) as intermediates:
+        if name + '.values' not in intermediates.files:
+            raise ValueError(
+                "{} has no {} matrix".format(filename, name)
+            )
+        values = intermediates[name + '.values']
+        index = intermediates[name + '.index']
+        if 'events.name' in intermediates.files:
+            index = intermediates['events.name'][index]
+        if name + '.columns' not in intermediates.files:
+            return pd.Series(values, index=index)
+        return pd.DataFrame(
+            values, index=index, columns=intermediates[name + '.columns']
+        )
+
+
+def read_intermediate_events(filename):
+    """
+    Returns the table of events stored in an .npz file written by
+    write_intermediates().
+
+    Parameters
+    ----------
+    filename : basestring
+
+    Returns
+    -------
+    events : pandas.DataFrame
+        see: event_table
+    """
+    filename, _ = _split_intermediate(filename, None)
+    with np.load(filename) as intermediates:
+        return event_table(*[
+            intermediates['events.' + column]
+            for column in ['name', 'chrom', 'start', 'end', 'strand']
+        ])
+
+
+def concat_chunks(chunks, scale_to=100):
+    """
+    Joins (row-wise, in order) the matrices that a builder returned for
+    consecutive chunks of the same annotation file.
+
+    same_length_region() scales every row of a chunk once it finds different
+    length features in it, so if the chunks ended up with different widths,
+    the unscaled chunks are scaled too, as they would have been if the
+    whole file had been built at once. Events that repeat an event name from
+    an earlier chunk are dropped, and the rest are given new event ids
+    (in order). The number of events at each position is the sum of the
+    chunks' counts, less the counts of any dropped rows.
+
+    Parameters
+    ----------
+    chunks : list
+        list of (pandas.DataFrame, events, num_events) returned by
+        build_with_plan()
+    scale_to : int
+
+    Returns
+    -------
+    pandas.DataFrame
+    events : pandas.DataFrame
+        see: event_table
+    num_events : numpy.ndarray
+        int32 number of events at each position
+    """
+    matrices = [matrix for matrix, _, _ in chunks]
+    counts = [num_events for _, _, num_events in chunks]
+    if len(set([matrix.shape[1] for matrix in matrices])) > 1:
+        print("found different length features")
+        for i, matrix in enumerate(matrices):
+            if matrix.shape[1] != scale_to:
+                matrices[i] = pd.DataFrame(
+                    intervals.get_scales(matrix.values, scale_to=scale_to)
+                )
+                # scaled rows have a value at every position
+                counts[i] = np.full(
+                    scale_to, matrix.shape[0], dtype=np.int32
+                )
+    ra = pd.concat(matrices, ignore_index=True)
+    num_events = np.sum(counts, axis=0, dtype=np.int32)
+    events = pd.concat(
+        [events for _, events, _ in chunks], ignore_index=True
+    )
+    keep = ~events['name'].duplicated().values
+    if not keep.all():
+        num_events -= count_events(ra[~keep])
+    events = events[keep]
+    ra = ra[keep]
+    ra.index = range(ra.shape[0])
+    return ra, _renumbered(events), num_events
+
+
+def join_regions(regions):
+    """
+    Joins (side by side) the matrices of several regions (ie. the 5' UTR,
+    CDS and 3' UTR of genes) by event name. Like an outer pandas.merge,
+    events missing from a region are NaN across that region's columns, and
+    events are sorted by name. Each event name appears once in a region,
+    so the number of events at each position is just its region's count.
+
+    Parameters
+    ----------
+    regions : list
+        list of (pandas.DataFrame, events, num_events) returned by
+        build_with_plan()
+
+    Returns
+    -------
+    pandas.DataFrame
+    events : pandas.DataFrame
+        see: event_table
+    num_events : numpy.ndarray
+        int32 number of events at each position
+    """
+    events = pd.concat([e for _, e, _ in regions], ignore_index=True)
+    events = events[~events['name'].duplicated().values]
+    events = events.iloc[np.argsort(events['name'].values, kind='mergesort')]
+    names = pd.Index(events['name'].values)
+
+    ra = np.empty((len(names), sum([m.shape[1] for m, _, _ in regions])))
+    ra.fill(np.nan)
+    col = 0
+    for matrix, region_events, _ in regions:
+        rows = names.get_indexer(
+            region_events['name'].values[np.asarray(matrix.index, dtype=int)]
+        )
+        ra[rows, col:col + matrix.shape[1]] = matrix.values
+        col += matrix.shape[1]
+    num_events = np.concatenate(
+        [np.asarray(counts, dtype=np.int32) for _, _, counts in regions]
+    )
+    return pd.DataFrame(ra), _renumbered(events), num_events
+
+
+def _allocate(num_events, widths):
+    """
+    Returns an empty (num_events x sum(widths)) MATRIX_DTYPE matrix, along
+    with a view of the columns of each region (of widths[i] columns), which
+    builders write each region's densities into.
+    """
+    ra = np.empty((num_events, sum(widths)), dtype=MATRIX_DTYPE)
+    bounds = np.cumsum([0] + list(widths))
+    return ra, [
+        ra[:, start:end] for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+class FetchPlan:
+    """
+    The window geometry of a matrix: the intervals.Windows of each block of
+    columns (ie. each junction site of a skipped exon), computed once from
+    an annotation and then fetched from any number of densities (ip, input,
+    replicates, phastcons) with fetch().
+
+    Attributes:
+        self.num_events (number of rows)
+        self.windows (list of intervals.Windows, one per block of columns)
+        self.scale_lengths (if not None, rows are scaled to 100 columns
+            using these lengths after they're fetched, see:
+            intervals.get_scales)
+    """
+
+    def __init__(self, num_events, windows=None, scale_lengths=None):
+        self.num_events = num_events
+        self.windows = [] if windows is None else windows
+        self.scale_lengths = scale_lengths
+
+    def add(self, windows):
+        """
+        Appends a block of columns (intervals.Windows) to the plan.
+        """
+        self.windows.append(windows)
+
+    def count_events(self):
+        """
+        Returns the number of events that fetch() gives a value (rather
+        than a pad) at each column, from the windows alone (see:
+        intervals.Windows.count_events()), so matrices built from the plan
+        don't have to be scanned by count_events().
+
+        Returns
+        -------
+        num_events : numpy.ndarray
+            int32 number of events at each position
+        """
+        if self.scale_lengths is not None:
+            # scaled rows have a value at every position
+            return np.full(100, self.num_events, dtype=np.int32)
+        if len(self.windows) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate(
+            [windows.count_events() for windows in self.windows]
+        )
+
+    def fetch(self, density):
+        """
+        Reads every window of the plan from density.
+
+        Returns
+        -------
+        ra : numpy.ndarray
+            (num_events x width of every block) MATRIX_DTYPE matrix
+        """
+        ra, blocks = _allocate(
+            self.num_events, [windows.width for windows in self.windows]
+        )
+        for windows, block in zip(self.windows, blocks):
+            windows.fetch(density, out=block)
+        if self.scale_lengths is not None:
+            return intervals.get_scales(ra, self.scale_lengths)
+        return ra
+
+
+def _stack(regions):
+    """
+    Concatenates (side by side) each region's density matrix into one
+    dataframe whose rows are event ids, and columns are numbered from 0.
+    """
+    ra = pd.DataFrame(np.hstack(regions))
+    ra.columns = range(0, ra.shape[1])
+    return ra
+
 
 def same_length_region(
         annotation, density, annotation_type,
@@ -52,45 +549,53 @@ def same_length_region(
 
     Returns
     -------
-
+    pandas.DataFrame
+        matrix of densities, one row per event id
+    events : pandas.DataFrame
+        event table (see: event_table) named by intervals.rename_index
     """
-    densities = {}
-    # TODO: pd.DataFrame.from_dict(dic, orient="index")
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not \
-                    line.startswith('ID') and not \
-                    line.startswith('annotation'):  # assume there is a header
-                event = line.rstrip()
-                interval = Feature.Feature(
-                    event, annotation_type
-                ).get_bedtool()
+    plan, events = same_length_region_plan(
+        annotation, annotation_type, upstream_offset, downstream_offset, scale
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-                wiggle = intervals.generic_site(
-                    density,
-                    interval,
-                    upstream_offset,
-                    downstream_offset
-                )
 
-                if scale:
-                    wiggle = intervals.get_scale(wiggle)
-                densities[intervals.rename_index(interval)] = wiggle
-                # if len(wiggle) != 601: # i saw some cds start sites that are more than 1 nt long.
-                #     print(len(wiggle), event)
-    try:
-        return pd.DataFrame(densities).T
-    except Exception as e:
-        print(e)
+def same_length_region_plan(
+        annotation, annotation_type,
+        upstream_offset, downstream_offset, scale
+):
+    """
+    Returns the FetchPlan (and event table) of same_length_region(),
+    which can be fetched from any number of densities.
+    """
+    names, table = annotations.read_table(annotation)
+    if len(names) > 0:
+        # chrom:start-end:name:strand (see: intervals.rename_index)
+        index = table[0].str.cat(
+            [table[1] + '-' + table[2], table[3], table[5]], sep=':'
+        )
+        unique = ~index.duplicated().values
+        index = list(index.values[unique])
+        names, table = names[unique], table[unique].reset_index(drop=True)
+    else:
+        index = []
+    region, = annotations.parse_regions(names, table, 'bed', annotation_type)
+
+    windows = intervals.generic_windows(
+        region, upstream_offset, downstream_offset
+    )
+    lengths = windows.lengths()
+    if not scale and len(set(lengths)) > 1:
         print("found different length features")
-        for key, value in densities.iteritems():
-            densities[key] = intervals.get_scale(value)
-        return pd.DataFrame(densities).T
+        scale = True
+    return FetchPlan(
+        len(windows), [windows], lengths if scale else None
+    ), _event_spans(index, region)
 
 
 def multi_length_regions(
         annotation, density, annotation_type,
-        upstream_offset, downstream_offset
+        upstream_offset, downstream_offset, cache_dir=None
 ):
     """
     Given an exon, return a dataframe of densities corresponding to unscaled
@@ -99,7 +604,8 @@ def multi_length_regions(
     Parameters
     ----------
     annotation : basestring
-        filename of the annotation file to use
+        filename of the annotation file to use (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object that contains positive and negative normalized density *.bw
     upstream_offset : int
@@ -114,6 +620,9 @@ def multi_length_regions(
         introns in (-) intron|exon features.
     annotation_type : basestring
         name of the annotation feature described by density.Feature
+    cache_dir : basestring
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
 
     Returns
     -------
@@ -121,88 +630,97 @@ def multi_length_regions(
     a list of exons defined by annotation_file.
     r = intron_offset + exon_offset + exon_offset + intron_offset
     c = number of annotations in annotation_file
+    events : pandas.DataFrame
+        event table (see: event_table)
     """
-    up = {}  # describes for every event the upstream region
-    down = {}  # describes for every event the downstream region
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()  # .split('\t')[0]
-
-                interval = Feature.Feature(
-                    event,
-                    annotation_type
-                ).get_bedtool()
+    plan, events = multi_length_regions_plan(
+        annotation, annotation_type, upstream_offset, downstream_offset,
+        cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-                """ calculate five prime site region """
-                # [      ]---|----[  |     ]
-                wiggle = intervals.five_prime_site(
-                    density, None, interval, upstream_offset,
-                    downstream_offset, stop_at_midpoint=True
-                )
-                up[event] = wiggle
-                """ calculate the three prime site region """
-                wiggle = intervals.three_prime_site(
-                    density, None, interval, upstream_offset,
-                    downstream_offset, stop_at_midpoint=True
-                )
-                down[event] = wiggle
 
-    up = pd.DataFrame(up).T
-    down = pd.DataFrame(down).T
+def multi_length_regions_plan(annotation, annotation_type, upstream_offset,
+                              downstream_offset, cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of multi_length_regions(),
+    which can be fetched from any number of densities.
+    """
+    events, (regions, ) = annotations.read_regions(
+        annotation, 'bed', annotation_type, cache_dir
+    )
+    plan = FetchPlan(len(events))
+
+    """ calculate five prime site region """
+    # [      ]---|----[  |     ]
+    plan.add(intervals.five_prime_windows(
+        None, regions, upstream_offset, downstream_offset,
+        stop_at_midpoint=True
+    ))
+    """ calculate the three prime site region """
+    plan.add(intervals.three_prime_windows(
+        None, regions, upstream_offset, downstream_offset,
+        stop_at_midpoint=True
+    ))
 
     # combine both regions in order to scale together.
-    ra = pd.concat([up, down], axis=1)
-    ra.columns = range(0, ra.shape[1])
-
-    return ra
+    return plan, _event_spans(events, regions)
 
 def meta(annotation, density, upstream_offset, downstream_offset, annotation_type="bed", scale_to=100):
     # TODO: implement upstream and downstream CDS features.
-    densities = {}
     # TODO: we dont need this? No need to collapse transcripts
     # df = intervals.merge(annotation)
     # df = intervals.explode(df)
     df = pd.read_table(annotation, names=['chrom','start','end','name','score','strand'])
     genes = df.groupby('name').apply(intervals.make_linelist_from_dataframe)
     progress = trange(len(genes))
+    bedtools = []  # every interval, in the order it's added to its gene
+    num_intervals = []  # number of intervals belonging to each gene
+    spans = []  # (chrom, start, end, strand) of each gene
     for name, gene in genes.iteritems():
         feature = Feature.MetaFeature(gene, annotation_type).get_bedtools()
-        wiggle = np.array([])  # create wiggle with all CDS values for each gene.
+        spans.append((
+            feature[0].chrom, min([interval.start for interval in feature]),
+            max([interval.end for interval in feature]), feature[0].strand
+        ))
         # check positive strand based on first element encountered
         if feature[0].strand == '+':
             # if positive, go from lower to higher
-            for interval in feature:
-                wig_segment = intervals.generic_site(
-                    density, interval, 0, 0
-                )
-                wiggle = np.append(wiggle, wig_segment)
+            feature = list(feature)
         elif feature[0].strand == '-':
             # if negative, go from higher to lower
-            for interval in reversed(feature):
-                wig_segment = intervals.generic_site(
-                    density, interval, 0, 0
-                )
-                wiggle = np.append(wiggle, wig_segment)
-        # if len(wiggle) != 0 and 'HepG2_EIF4B_626_intersecting_CDS.bed' in annotation and name == 'ENST00000379389.4':
-        #     print("WRITING INTERMEDIATE WIGGLE TO FILE")
-        #     with open('/home/bay001/projects/eric_clip_paper_20180120/permanent_data/conservation/intermediates/EIF4B.CDS.ENST00000379389.before_scaling.txt', 'w') as f:
-        #         for w in wiggle:
-        #             f.write("{}\n".format(w))
-        #    sys.exit(1)
-        wiggle = intervals.get_scale(wiggle, scale_to=scale_to)
-        densities[name] = wiggle
+            feature = list(reversed(feature))
+        else:
+            feature = []
+        bedtools += feature
+        num_intervals.append(len(feature))
         progress.update(1)
-    try:
 
-        return pd.DataFrame(densities).T
-    except Exception as e:
-        print(e)
-        print("found different length features")
+    # create wiggle with all CDS values for each gene: every interval is
+    # read into one long row, (-) genes from their last interval to first.
+    starts = np.array([interval.start for interval in bedtools], dtype=int)
+    ends = np.array([interval.end for interval in bedtools], dtype=int)
+    lengths = np.maximum(ends - starts, 0)
+    wiggle = density.values_batch(
+        [interval.chrom for interval in bedtools], starts, ends,
+        [interval.strand for interval in bedtools],
+        offsets=np.cumsum(lengths) - lengths,
+        rows=np.zeros(len(bedtools), dtype=int)
+    )
+    wiggle = np.nan_to_num(np.abs(wiggle.ravel()))
+    gene_lengths = np.bincount(
+        np.repeat(np.arange(len(num_intervals)), num_intervals),
+        weights=lengths, minlength=len(num_intervals)
+    ).astype(int)
+    gene_wiggles = np.split(wiggle, np.cumsum(gene_lengths)[:-1])
+    chroms, starts, ends, strands = zip(*spans) if spans else [[]] * 4
+    return pd.DataFrame(
+        intervals.get_scales(gene_wiggles, scale_to=scale_to)
+    ), event_table(list(genes.index), chroms, starts, ends, strands)
 
 
 def mutually_exc_exon(annotation, density, exon_offset, intron_offset,
-                      annotation_type="rmats"):
+                      annotation_type="rmats", cache_dir=None):
     """
 
     Creates an r x c pandas dataframe of r events for a mutually exclusive
@@ -220,7 +738,8 @@ def mutually_exc_exon(annotation, density, exon_offset, intron_offset,
     Parameters
     ----------
     annotation : basestring
-        path of file containing the annotation
+        path of file containing the annotation (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object containing positive and negative BigWig files
     exon_offset : int
@@ -229,90 +748,73 @@ def mutually_exc_exon(annotation, density, exon_offset, intron_offset,
         how far after the exon boundary to plotter
     annotation_type : basestring
         Must be "rmats" or any additional defined format (see: density.Feature)
+    cache_dir : basestring
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
     Returns
     -------
     pandas.DataFrame
         A dataframe of r events for an MXE feature (see: description).
+    events : pandas.DataFrame
+        event table (see: event_table)
     """
-    # covers 3' end of upstream flanking exon
-    three_upstream = {}
-    # covers 5-3' ends of upstream exclusive exon
-    five_up_mxe = {}
-    three_up_mxe = {}
-    # covers 5-3' ends of downstream exclusive exon
-    five_down_mxe = {}
-    three_down_mxe = {}
-    # covers 5' end of downstream flanking exon
-    five_downstream = {}
+    plan, events = mutually_exc_exon_plan(
+        annotation, exon_offset, intron_offset, annotation_type, cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()  # .split('\t')[0]
-                upstream_interval, upstream_mxe_interval, \
-                    downstream_mxe_interval, downstream_interval = \
-                    Feature.Mutually_exclusive_exon(
-                        event,
-                        annotation_type
-                    ).get_bedtools()
-
-                """three prime upstream region"""
-                wiggle = intervals.three_prime_site(
-                    density, upstream_mxe_interval, upstream_interval,
-                    exon_offset, intron_offset
-                )
-                three_upstream[event] = wiggle
-                """five prime site of mxe1 (upstream mxe) region"""
-                wiggle = intervals.five_prime_site(
-                    density, upstream_interval, upstream_mxe_interval,
-                    exon_offset, intron_offset
-                )
-                five_up_mxe[event] = wiggle
-                """three prime site of mxe1 (upstream mxe) region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream_mxe_interval, upstream_mxe_interval,
-                    exon_offset, intron_offset
-                )
-                three_up_mxe[event] = wiggle
-                """five prime site of mxe2 (downstream mxe) region"""
-                wiggle = intervals.five_prime_site(
-                    density, upstream_mxe_interval, downstream_mxe_interval,
-                    exon_offset, intron_offset
-                )
-                five_down_mxe[event] = wiggle
-                """three prime site of mxe2 (downstream mxe) region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream_interval, downstream_mxe_interval,
-                    exon_offset, intron_offset
-                )
-                three_down_mxe[event] = wiggle
-                """five prime site of downstream region"""
-                wiggle = intervals.five_prime_site(
-                    density, downstream_mxe_interval, downstream_interval,
-                    exon_offset, intron_offset
-                )
-                five_downstream[event] = wiggle
-
-        # TODO make this more efficient.
-        three_upstream = pd.DataFrame(three_upstream).T
-        five_up_mxe = pd.DataFrame(five_up_mxe).T
-        three_up_mxe = pd.DataFrame(three_up_mxe).T
-        five_down_mxe = pd.DataFrame(five_down_mxe).T
-        three_down_mxe = pd.DataFrame(three_down_mxe).T
-        five_downstream = pd.DataFrame(five_downstream).T
-
-    ra = pd.concat([
-        three_upstream, five_up_mxe, three_up_mxe,
-        five_down_mxe, three_down_mxe, five_downstream
-    ], axis=1
+
+def mutually_exc_exon_plan(annotation, exon_offset, intron_offset,
+                           annotation_type="rmats", cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of mutually_exc_exon(),
+    which can be fetched from any number of densities.
+    """
+    events, (upstream_intervals, upstream_mxe_intervals,
+             downstream_mxe_intervals, downstream_intervals) = \
+        annotations.read_regions(
+            annotation, 'mxe', annotation_type, cache_dir
+        )
+    plan = FetchPlan(len(events))
+
+    """three prime upstream region"""
+    plan.add(intervals.three_prime_windows(
+        upstream_mxe_intervals, upstream_intervals, exon_offset, intron_offset
+    ))
+    """five prime site of mxe1 (upstream mxe) region"""
+    plan.add(intervals.five_prime_windows(
+        upstream_intervals, upstream_mxe_intervals, exon_offset, intron_offset
+    ))
+    """three prime site of mxe1 (upstream mxe) region"""
+    plan.add(intervals.three_prime_windows(
+        downstream_mxe_intervals, upstream_mxe_intervals,
+        exon_offset, intron_offset
+    ))
+    """five prime site of mxe2 (downstream mxe) region"""
+    plan.add(intervals.five_prime_windows(
+        upstream_mxe_intervals, downstream_mxe_intervals,
+        exon_offset, intron_offset
+    ))
+    """three prime site of mxe2 (downstream mxe) region"""
+    plan.add(intervals.three_prime_windows(
+        downstream_intervals, downstream_mxe_intervals,
+        exon_offset, intron_offset
+    ))
+    """five prime site of downstream region"""
+    plan.add(intervals.five_prime_windows(
+        downstream_mxe_intervals, downstream_intervals,
+        exon_offset, intron_offset
+    ))
+
+    return plan, _event_spans(
+        events, upstream_intervals, upstream_mxe_intervals,
+        downstream_mxe_intervals, downstream_intervals
     )
-    ra.columns = range(0, ra.shape[1])
-    return ra
 
 
 def retained_intron(annotation, density,
                     exon_offset, intron_offset,
-                    annotation_type="rmats"):
+                    annotation_type="rmats", cache_dir=None):
     """
     Creates an r x c pandas dataframe of r events for a
     Retained Intron (RI) feature.
@@ -324,7 +826,8 @@ def retained_intron(annotation, density,
     Parameters
     ----------
     annotation : str
-        path of file containing the annotation
+        path of file containing the annotation (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object containing the positive and negative BigWig files
     exon_offset : int
@@ -333,47 +836,49 @@ def retained_intron(annotation, density,
         how far from the exon boundary to plotter
     annotation_type : str
         may be rmats format or any additional defined format in Feature
+    cache_dir : str
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
 
     Returns
     -------
     pandas.DataFrame : dataframe of r events for an MXE feature.
+    events : pandas.DataFrame : event table (see: event_table)
     """
+    plan, events = retained_intron_plan(
+        annotation, exon_offset, intron_offset, annotation_type, cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-    three_upstream = {}
-    five_downstream = {}
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()  # .split('\t')[0]
-                upstream_interval, downstream_interval = Feature.Retained_intron(
-                    event,
-                    annotation_type
-                ).get_bedtools()
-
-                """three prime upstream region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream_interval, upstream_interval,
-                    exon_offset, intron_offset
-                )
-                three_upstream[event] = wiggle
-
-                """five prime site of downstream region"""
-                wiggle = intervals.five_prime_site(
-                    density, upstream_interval, downstream_interval,
-                    exon_offset, intron_offset
-                )
-                five_downstream[event] = wiggle
-
-        three_upstream = pd.DataFrame(three_upstream).T
-        five_downstream = pd.DataFrame(five_downstream).T
 
-    ra = pd.concat([three_upstream, five_downstream], axis=1)
-    ra.columns = range(0, ra.shape[1])
-    return ra
+def retained_intron_plan(annotation, exon_offset, intron_offset,
+                         annotation_type="rmats", cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of retained_intron(),
+    which can be fetched from any number of densities.
+    """
+    events, (upstream_intervals, downstream_intervals) = \
+        annotations.read_regions(
+            annotation, 'ri', annotation_type, cache_dir
+        )
+    plan = FetchPlan(len(events))
+
+    """three prime upstream region"""
+    plan.add(intervals.three_prime_windows(
+        downstream_intervals, upstream_intervals, exon_offset, intron_offset
+    ))
+    """five prime site of downstream region"""
+    plan.add(intervals.five_prime_windows(
+        upstream_intervals, downstream_intervals, exon_offset, intron_offset
+    ))
+
+    return plan, _event_spans(
+        events, upstream_intervals, downstream_intervals
+    )
 
 
 def alt_5p_splice_site(annotation, density, exon_offset, intron_offset,
-                       annotation_type="rmats"):
+                       annotation_type="rmats", cache_dir=None):
     """
     Creates an r x c pandas dataframe of r events for an
     alternative 5' splice site feature. An A5ss matrix will
@@ -389,7 +894,8 @@ def alt_5p_splice_site(annotation, density, exon_offset, intron_offset,
     Parameters
     ----------
     annotation : str
-        path of file containing the annotation
+        path of file containing the annotation (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object containing positive and negative BigWig files
     exon_offset : int
@@ -398,50 +904,49 @@ def alt_5p_splice_site(annotation, density, exon_offset, intron_offset,
         how far from the exon boundary to plotter
     annotation_type : str
         may be rmats format or any additional defined format in Feature
+    cache_dir : str
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
     Returns
     -------
     pandas.DataFrame : a dataframe of r events for an A5SS feature.
+    events : pandas.DataFrame : event table (see: event_table)
     """
+    plan, events = alt_5p_splice_site_plan(
+        annotation, exon_offset, intron_offset, annotation_type, cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-    three_alt1 = {}
-    three_alt2 = {}
-    five_downstream = {}
 
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()  # .split('\t')[0] ## do we have headers?
-                alt1, alt2, downstream = Feature.Alt_5p_splice_site(
-                    event, annotation_type
-                ).get_bedtools()
-                """three prime site of alt2 (shorter) region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream, alt2, exon_offset, intron_offset
-                )
-                three_alt2[event] = wiggle
+def alt_5p_splice_site_plan(annotation, exon_offset, intron_offset,
+                            annotation_type="rmats", cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of alt_5p_splice_site(),
+    which can be fetched from any number of densities.
+    """
+    events, (alt1s, alt2s, downstreams) = annotations.read_regions(
+        annotation, 'a5ss', annotation_type, cache_dir
+    )
+    plan = FetchPlan(len(events))
 
-                """three prime alt1  (longer) region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream, alt1, exon_offset, intron_offset
-                )
-                three_alt1[event] = wiggle
+    """three prime site of alt2 (shorter) region"""
+    plan.add(intervals.three_prime_windows(
+        downstreams, alt2s, exon_offset, intron_offset
+    ))
+    """three prime alt1  (longer) region"""
+    plan.add(intervals.three_prime_windows(
+        downstreams, alt1s, exon_offset, intron_offset
+    ))
+    """five prime site of downstream region"""
+    plan.add(intervals.five_prime_windows(
+        alt2s, downstreams, exon_offset, intron_offset
+    ))
 
-                """five prime site of downstream region"""
-                wiggle = intervals.five_prime_site(
-                    density, alt2, downstream, exon_offset, intron_offset
-                )
-                five_downstream[event] = wiggle
-        three_alt1 = pd.DataFrame(three_alt1).T
-        three_alt2 = pd.DataFrame(three_alt2).T
-        five_downstream = pd.DataFrame(five_downstream).T
-
-    ra = pd.concat([three_alt2, three_alt1, five_downstream], axis=1)
-    ra.columns = range(0, ra.shape[1])
-    return ra
+    return plan, _event_spans(events, alt1s, alt2s, downstreams)
 
 
 def alt_3p_splice_site(annotation, density, exon_offset, intron_offset,
-                       annotation_type="rmats"):
+                       annotation_type="rmats", cache_dir=None):
     """
     Creates an r x c pandas dataframe of r events for an
     alternative 3' splice site feature. An A3SS matrix will
@@ -457,7 +962,8 @@ def alt_3p_splice_site(annotation, density, exon_offset, intron_offset,
     Parameters
     ----------
     annotation : str
-        path of file containing the annotation
+        path of file containing the annotation (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object containing positive and negative BigWig files
     exon_offset : int
@@ -466,50 +972,49 @@ def alt_3p_splice_site(annotation, density, exon_offset, intron_offset,
         how far after the exon boundary to plotter
     annotation_type : str
         may be rmats format or any additional defined format in Feature
+    cache_dir : str
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
     Returns
     -------
     pandas.DataFrame : a dataframe of r events for an A3SS feature.
+    events : pandas.DataFrame : event table (see: event_table)
     """
+    plan, events = alt_3p_splice_site_plan(
+        annotation, exon_offset, intron_offset, annotation_type, cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
-    three_upstream = {}
-    five_alt1 = {}
-    five_alt2 = {}
 
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()
-                upstream, alt1, alt2 = Feature.Alt_3p_splice_site(
-                    event, annotation_type
-                ).get_bedtools()
-                """ upstream region """
-                wiggle = intervals.three_prime_site(
-                    density, alt1, upstream, exon_offset, intron_offset
-                )
-                three_upstream[event] = wiggle
-                """ five prime site of alt1 (longer exon) """
-                wiggle = intervals.five_prime_site(
-                    density, upstream, alt1, exon_offset, intron_offset
-                )
-                five_alt1[event] = wiggle
-                """ five prime site of alt2 (shorter exon) """
-                wiggle = intervals.five_prime_site(
-                    density, upstream, alt2, exon_offset, intron_offset
-                )
-                five_alt2[event] = wiggle
-
-        three_upstream = pd.DataFrame(three_upstream).T
-        five_alt1 = pd.DataFrame(five_alt1).T
-        five_alt2 = pd.DataFrame(five_alt2).T
+def alt_3p_splice_site_plan(annotation, exon_offset, intron_offset,
+                            annotation_type="rmats", cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of alt_3p_splice_site(),
+    which can be fetched from any number of densities.
+    """
+    events, (upstreams, alt1s, alt2s) = annotations.read_regions(
+        annotation, 'a3ss', annotation_type, cache_dir
+    )
+    plan = FetchPlan(len(events))
 
-    ra = pd.concat([three_upstream, five_alt1, five_alt2], axis=1)
-    ra.columns = range(0, ra.shape[1])
+    """ upstream region """
+    plan.add(intervals.three_prime_windows(
+        alt1s, upstreams, exon_offset, intron_offset
+    ))
+    """ five prime site of alt1 (longer exon) """
+    plan.add(intervals.five_prime_windows(
+        upstreams, alt1s, exon_offset, intron_offset
+    ))
+    """ five prime site of alt2 (shorter exon) """
+    plan.add(intervals.five_prime_windows(
+        upstreams, alt2s, exon_offset, intron_offset
+    ))
 
-    return ra
+    return plan, _event_spans(events, upstreams, alt1s, alt2s)
 
 
 def skipped_exon(annotation, density, exon_offset, intron_offset,
-                 annotation_type="rmats"):
+                 annotation_type="rmats", cache_dir=None):
     """
     Creates an r x c pandas dataframe of r events for a skipped
     exon feature. An SE matrix will contain four distinct regions:
@@ -524,7 +1029,8 @@ def skipped_exon(annotation, density, exon_offset, intron_offset,
     Parameters
     ----------
     annotation : str
-        path of file containing the annotation
+        path of file containing the annotation (or list of its events,
+        see: read_events)
     density : density.ReadDensity
         object containing positive and negative BigWig files
     exon_offset : int
@@ -533,66 +1039,108 @@ def skipped_exon(annotation, density, exon_offset, intron_offset,
         how far after the exon boundary to plotter
     annotation_type : str
         may be rmats format or any additional defined format in Feature
+    cache_dir : str
+        directory to cache the parsed annotation in (see:
+        annotations.read_regions), or None
     Returns
     -------
+    pandas.DataFrame : a dataframe of r events for an SE feature.
+    events : pandas.DataFrame : event table (see: event_table)
+    """
+    plan, events = skipped_exon_plan(
+        annotation, exon_offset, intron_offset, annotation_type, cache_dir
+    )
+    return pd.DataFrame(plan.fetch(density)), events
 
+
+def skipped_exon_plan(annotation, exon_offset, intron_offset,
+                      annotation_type="rmats", cache_dir=None):
+    """
+    Returns the FetchPlan (and event table) of skipped_exon(),
+    which can be fetched from any number of densities.
     """
+    events, (upstream_intervals, skipped_intervals, downstream_intervals) = \
+        annotations.read_regions(
+            annotation, 'se', annotation_type, cache_dir
+        )
+    plan = FetchPlan(len(events))
+
+    """three prime upstream region"""
+    plan.add(intervals.three_prime_windows(
+        skipped_intervals, upstream_intervals, exon_offset, intron_offset
+    ))
+    """five prime site of skipped region"""
+    plan.add(intervals.five_prime_windows(
+        upstream_intervals, skipped_intervals, exon_offset, intron_offset
+    ))
+    """three prime site of skipped region"""
+    plan.add(intervals.three_prime_windows(
+        downstream_intervals, skipped_intervals, exon_offset, intron_offset
+    ))
+    """five prime site of downstream region"""
+    plan.add(intervals.five_prime_windows(
+        skipped_intervals, downstream_intervals, exon_offset, intron_offset
+    ))
+
+    return plan, _event_spans(
+        events, upstream_intervals, skipped_intervals, downstream_intervals
+    )
 
-    three_upstream = {}
-    five_skipped = {}
-    three_skipped = {}
-    five_downstream = {}
 
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()
-                try:
-                    upstream_interval, interval, downstream_interval = \
-                        Feature.Skipped_exon(
-                            event,
-                            annotation_type
-                        ).get_bedtools()
-                except Exception as e:
-                    print("Having trouble parsing event: \
-                    {} (assumed type: {})".format(event, annotation_type))
-
-                """three prime upstream region"""
-                wiggle = intervals.three_prime_site(
-                    density, interval, upstream_interval,
-                    exon_offset, intron_offset
-                )
-                three_upstream[event] = wiggle
-                """five prime site of skipped region"""
-                wiggle = intervals.five_prime_site(
-                    density, upstream_interval, interval,
-                    exon_offset, intron_offset
-                )
-                five_skipped[event] = wiggle
-                """three prime site of skipped region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream_interval, interval,
-                    exon_offset, intron_offset
-                )
-                three_skipped[event] = wiggle
-                """five prime site of downstream region"""
-                wiggle = intervals.five_prime_site(
-                    density, interval, downstream_interval,
-                    exon_offset, intron_offset
-                )
-                five_downstream[event] = wiggle
+# builders whose windows don't depend on the density they read from
+PLANS = {
+    same_length_region: same_length_region_plan,
+    multi_length_regions: multi_length_regions_plan,
+    mutually_exc_exon: mutually_exc_exon_plan,
+    retained_intron: retained_intron_plan,
+    alt_5p_splice_site: alt_5p_splice_site_plan,
+    alt_3p_splice_site: alt_3p_splice_site_plan,
+    skipped_exon: skipped_exon_plan,
+}
 
-        three_upstream = pd.DataFrame(three_upstream).T
-        five_skipped = pd.DataFrame(five_skipped).T
-        three_skipped = pd.DataFrame(three_skipped).T
-        five_downstream = pd.DataFrame(five_downstream).T
 
-    ra = pd.concat(
-        [three_upstream, five_skipped, three_skipped, five_downstream],
-        axis=1
-    )
-    ra.columns = range(0, ra.shape[1])
-    return ra
+def build_with_plan(builder, densities, **kwargs):
+    """
+    Builds the matrix of each density with builder, computing the windows
+    (see: FetchPlan) of the annotation just once if the builder has a plan
+    (see: PLANS), so that each extra density only costs its reads. The
+    number of events at each position is counted as each matrix is built:
+    from the plan's windows, or for builders without a plan, from the rows
+    of meta() (which has a value at every position) or with count_events().
+
+    Parameters
+    ----------
+    builder : function
+        matrix builder (ie. skipped_exon)
+    densities : list
+        density.ReadDensity (or any other density) objects to read from
+    kwargs :
+        arguments to builder, other than density
+
+    Returns
+    -------
+    matrices : list
+        (pandas.DataFrame, events, num_events) for each density, where
+        pandas.DataFrame and events are what builder returns
+    """
+    if builder not in PLANS:
+        matrices = []
+        for density in densities:
+            matrix, events = builder(density=density, **kwargs)
+            if builder is meta:
+                num_events = np.full(
+                    matrix.shape[1], matrix.shape[0], dtype=np.int32
+                )
+            else:
+                num_events = count_events(matrix)
+            matrices.append((matrix, events, num_events))
+        return matrices
+    plan, events = PLANS[builder](**kwargs)
+    num_events = plan.count_events()
+    return [
+        (pd.DataFrame(plan.fetch(density)), events, num_events.copy())
+        for density in densities
+    ]
 
 
 def phastcon_region(
@@ -614,67 +1162,69 @@ def phastcon_region(
 
     Returns
     -------
-
+    pandas.DataFrame
+    events : pandas.DataFrame
+        event table (see: event_table)
     """
-    three_upstream = {}
-    five_downstream = {}
-    with open(annotation) as f:
-        for line in f:
-            if not line.startswith('event_name') and not line.startswith('ID') and not line.startswith('annotation'):
-                event = line.rstrip()  # .split('\t')[0]
-                upstream_interval, downstream_interval = Feature.Phastcon(
-                    event,
-                    annotation_type
-                ).get_bedtools()
-                """three prime upstream region"""
-                wiggle = intervals.three_prime_site(
-                    density, downstream_interval, upstream_interval,
-                    exon_offset, intron_offset, fill_pads_with=-1
-                )
-                if mask_df:
-                    region = intervals.bedtool_from_renamed_twobed_index(event, 'upstream')
-
-
-                    masked_interval = peak.values(region.chrom, region.start,
-                                                  region.end, region.strand)
-                    if sum(masked_interval) > 0:
-                        for pos in masked_interval.index:
-                            wiggle[pos] = wiggle[pos] if masked_interval.loc[pos] > 0 else np.nan
-                        # if event == 'chr1\t1234724\t1234736\tENST00000354700.5\t0\t-\tchr1\t1235210\t1235285\tENST00000354700.5\t0\t-':
-                        #     print("upstream", region)
-                        #     print(wiggle)
-                    else:
-                        wiggle = [np.nan for pos in wiggle]
-                three_upstream[event] = wiggle
-
-                """five prime site of downstream region"""
-                wiggle = intervals.five_prime_site(
-                    density, upstream_interval, downstream_interval,
-                    exon_offset, intron_offset, fill_pads_with=-1
-                )
-
-                if mask_df:
-                    region = intervals.bedtool_from_renamed_twobed_index(event, 'downstream')
-                    masked_interval = peak.values(region.chrom, region.start,
-                                                  region.end, region.strand)
-                    if sum(masked_interval) > 0:
-
-                        for pos in masked_interval.index:
-                            wiggle[pos] = wiggle[pos] if (masked_interval.loc[pos] > 0 and wiggle[pos] >= 0) else np.nan
-                        # if event == 'chr1\t1234724\t1234736\tENST00000354700.5\t0\t-\tchr1\t1235210\t1235285\tENST00000354700.5\t0\t-':
-                        #     print("downstream", region)
-                    else:
-                        wiggle = [np.nan for pos in wiggle]
-                five_downstream[event] = wiggle
-
-        three_upstream = pd.DataFrame(three_upstream).T
-        five_downstream = pd.DataFrame(five_downstream).T
-
-    ra = pd.merge(three_upstream, five_downstream, how='outer', left_index=True, right_index=True)
+    events = read_events(annotation)
+    three_upstream = []
+    five_downstream = []
+    upstream_intervals = []
+    downstream_intervals = []
+    for event in events:
+        upstream_interval, downstream_interval = Feature.Phastcon(
+            event,
+            annotation_type
+        ).get_bedtools()
+        upstream_intervals.append(upstream_interval)
+        downstream_intervals.append(downstream_interval)
+        """three prime upstream region"""
+        wiggle = intervals.three_prime_site(
+            density, downstream_interval, upstream_interval,
+            exon_offset, intron_offset, fill_pads_with=-1
+        )
+        if mask_df:
+            region = intervals.bedtool_from_renamed_twobed_index(event, 'upstream')
+
+
+            masked_interval = peak.values(region.chrom, region.start,
+                                          region.end, region.strand)
+            if sum(masked_interval) > 0:
+                for pos in masked_interval.index:
+                    wiggle[pos] = wiggle[pos] if masked_interval.loc[pos] > 0 else np.nan
+                # if event == 'chr1\t1234724\t1234736\tENST00000354700.5\t0\t-\tchr1\t1235210\t1235285\tENST00000354700.5\t0\t-':
+                #     print("upstream", region)
+                #     print(wiggle)
+            else:
+                wiggle = [np.nan for pos in wiggle]
+        three_upstream.append(wiggle)
+
+        """five prime site of downstream region"""
+        wiggle = intervals.five_prime_site(
+            density, upstream_interval, downstream_interval,
+            exon_offset, intron_offset, fill_pads_with=-1
+        )
+
+        if mask_df:
+            region = intervals.bedtool_from_renamed_twobed_index(event, 'downstream')
+            masked_interval = peak.values(region.chrom, region.start,
+                                          region.end, region.strand)
+            if sum(masked_interval) > 0:
+
+                for pos in masked_interval.index:
+                    wiggle[pos] = wiggle[pos] if (masked_interval.loc[pos] > 0 and wiggle[pos] >= 0) else np.nan
+                # if event == 'chr1\t1234724\t1234736\tENST00000354700.5\t0\t-\tchr1\t1235210\t1235285\tENST00000354700.5\t0\t-':
+                #     print("downstream", region)
+            else:
+                wiggle = [np.nan for pos in wiggle]
+        five_downstream.append(wiggle)
+
+    ra = _stack([
+        np.array(three_upstream, dtype=float).reshape(len(events), -1),
+        np.array(five_downstream, dtype=float).reshape(len(events), -1)
+    ])
     ra = ra.replace(-1, np.nan)
-    # ra = pd.concat([three_upstream, five_downstream], axis=1)
-    ra.columns = range(0, ra.shape[1])
-    return ra
+    return ra, _event_spans(events, upstream_intervals, downstream_intervals)
 
     """
     densities = {}
@@ -13,6 +13,7 @@ Main Functions
 clean : rather important function for handling -1 and NaN values.
 get_means_and_sems : returns the mean and std error over each column (position)
     in a dataframe.
+trimmed_means_and_sems : same as get_means_and_sems, but over a numpy matrix
 normalize_and_subtract : subtract the average read densities of input
     from ip
 normalize_and_per_region_subtract : subtract the read densities of input
@@ -33,8 +34,14 @@ calculate_pdf : normalizes each event (row) to sum to 1
 import numpy as np
 import pandas as pd
 import math
+import multiprocessing
 from density import misc
 from decimal import Decimal
+from tqdm import trange
+
+PERMUTATION_BATCH_SIZE = 2 ** 26  # max (permutations x bg events x positions) in one batch
+TAIL_RANKS = 64  # smallest/largest background values first searched for outliers
+KERNEL_ROWS = 4096  # rows whose absolute values are summed at a time (see: _abs_pdf_values)
 
 ### Normalize density methods ###
 
@@ -76,6 +83,180 @@ def clean(density_df):
     return density_df.replace(-1, np.nan)
 
 
+### Normalization kernels ###
+# These work in place on float32 copies of the matrices. Instead of turning
+# -1 (premature boundary) positions into NaNs right away like clean() does,
+# they're kept as an explicit mask and held at 0 so that rows can be summed
+# without copying the matrix; _mask_boundaries() makes them NaN at the end.
+
+
+def _cleaned_values(density_df):
+    """
+    Returns clean() of a matrix as a new float32 array, along with the
+    mask of its -1 (premature boundary) positions, which are set to 0.
+
+    Parameters
+    ----------
+    density_df : pandas.DataFrame
+
+    Returns
+    -------
+    values : numpy.ndarray
+    boundaries : numpy.ndarray
+        True where density_df is -1
+    """
+    values = np.array(density_df.values, dtype=np.float32, order='C')
+    boundaries = values == -1
+    np.copyto(values, 0, where=np.isnan(values))
+    values[boundaries] = 0
+    return values, boundaries
+
+
+def _cleaned_pair(density_df, input_density_df):
+    """
+    Returns _cleaned_values() of the ip and the input matrix, which must
+    share the same rows (see: matrix.align_rows()); the input rows are
+    matched to the ip rows by position, not by index.
+
+    Parameters
+    ----------
+    density_df : pandas.DataFrame
+    input_density_df : pandas.DataFrame
+
+    Returns
+    -------
+    values : numpy.ndarray
+    boundaries : numpy.ndarray
+    input_values : numpy.ndarray
+    input_boundaries : numpy.ndarray
+    """
+    if density_df.shape != input_density_df.shape:
+        raise ValueError(
+            "ip {} and input {} matrices aren't row-aligned".format(
+                density_df.shape, input_density_df.shape
+            )
+        )
+    values, boundaries = _cleaned_values(density_df)
+    input_values, input_boundaries = _cleaned_values(input_density_df)
+    return values, boundaries, input_values, input_boundaries
+
+
+def _mask_boundaries(values, boundaries, rows=None):
+    """
+    Sets the boundary positions of values to NaN (as clean() would), as
+    well as every row not in rows (a boolean mask) if given.
+    """
+    values[boundaries] = np.nan
+    if rows is not None:
+        values[~rows] = np.nan
+    return values
+
+
+def _min_read(values, rows=None):
+    """
+    Returns the smallest positive value of values (in rows if given), which
+    calculate_pdf() uses when there is no pseudocount.
+    """
+    positive = values > 0
+    if rows is not None:
+        positive &= rows[:, np.newaxis]
+    return values[positive].min()
+
+
+def _pdf_values(values, boundaries, pseudocount=None,
+                min_density_threshold=0, rows=None):
+    """
+    calculate_pdf() of cleaned values (see: _cleaned_values) in place.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        each row divided by its sum (after adding the pseudocount to every
+        position that isn't a boundary). Boundaries are left at 0.
+    kept : numpy.ndarray
+        True for rows whose (cleaned) sum is at least min_density_threshold,
+        or rows itself if given
+    """
+    if (values < 0).any():
+        print("This dataframe has negative values, "
+              "use calculate_abs_pdf() function instead.")
+        raise ValueError("negative values")
+    if rows is None:
+        kept = values.sum(axis=1) >= min_density_threshold
+    else:
+        kept = rows
+    min_read = pseudocount if pseudocount else _min_read(values, kept)
+    values += min_read
+    values[boundaries] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values /= values.sum(axis=1)[:, np.newaxis]
+    return values, kept
+
+
+def _abs_pdf_values(values, boundaries, pseudocount=None,
+                    min_density_threshold=0, rows=None):
+    """
+    calculate_abs_pdf() of cleaned values (see: _cleaned_values) in place.
+    Absolute values are summed KERNEL_ROWS rows at a time, so at most that
+    many rows are ever copied.
+
+    Returns
+    -------
+    values : numpy.ndarray
+    kept : numpy.ndarray
+        True for rows whose absolute sum is at least min_density_threshold,
+        or rows itself if given
+    """
+    summed = np.empty(values.shape[0], dtype=np.float64)
+    for start in range(0, values.shape[0], KERNEL_ROWS):
+        summed[start:start + KERNEL_ROWS] = np.abs(
+            values[start:start + KERNEL_ROWS]
+        ).sum(axis=1)
+    if rows is None:
+        kept = summed >= min_density_threshold
+    else:
+        kept = rows
+    min_read = pseudocount if pseudocount else _min_read(values, kept)
+    summed += min_read * (values.shape[1] - boundaries.sum(axis=1))
+    if (summed == 0).any():
+        print(
+            "Warning, every value is zero AND either: "
+            "everything is NaN OR pseudocount/min_read is zero"
+        )
+    if (summed < 0).any():
+        print(
+            "Warning, min_read is less than zero or something "
+            "really weird (like row length is < 0) is happening."
+        )
+    summed[summed <= 0] = 1
+    values /= summed[:, np.newaxis]
+    return values, kept
+
+
+def _counted_values(density_df):
+    """
+    Returns the values of an already clean()ed matrix as a new float array
+    with its NaN (not counted) positions set to 0, along with their mask.
+    """
+    values = np.array(
+        density_df.values,
+        dtype=np.promote_types(density_df.values.dtype, np.float32),
+        order='C'
+    )
+    boundaries = np.isnan(values)
+    values[boundaries] = 0
+    return values, boundaries
+
+
+def _as_frame(values, density_df):
+    """
+    Returns values as a DataFrame with the rows and columns of density_df.
+    """
+    return pd.DataFrame(
+        values, index=density_df.index, columns=density_df.columns
+    )
+
+
 def pdf_entropy(density_df, input_density_df,
                 pseudocount, input_pseudocount,
                 min_density_threshold=0):
@@ -104,22 +285,24 @@ def pdf_entropy(density_df, input_density_df,
     en : pandas.DataFrame
     """
 
-    df_indices = density_df.index
-    dfi_indices = input_density_df.index
-    missing = set(df_indices) - set(dfi_indices)
-
-    input_density_df = input_density_df.append(input_density_df.ix[missing])
-
-    density_df = clean(density_df)
-    input_density_df = clean(input_density_df)
-
-    pdf = calculate_pdf(density_df, pseudocount, min_density_threshold)
-    input_pdf = calculate_pdf(
-        input_density_df, input_pseudocount, min_density_threshold
+    pdf, boundaries, input_pdf, input_boundaries = _cleaned_pair(
+        density_df, input_density_df
+    )
+    pdf, kept = _pdf_values(
+        pdf, boundaries, pseudocount, min_density_threshold
+    )
+    input_pdf, input_kept = _pdf_values(
+        input_pdf, input_boundaries, input_pseudocount, min_density_threshold
     )
 
-    en = pdf.multiply(np.log2(pdf.div(input_pdf)))
-    return en
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(pdf, input_pdf, out=input_pdf)
+        np.log2(input_pdf, out=input_pdf)
+        pdf *= input_pdf
+    # rows either pdf dropped are NaN, rows both dropped are left out
+    rows = kept | input_kept
+    en = _mask_boundaries(pdf, boundaries | input_boundaries, kept & input_kept)
+    return _as_frame(en, density_df)[rows]
 
 
 def read_entropy(density_df, input_density_df, pseudocount, input_pseudocount,
@@ -156,22 +339,25 @@ def read_entropy(density_df, input_density_df, pseudocount, input_pseudocount,
 
     total_ip_mapped_reads = 1000000 / pseudocount
     total_input_mapped_reads = 1000000 / input_pseudocount
-    density_df = density_df[density_df.sum(axis=1) > min_density_threshold]
-
+    # rows are kept by their raw sum (-1 boundaries included)
+    kept = density_df.sum(axis=1).values > min_density_threshold
 
     # get equivalent events for input and ip
-    df_indices = density_df.index
-    dfi_indices = input_density_df.index
-    missing = set(df_indices) - set(dfi_indices)
-    input_density_df = input_density_df.append(input_density_df.ix[missing])
-
-    rpm = clean(density_df)
-    rpmi = clean(input_density_df)
-
-    rpr = rpm / 1000000. + 1./total_input_mapped_reads
-    ripr = rpmi / 1000000. + 1./total_input_mapped_reads
+    rpr, boundaries, ripr, input_boundaries = _cleaned_pair(
+        density_df, input_density_df
+    )
 
-    en = rpr.multiply(np.log2(rpr.div(ripr)))
+    rpr /= 1000000.
+    rpr += 1./total_input_mapped_reads
+    ripr /= 1000000.
+    ripr += 1./total_input_mapped_reads
+
+    np.divide(rpr, ripr, out=ripr)
+    np.log2(ripr, out=ripr)
+    rpr *= ripr
+    en = _as_frame(_mask_boundaries(
+        rpr, boundaries | input_boundaries, kept
+    ), density_df)
     """
     TODO: deprecate this completely and remove.
     
@@ -259,10 +445,10 @@ def normalize_and_subtract(density_df, input_density_df,
     density_df = clean(density_df)
     input_density_df = clean(input_density_df)
 
-    pdf = calculate_pdf(
+    pdf, _ = calculate_pdf(
         density_df, pseudocount, min_density_threshold
     )
-    input_pdf = calculate_pdf(
+    input_pdf, _ = calculate_pdf(
         input_density_df, input_pseudocount, min_density_threshold
     )
 
@@ -293,23 +479,21 @@ def normalize_and_per_region_subtract(density_df, input_density_df,
     -------
     subtracted : pandas.DataFrame
     """
-    df_indices = density_df.index
-    dfi_indices = input_density_df.index
-    missing = set(df_indices) - set(dfi_indices)
-
-    input_density_df = input_density_df.append(input_density_df.ix[missing])
-
-    density_df = clean(density_df)
-    input_density_df = clean(input_density_df)
-
-    pdf = calculate_pdf(
-        density_df, pseudocount, min_density_threshold
+    pdf, boundaries, pdfi, input_boundaries = _cleaned_pair(
+        density_df, input_density_df
     )
-    pdfi = calculate_pdf(
-        input_density_df, input_pseudocount, min_density_threshold
+    pdf, kept = _pdf_values(
+        pdf, boundaries, pseudocount, min_density_threshold
     )
-    subtracted = pdf.sub(pdfi)
-    return subtracted
+    pdfi, input_kept = _pdf_values(
+        pdfi, input_boundaries, input_pseudocount, min_density_threshold
+    )
+    pdf -= pdfi
+    # rows either pdf dropped are NaN, rows both dropped are left out
+    subtracted = _mask_boundaries(
+        pdf, boundaries | input_boundaries, kept & input_kept
+    )
+    return _as_frame(subtracted, density_df)[kept | input_kept]
 
 
 def per_region_subtract_and_normalize(density_df, input_density_df,
@@ -335,19 +519,16 @@ def per_region_subtract_and_normalize(density_df, input_density_df,
     -------
     subtracted : pandas.DataFrame
     """
-    df_indices = density_df.index
-    dfi_indices = input_density_df.index
-    missing = set(df_indices) - set(dfi_indices)
-    input_density_df = input_density_df.append(input_density_df.ix[missing])
-    subtracted = clean(density_df).sub(clean(input_density_df))
-
-    pdf = calculate_abs_pdf(
-        density_df=subtracted,
-        pseudocount=pseudocount,
-        min_density_threshold=min_density_threshold
+    subtracted, boundaries, input_values, input_boundaries = _cleaned_pair(
+        density_df, input_density_df
     )
-    # pdf.to_csv('/oasis/tscc/scratch/bay001/pdf.csv')
-    return pdf
+    subtracted -= input_values
+    del input_values
+    boundaries |= input_boundaries
+    subtracted[boundaries] = 0
+
+    pdf, _ = _abs_pdf_values(subtracted, boundaries, pseudocount)
+    return _as_frame(_mask_boundaries(pdf, boundaries), density_df)
 
 
 def get_abs_sum(row, min_read):
@@ -381,7 +562,8 @@ def get_abs_sum(row, min_read):
     return summed
 
 
-def calculate_pdf(density_df, pseudocount=None, min_density_threshold=0):
+def calculate_pdf(density_df, pseudocount=None, min_density_threshold=0,
+                  rows=None):
     """
     Calculates the PDF of a density matrix (makes all rows sum to 1).
     Parameters
@@ -398,29 +580,32 @@ def calculate_pdf(density_df, pseudocount=None, min_density_threshold=0):
     min_density_threshold : int
         minimum total density_df across a row.
         (May be deprecated - possibly removed in the future)
+    rows : numpy.ndarray
+        boolean mask of the rows to keep, instead of filtering rows by
+        min_density_threshold (ie. the kept mask of another matrix with
+        the same rows, so the filter is shared and not recomputed).
     Returns
     -------
     pdf : pandas.DataFrame
         r x c matrix of densities normalized across each respective
         (r)ow as a probability density_df func.
+    kept : numpy.ndarray
+        True for each row of density_df that pdf keeps
     """
-    df = density_df
-    if misc.has_negative_values(df):
+    values, boundaries = _counted_values(density_df)
+    if (values < 0).any():
         print("This dataframe has negative values, "
               "use calculate_abs_pdf() function instead.")
         return 1
-
-    df = df[df.sum(axis=1) >= min_density_threshold]
-    min_read = pseudocount if pseudocount else min(
-        [item for item in df.unstack().values if item > 0]
+    pdf, kept = _pdf_values(
+        values, boundaries, pseudocount, min_density_threshold, rows
     )
-
-    df = df + min_read
-    pdf = df.div(df.sum(axis=1), axis=0)
-    return pdf  # , mean, sem
+    pdf = _as_frame(_mask_boundaries(pdf, boundaries), density_df)
+    return pdf[kept], kept
 
 
-def calculate_abs_pdf(density_df, pseudocount=None, min_density_threshold=0):
+def calculate_abs_pdf(density_df, pseudocount=None, min_density_threshold=0,
+                      rows=None):
     """
     Calculates the absolute "PDF" of a density matrix.
     This isn't really summing every row to 1, but will divide the native
@@ -449,30 +634,29 @@ def calculate_abs_pdf(density_df, pseudocount=None, min_density_threshold=0):
     pseudocount : float
         value added to the entire dataframe before calculating pdf.
     min_density_threshold : int
-        minimum total density_df across a row.
+        minimum total absolute density_df across a row.
         (deprecated - possibly removed in the future)
+    rows : numpy.ndarray
+        boolean mask of the rows to keep, instead of filtering rows by
+        min_density_threshold (ie. the kept mask of another matrix with
+        the same rows, so the filter is shared and not recomputed).
 
     Returns
     -------
     pdf : pandas.DataFrame
         r x c matrix of densities normalized across each respective
         (r)ow as a probability density_df func.
+    kept : numpy.ndarray
+        True for each row of density_df that pdf keeps
     """
 
     # df = clean(density_df)  # moved this out, it doesn't belong here and i don't think we use it ever
-    df = density_df
-
-    min_read = pseudocount if pseudocount else min(
-        [item for item in df.unstack().values if item > 0]
+    values, boundaries = _counted_values(density_df)
+    pdf, kept = _abs_pdf_values(
+        values, boundaries, pseudocount, min_density_threshold, rows
     )
-    summed = df.apply(get_abs_sum, axis=1, args=(min_read,))
-    try:
-        pdf = df.div(summed, axis=0)
-    except ZeroDivisionError:
-        print("Warning: zero division error encountered in calculating absolute PDF.")
-        return 1
-
-    return pdf  # , mean, sem
+    pdf = _as_frame(_mask_boundaries(pdf, boundaries), density_df)
+    return pdf[kept], kept
 
 
 def get_means_and_sems_with_merged(df, conf=0.95):
@@ -497,34 +681,106 @@ def get_means_and_sems_with_merged(df, conf=0.95):
     std_deviation: list
         standard deviation of the mean
     merged : pandas.DataFrame
-        dataframe 'masked' of outliers
+        dataframe 'masked' of outliers (see: outlier_mask())
     """
-
-    means = []
-    sems = []
-    std_deviation = []
-    
-    merged = pd.DataFrame(index=df.index)
-    for key, value in df.iteritems():
-        single_col = df[key].dropna()
-        single_col = single_col.sort_values()
-        nums = len(single_col)
-        droppercent = (1 - conf) / 2.0
-
-        dropnum = int(round(nums * droppercent))
-        if dropnum > 0:
-            single_col = single_col[dropnum:-dropnum]
-        merged = pd.merge(
-            merged, pd.DataFrame(single_col), how='left',
-            left_index=True, right_index=True
-        )
-        means.append(single_col.mean())
-        sems.append(single_col.sem())
-        std_deviation.append(single_col.std())
+    mask = outlier_mask(df.values, conf)
+    merged = df.where(mask)
+    means = list(merged.mean())
+    sems = list(merged.sem())
+    std_deviation = list(merged.std())
 
     return means, sems, std_deviation, merged
 
 
+def outlier_mask(values, conf=0.95):
+    """
+    Returns which values of a matrix are kept after dropping NaNs and the
+    int(round(nums * (1 - conf) / 2)) lowest and highest values of each
+    column (where nums is the number of non-NaN values in that column).
+
+    Every column is ranked at once (ties are ranked in row order), so the
+    cutoffs of all columns are compared to the ranks in one step.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D (events x positions) matrix of densities or values
+    conf : float
+        keep {conf}% of densities present at every given position
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        (events x positions) boolean mask, False for outliers and NaNs
+    """
+    # one contiguous row per position. NaNs are sorted (and so ranked)
+    # after every value of their column.
+    values = np.ascontiguousarray(np.asarray(values, dtype=np.float64).T)
+    order = np.argsort(values, axis=1, kind='mergesort')
+    ranks = np.empty(values.shape, dtype=np.intp)
+    np.put_along_axis(ranks, order, np.arange(values.shape[1]), axis=1)
+    nums = (~np.isnan(values)).sum(axis=1)[:, np.newaxis]
+    # python rounds halves away from zero, np.round rounds them to even.
+    dropnums = np.floor(nums * ((1 - conf) / 2.0) + 0.5).astype(int)
+    return ((ranks >= dropnums) & (ranks < nums - dropnums)).T
+
+
+def trimmed_means_and_sems(values, conf=0.95):
+    """
+    Returns the mean, standard error and standard deviation of each column
+    of a matrix after dropping NaNs and trimming the (1-conf)/2 lowest and
+    highest values of each column (int(nums * droppercent) values from each
+    side, where nums is the number of non-NaN values in that column).
+
+    Columns are sorted all at once and columns sharing the same number of
+    non-NaN values are reduced together, adding their values in the same
+    (sorted) order as pandas.Series.mean/sem/std would.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D (events x positions) matrix of densities or values
+    conf : float
+        keep {conf}% of densities present at every given position
+
+    Returns
+    -------
+    means : numpy.ndarray
+        mean value for each column
+    sems : numpy.ndarray
+        standard error of the mean for each column
+    std_deviation : numpy.ndarray
+        standard deviation for each column
+    """
+    # one contiguous row per position, sorted with NaNs last.
+    values = np.array(np.asarray(values, dtype=np.float64).T)
+    values.sort(axis=1)
+    nums = (~np.isnan(values)).sum(axis=1)
+    droppercent = (1 - conf) / 2.0
+    dropnums = (nums * droppercent).astype(int)
+
+    means = np.empty(values.shape[0])
+    means.fill(np.nan)
+    sems = means.copy()
+    std_deviation = means.copy()
+
+    for num in np.unique(nums):
+        cols = np.flatnonzero(nums == num)
+        dropnum = dropnums[cols[0]]
+        kept = values[cols, dropnum:num - dropnum]
+        count = float(kept.shape[1])
+        if count == 0:
+            continue
+        means[cols] = kept.sum(axis=1, dtype=np.float64) / count
+        if count <= 1:
+            continue
+        sqr = (means[cols][:, np.newaxis] - kept) ** 2
+        variance = sqr.sum(axis=1, dtype=np.float64) / (count - 1)
+        std_deviation[cols] = np.sqrt(variance)
+        sems[cols] = np.sqrt(variance) / np.sqrt(count)
+    return means, sems, std_deviation
+
+
 def get_means_and_sems(df, conf=0.95):
     """
     Sets the means and standard error values after outlier
@@ -549,28 +805,8 @@ def get_means_and_sems(df, conf=0.95):
     None : None
         used to be a merged dataframe, bt merging slows stuff down
     """
-
-    means = []
-    sems = []
-    std_deviation = []
-    # merged = pd.DataFrame(index=df.index)
-    for key, value in df.iteritems():
-        single_col = df[key].dropna()
-        single_col = single_col.sort_values()
-        nums = len(single_col)
-        droppercent = (1 - conf) / 2.0
-        dropnum = int(nums * droppercent)
-        # print('dropping {} events'.format(dropnum))
-        if dropnum > 0:
-            single_col = single_col[dropnum:-dropnum]
-        # merged = pd.merge(
-        #     merged, pd.DataFrame(single_col), how='left',
-        #     left_index=True, right_index=True
-        # )
-        means.append(single_col.mean())
-        sems.append(single_col.sem())
-        std_deviation.append(single_col.std())
-    return means, sems, std_deviation, None
+    means, sems, std_deviation = trimmed_means_and_sems(df.values, conf)
+    return list(means), list(sems), list(std_deviation), None
 
 
 def median_bottom_top_values_from_dataframe(df, bottom_percent=0.5, top_percent=0.5):
@@ -615,6 +851,48 @@ def median_bottom_top_values_from_dataframe(df, bottom_percent=0.5, top_percent=
     return bottom_values, top_values
 
 
+def bottom_top_values(values, bottom_percent=0.5, top_percent=0.5):
+    """
+    Returns the bottom and top % value of each column in a matrix, ignoring
+    NaNs (the int(bottom_percent% * nums)-th smallest and the
+    int(top_percent% * nums)-th largest values of each column).
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D matrix (ie. permutations x positions)
+    bottom_percent: float
+        bottom percent (the bottom 25% would be bottom_percent=25)
+    top_percent: float
+        top percent (the top 25% would be top_percent=25)
+
+    Returns
+    -------
+    bottom_values : numpy.ndarray
+    top_values : numpy.ndarray
+        NaN for columns without any values.
+    """
+    values = np.sort(np.asarray(values, dtype=np.float64), axis=0)
+    nums = (~np.isnan(values)).sum(axis=0)
+    bottom_subset = (bottom_percent * 0.01 * nums).astype(int)
+    top_subset = (top_percent * 0.01 * nums).astype(int)
+    # same as single_col.iloc[bottom_subset-1]: 0 wraps around to the end.
+    bottom_rows = np.where(bottom_subset > 0, bottom_subset - 1, nums - 1)
+    top_rows = nums - top_subset
+
+    bottom_values = np.empty(values.shape[1])
+    bottom_values.fill(np.nan)
+    top_values = bottom_values.copy()
+    cols = np.arange(values.shape[1])
+    has_values = nums > 0
+    bottom_values[has_values] = values[
+        bottom_rows[has_values], cols[has_values]
+    ]
+    has_top = has_values & (top_rows < nums)
+    top_values[has_top] = values[top_rows[has_top], cols[has_top]]
+    return bottom_values, top_values
+
+
 def bottom_top_values_from_dataframe(df, bottom_percent=0.5, top_percent=0.5):
     """
     This takes a dataframe and computes the bottom and top % for each
@@ -635,27 +913,10 @@ def bottom_top_values_from_dataframe(df, bottom_percent=0.5, top_percent=0.5):
     bottom_values : list
     top_values : list
     """
-    bottom_values = []
-    top_values = []
-    for key, value in df.iteritems():
-        # get true percentage
-        bottom_actual_percent = bottom_percent * 0.01
-        top_actual_percent = top_percent * 0.01
-        # foreach column, drop nans and get the number of starting events, sorted.
-        single_col = df[key].dropna()
-        single_col = single_col.sort_values()
-        nums = len(single_col)
-        # collect top (top subset) 0.5% and bottom 0.5% of values
-        bottom_subset = int(bottom_actual_percent * nums)
-        top_subset = int(top_actual_percent * nums)
-        # get the bottom/top 0.5%
-
-        bottom = single_col.iloc[bottom_subset-1]
-        top = single_col.iloc[len(single_col)-top_subset]
-        # append to list of bottom/top values
-        bottom_values.append(bottom)
-        top_values.append(top)
-    return bottom_values, top_values
+    bottom_values, top_values = bottom_top_values(
+        df.values, bottom_percent, top_percent
+    )
+    return list(bottom_values), list(top_values)
 
 
 ### Normalize peak methods ###
@@ -673,19 +934,21 @@ def divide_by_num_events(some_list, num_events):
     ----------
     some_list: list
         list of values
-    num_events: list
-        list of event numbers to divide some_list at each position
+    num_events: list or numpy.ndarray
+        event numbers to divide some_list at each position
+        (see: matrix.count_events())
 
     Returns
     -------
     normed_list: list
-        list containing value / number of events at each position.
+        list containing value / number of events at each position
+        (NaN or inf at positions without any events).
     """
-    normed_list = []
     # some_list_ps = [x+1 for x in some_list] # remove pseudocount, uncomment to add back in
-    for value, num_event in zip(some_list, num_events):
-        normed_list.append(float(value) / num_event)
-    return normed_list
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normed = np.asarray(some_list, dtype=np.float64) / \
+                 np.asarray(num_events, dtype=np.float64)
+    return list(normed)
 
 
 def std_error(some_list, num_events):
@@ -695,19 +958,18 @@ def std_error(some_list, num_events):
     Parameters
     ----------
     some_list : list
-    num_events : list
-
+    num_events : list or numpy.ndarray
+        number of events at each position (see: matrix.count_events())
 
     Returns
     -------
-
+    devs : list
+        dev() of each position
     """
-    devs = []
-    p_list = divide_by_num_events(some_list, num_events)
-    q_list = [1 - p for p in p_list]
-    for p, q, e in zip(p_list, q_list, num_events):
-        devs.append(dev(p, q, e))
-    return devs
+    p = np.array(divide_by_num_events(some_list, num_events))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        devs = np.sqrt(p * (1 - p)) / np.sqrt(num_events)
+    return list(devs)
 
 
 def dev(p, q, n):
@@ -730,34 +992,231 @@ def dev(p, q, n):
     return math.sqrt(p * q) / math.sqrt(n)
 
 
-def permutation_normalization(test_matrix, bg_matrix, num_events):
-    # TODO: pull out of map.py permutation testing
-    subset_iterations = []
-    iterations = 1000  # how many random samplings to take.
-    percentile = 0.5  # the extreme % value from which to take the median of. (out of 1000 values, take the median of the top and bottom 0.5%, or 5)
-    progress = trange(iterations)
-    for i in range(0, iterations):
-        # since event_num is reported as a list across all positions, simply get the average for now.
-        mean_event_num = int(
-            sum(num_events) / float(len(num_events))
-        )
-        rand_subset = Feature.get_random_sample(
-            bg_matrix, mean_event_num
+def _sort_columns(values):
+    """
+    Sorts each column of a matrix (NaNs last).
+
+    Returns
+    -------
+    sorted_values : numpy.ndarray
+        each column sorted, with NaNs replaced by 0
+    order : numpy.ndarray
+        int32 row of values that each sorted value comes from
+        (-1 for NaNs)
+    """
+    order = np.argsort(values, axis=0, kind='mergesort').astype(np.int32)
+    sorted_values = values[order, np.arange(values.shape[1])]
+    order[np.isnan(sorted_values)] = -1
+    return np.nan_to_num(sorted_values), order
+
+
+def presort_background(bg_matrix):
+    """
+    Prepares a background matrix for permuted_trimmed_means().
+
+    Parameters
+    ----------
+    bg_matrix : pandas.DataFrame
+
+    Returns
+    -------
+    background : tuple
+        (values with NaNs replaced by 0, 1.0 where values are not NaN,
+        ascending (sorted_values, order), descending (sorted_values, order))
+        see: _sort_columns()
+    """
+    values = np.asarray(bg_matrix, dtype=np.float64)
+    return (
+        np.nan_to_num(values), (~np.isnan(values)).astype(np.float64),
+        _sort_columns(values), _sort_columns(-values)
+    )
+
+
+def _tail_sums(sorted_values, order, draws, tails):
+    """
+    Returns the sum of the {tails} smallest values drawn from each column.
+
+    Parameters
+    ----------
+    sorted_values : numpy.ndarray
+    order : numpy.ndarray
+        see: _sort_columns()
+    draws : numpy.ndarray
+        (num samples x num rows + 1) number of times each row was drawn
+        (the last column is 0, for NaNs)
+    tails : numpy.ndarray
+        (num samples x num positions) number of values to add up
+
+    Returns
+    -------
+    sums : numpy.ndarray
+        (num samples x num positions)
+    """
+    num_rows = order.shape[0]
+    # the smallest values come from the first few ranks, so only look
+    # further when a column hasn't drawn enough values in them yet.
+    ranks = min(num_rows, TAIL_RANKS)
+    while True:
+        counts = draws[:, order[:ranks]].cumsum(axis=1, dtype=np.int32)
+        if ranks == num_rows or (counts[:, -1, :] >= tails).all():
+            break
+        ranks = min(num_rows, ranks * 2)
+    kept = np.minimum(counts, tails[:, np.newaxis, :])
+    kept[:, 1:, :] -= kept[:, :-1, :].copy()
+    return (kept * sorted_values[:ranks]).sum(axis=1)
+
+
+def permuted_trimmed_means(background, samples, conf=0.95):
+    """
+    Returns the outlier-removed means (see: trimmed_means_and_sems()) of
+    many random samples of rows from the same matrix at once.
+
+    Each sample is turned into the number of times it drew each row. Sums
+    are then the product of these counts with the matrix, and the
+    int(nums * droppercent) smallest and largest values of each position
+    are found in the presorted columns of the matrix rather than by sorting
+    every sample.
+
+    Parameters
+    ----------
+    background : tuple
+        see: presort_background()
+    samples : numpy.ndarray
+        (num samples x num rows in each sample) row indices
+    conf : float
+        keep {conf}% of densities present at every given position
+
+    Returns
+    -------
+    means : numpy.ndarray
+        (num samples x num positions) trimmed means
+    """
+    values, present, lowest, highest = background
+    num_samples = samples.shape[0]
+    num_rows = values.shape[0]
+    droppercent = (1 - conf) / 2.0
+
+    draws = np.bincount(
+        (samples + num_rows * np.arange(num_samples)[:, np.newaxis]).ravel(),
+        minlength=num_samples * num_rows
+    ).reshape(num_samples, num_rows)
+    nums = np.dot(draws, present).astype(int)
+    totals = np.dot(draws, values)
+    dropnums = (nums * droppercent).astype(int)
+
+    draws = np.hstack(
+        [draws, np.zeros((num_samples, 1), dtype=draws.dtype)]
+    ).astype(np.int32)
+    trimmed = totals - _tail_sums(
+        lowest[0], lowest[1], draws, dropnums
+    ) + _tail_sums(  # highest values are sorted as -values
+        highest[0], highest[1], draws, dropnums
+    )
+    kept = nums - 2 * dropnums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = trimmed / kept
+    means[kept <= 0] = np.nan
+    return means
+
+
+_PERMUTATION_BACKGROUND = []
+
+
+def _set_permutation_background(background):
+    """
+    Stores the presorted background in each worker process
+    (see: permutation_bounds())
+    """
+    _PERMUTATION_BACKGROUND[:] = [background]
+
+
+def _permute(samples, conf):
+    """
+    Returns the trimmed means of a batch of samples (see:
+    permuted_trimmed_means()) of the worker process' background.
+    """
+    return permuted_trimmed_means(_PERMUTATION_BACKGROUND[0], samples, conf)
+
+
+def permutation_bounds(
+        bg_matrix, num_events, num_permutations=1000, conf=0.95,
+        boundary_percent=0.5, seed=None, cores=1
+):
+    """
+    Randomly samples (with replacement) num_events events from a background
+    matrix num_permutations times, and returns the bottom and top
+    boundary_percent% of the outlier-removed means of these samples at each
+    position. The random samples are all drawn up front from a single seed,
+    so the boundaries do not depend on the number of cores.
+
+    Parameters
+    ----------
+    bg_matrix : pandas.DataFrame
+        normed background matrix
+    num_events : int
+        number of events in each random sample
+    num_permutations : int
+        number of random samples
+    conf : float
+        keep {conf}% of densities present at every given position
+    boundary_percent : float
+        the extreme % value from which to (out of 1000 values, take the top
+        and bottom 0.5%, or 5)
+    seed : int or numpy.random.RandomState
+        seed for numpy.random.RandomState (default: None, unseeded), or the
+        RandomState to draw the samples from (ie. one shared by several
+        calls, so that each draws different samples)
+    cores : int
+        number of processes used to calculate the sample means
+
+    Returns
+    -------
+    bottom_values : numpy.ndarray
+    top_values : numpy.ndarray
+    means : pandas.DataFrame
+        (num_permutations x positions) outlier-removed means of each sample
+    """
+    background = presort_background(bg_matrix)
+    if not isinstance(seed, np.random.RandomState):
+        seed = np.random.RandomState(seed)
+    samples = seed.randint(
+        0, bg_matrix.shape[0], size=(num_permutations, num_events)
+    )
+    batch_size = max(1, PERMUTATION_BATCH_SIZE // max(1, bg_matrix.size))
+    batches = [
+        samples[start:start + batch_size]
+        for start in range(0, num_permutations, batch_size)
+    ]
+    progress = trange(num_permutations, desc='permutations')
+    if cores <= 1:
+        results = []
+        for batch in batches:
+            results.append(permuted_trimmed_means(background, batch, conf))
+            progress.update(batch.shape[0])
+    else:
+        pool = multiprocessing.Pool(
+            cores, initializer=_set_permutation_background,
+            initargs=(background, )
         )
-        # remove outliers
-        means, _, _, _ = norm.get_means_and_sems(rand_subset, conf=0.95)
-        subset_iterations.append(pd.Series(means))
-        progress.update(1)
-
-    # concatenate all "lines" (means of outlier-removed normalized data)
-    df = pd.concat(subset_iterations, axis=1).T
-    df.to_csv(tsv, sep='\t')
-    bottom_values_condition, top_values_condition = norm.median_bottom_top_values_from_dataframe(
-        df, percentile, percentile
+        try:
+            results = [
+                pool.apply_async(
+                    _permute, (batch, conf),
+                    callback=lambda _, n=batch.shape[0]: progress.update(n)
+                ) for batch in batches
+            ]
+            pool.close()
+            results = [result.get() for result in results]
+        finally:
+            pool.terminate()
+            pool.join()
+    progress.close()
+
+    means = pd.DataFrame(np.vstack(results), columns=bg_matrix.columns)
+    bottom_values, top_values = bottom_top_values(
+        means.values, boundary_percent, boundary_percent
     )
-    # replace max/min defaults if nonetypes were found in any position
-    bottom_values = [np.nan if (x == MAX_VAL or x == MIN_VAL) else x for x in bottom_values]
-    top_values = [np.nan if (x == MAX_VAL or x == MIN_VAL) else x for x in top_values]
+    return bottom_values, top_values, means
 
 
 def calculate_num_events(df, legacy=True):
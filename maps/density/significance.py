@@ -0,0 +1,349 @@
+#!/bin/env python
+
+"""
+Created on May 27, 2019
+
+Module that tests every position (column) of a condition matrix against the
+same position of a background matrix at once, instead of calling scipy.stats
+once per position.
+
+Both matrices are outlier trimmed with normalization_functions.outlier_mask()
+(the mask get_means_and_sems_with_merged() uses), and the trimmed columns are
+ranked together as rows of one array, so the U and D statistics (and
+p-values) of all positions come out as arrays that match
+scipy.stats.mannwhitneyu() and scipy.stats.ks_2samp() run on each position's
+trimmed values.
+
+Main Functions
+--------------
+trimmed_columns : sorted, outlier trimmed values of every column of a matrix
+mannwhitneyu : Mann-Whitney U test of every position
+ks_2samp : 2-sample Kolmogorov-Smirnov test of every position
+fisher_exact : two sided Fisher exact test of every position's 2x2 table
+zscores : z-score of every position's mean against the background
+"""
+import numpy as np
+from scipy import stats
+import normalization_functions as norm
+
+BATCH_SIZE = 2 ** 24  # max (positions x values) ranked at once
+EPSILON = 1 - 1e-4  # scipy.stats.fisher_exact() relative tolerance for ties
+PMF_CACHE_SIZE = 1024  # hypergeometric tables kept between calls
+
+_pmf_tables = {}
+
+
+def trimmed_columns(values, conf=0.95, mask=None):
+    """
+    Returns the values of each column of a matrix that are kept after
+    outlier removal (see: norm.outlier_mask()), sorted.
+
+    Parameters
+    ----------
+    values : numpy.ndarray or pandas.DataFrame
+        2D (events x positions) matrix of densities or values
+    conf : float
+        keep {conf}% of densities present at every given position
+    mask : numpy.ndarray
+        norm.outlier_mask() of values, if it has already been computed
+
+    Returns
+    -------
+    trimmed : numpy.ndarray
+        (positions x events) array, one row per column of values, with the
+        trimmed values first (in ascending order) followed by NaNs
+    counts : numpy.ndarray
+        the number of trimmed values of each column
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if mask is None:
+        mask = norm.outlier_mask(values, conf)
+    counts = mask.sum(axis=0)
+    # one contiguous row per position, sorted with NaNs last.
+    trimmed = np.where(mask, values, np.nan).T
+    trimmed.sort(axis=1)
+    width = counts.max() if len(counts) else 0
+    return trimmed[:, :width], counts
+
+
+def _batches(num_positions, width):
+    """
+    Yields slices of positions to rank together, so that no more than
+    BATCH_SIZE values are ranked at once.
+    """
+    step = max(1, BATCH_SIZE // max(width, 1))
+    for start in range(0, num_positions, step):
+        yield slice(start, start + step)
+
+
+def _ranked(test, background):
+    """
+    Ranks the trimmed rows of test and background (see: trimmed_columns)
+    together, one row (position) at a time.
+
+    Returns
+    -------
+    in_test : numpy.ndarray
+        for each sorted value of each row, True if it came from test
+    valid : numpy.ndarray
+        False for the NaNs (sorted last) that pad each row
+    first : numpy.ndarray
+        sorted index of the first value tied with each value
+    last : numpy.ndarray
+        sorted index of the last value tied with each value
+    """
+    combined = np.concatenate([test, background], axis=1)
+    order = np.argsort(combined, axis=1, kind='mergesort')
+    combined = np.take_along_axis(combined, order, axis=1)
+    in_test = order < test.shape[1]
+    valid = ~np.isnan(combined)
+
+    index = np.arange(combined.shape[1])
+    starts = np.ones(combined.shape, dtype=bool)
+    starts[:, 1:] = combined[:, 1:] != combined[:, :-1]
+    ends = np.ones(combined.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, index, 0), axis=1)
+    last = np.minimum.accumulate(
+        np.where(ends, index, combined.shape[1])[:, ::-1], axis=1
+    )[:, ::-1]
+    return in_test, valid, first, last
+
+
+def _trimmed_pair(test_values, bg_values, conf, test_mask, bg_mask):
+    """
+    Returns trimmed_columns() of a condition and a background matrix.
+    """
+    test, n1 = trimmed_columns(test_values, conf, test_mask)
+    background, n2 = trimmed_columns(bg_values, conf, bg_mask)
+    if test.shape[0] != background.shape[0]:
+        raise ValueError(
+            "condition ({}) and background ({}) have a different number "
+            "of positions".format(test.shape[0], background.shape[0])
+        )
+    return test, n1.astype(np.float64), background, n2.astype(np.float64)
+
+
+def mannwhitneyu(test_values, bg_values, conf=0.95, alternative='greater',
+                 test_mask=None, bg_mask=None):
+    """
+    Mann-Whitney U test (with tie and continuity correction) of the trimmed
+    values of every position of test_values against the same position of
+    bg_values, as scipy.stats.mannwhitneyu() would give for each position.
+
+    Parameters
+    ----------
+    test_values : numpy.ndarray or pandas.DataFrame
+        (events x positions) condition matrix
+    bg_values : numpy.ndarray or pandas.DataFrame
+        (events x positions) background matrix
+    conf : float
+        keep {conf}% of values present at every given position
+    alternative : basestring
+        'greater', 'less' or 'two-sided'
+    test_mask : numpy.ndarray
+        norm.outlier_mask() of test_values, if it has already been computed
+    bg_mask : numpy.ndarray
+        norm.outlier_mask() of bg_values, if it has already been computed
+
+    Returns
+    -------
+    u : numpy.ndarray
+        U statistic of bg_values at each position
+    p : numpy.ndarray
+        p-value at each position (NaN where every value is identical)
+    """
+    test, n1, background, n2 = _trimmed_pair(
+        test_values, bg_values, conf, test_mask, bg_mask
+    )
+    rank_sums = np.empty(len(n1))
+    tie_sums = np.empty(len(n1))
+    for rows in _batches(len(n1), test.shape[1] + background.shape[1]):
+        in_test, valid, first, last = _ranked(test[rows], background[rows])
+        ranks = (first + last) / 2.0 + 1
+        rank_sums[rows] = np.where(in_test & valid, ranks, 0).sum(axis=1)
+        # each group of t ties adds t * (t ** 2 - 1), once for every value
+        ties = (last - first + 1).astype(np.float64)
+        tie_sums[rows] = np.where(valid, ties ** 2 - 1, 0).sum(axis=1)
+
+    size = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tie_correction = np.where(
+            size < 2, 1.0, 1.0 - tie_sums / (size ** 3 - size)
+        )
+        u1 = n1 * n2 + (n1 * (n1 + 1)) / 2.0 - rank_sums
+        u2 = n1 * n2 - u1
+        sd = np.sqrt(tie_correction * n1 * n2 * (n1 + n2 + 1) / 12.0)
+        sd[tie_correction == 0] = np.nan
+        meanrank = n1 * n2 / 2.0 + 0.5
+        if alternative == 'two-sided':
+            z = (np.maximum(u1, u2) - meanrank) / sd
+            p = 2 * stats.norm.sf(np.abs(z))
+        elif alternative == 'less':
+            p = stats.norm.sf((u1 - meanrank) / sd)
+        elif alternative == 'greater':
+            p = stats.norm.sf((u2 - meanrank) / sd)
+        else:
+            raise ValueError("alternative should be 'less', 'greater' "
+                             "or 'two-sided'")
+    if (tie_correction == 0).any():
+        print("Warning: all numbers are identical at positions: {}".format(
+            list(np.flatnonzero(tie_correction == 0))
+        ))
+    return u2, p
+
+
+def ks_2samp(test_values, bg_values, conf=0.95, test_mask=None,
+             bg_mask=None):
+    """
+    Two sided 2-sample Kolmogorov-Smirnov test of the trimmed values of
+    every position of test_values against the same position of bg_values,
+    as scipy.stats.ks_2samp() would give for each position.
+
+    Parameters
+    ----------
+    test_values : numpy.ndarray or pandas.DataFrame
+        (events x positions) condition matrix
+    bg_values : numpy.ndarray or pandas.DataFrame
+        (events x positions) background matrix
+    conf : float
+        keep {conf}% of values present at every given position
+    test_mask : numpy.ndarray
+        norm.outlier_mask() of test_values, if it has already been computed
+    bg_mask : numpy.ndarray
+        norm.outlier_mask() of bg_values, if it has already been computed
+
+    Returns
+    -------
+    d : numpy.ndarray
+        KS statistic at each position
+    p : numpy.ndarray
+        p-value at each position
+    """
+    test, n1, background, n2 = _trimmed_pair(
+        test_values, bg_values, conf, test_mask, bg_mask
+    )
+    d = np.empty(len(n1))
+    for rows in _batches(len(n1), test.shape[1] + background.shape[1]):
+        in_test, valid, first, last = _ranked(test[rows], background[rows])
+        # empirical cdfs at each value (counting every value tied with it)
+        in_test &= valid
+        cdf1 = np.take_along_axis(np.cumsum(in_test, axis=1), last, axis=1)
+        cdf2 = np.take_along_axis(
+            np.cumsum(valid & ~in_test, axis=1), last, axis=1
+        )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.abs(
+                cdf1 / n1[rows, np.newaxis] - cdf2 / n2[rows, np.newaxis]
+            )
+        distances[~valid] = 0
+        d[rows] = distances.max(axis=1) if distances.shape[1] else 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        en = np.sqrt(n1 * n2 / (n1 + n2))
+        p = stats.kstwobign.sf((en + 0.12 + 0.11 / en) * d)
+    return d, p
+
+
+def _hypergeom_table(total, good, draws):
+    """
+    Returns the hypergeometric pmf of drawing 0..draws good items (out of
+    good) in draws draws from total items, along with its cumulative sums
+    from the left (cdf) and from the right (sf). Tables are cached by their
+    marginals, so positions (and lines) that share them also share tables.
+    """
+    key = (total, good, draws)
+    if key not in _pmf_tables:
+        if len(_pmf_tables) >= PMF_CACHE_SIZE:
+            _pmf_tables.clear()
+        pmf = np.exp(stats.hypergeom.logpmf(
+            np.arange(draws + 1), total, good, draws
+        ))
+        _pmf_tables[key] = pmf, np.cumsum(pmf), np.cumsum(pmf[::-1])[::-1]
+    return _pmf_tables[key]
+
+
+def fisher_exact(tables):
+    """
+    Two sided Fisher exact test of many 2x2 contingency tables, as
+    scipy.stats.fisher_exact() would give for each table.
+
+    Tables that share their marginals are tested together against the same
+    hypergeometric table (see: _hypergeom_table()), so for a peak line the
+    work grows with the number of distinct peak counts, not positions.
+
+    Parameters
+    ----------
+    tables : numpy.ndarray
+        (positions x 2 x 2) array of counts (truncated to integers)
+
+    Returns
+    -------
+    oddsratio : numpy.ndarray
+    p : numpy.ndarray
+    """
+    counts = np.asarray(tables, dtype=np.int64).reshape(-1, 2, 2)
+    if (counts < 0).any():
+        raise ValueError("All values in `table` must be nonnegative.")
+    a, b = counts[:, 0, 0], counts[:, 0, 1]
+    c, d = counts[:, 1, 0], counts[:, 1, 1]
+    n1, n2, n = a + b, c + d, a + c
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratio = np.where(
+            (c > 0) & (b > 0), a * d / (c * b).astype(np.float64), np.inf
+        )
+    p = np.ones(len(a))
+    tested = (n1 > 0) & (n2 > 0) & (n > 0) & (b + d > 0)
+    oddsratio[~tested] = np.nan
+
+    marginals = np.stack([n1 + n2, n1, n], axis=1)[tested]
+    if not len(marginals):
+        return oddsratio, p
+    marginals, groups = np.unique(marginals, axis=0, return_inverse=True)
+    positions = np.flatnonzero(tested)
+    for group, (total, good, draws) in enumerate(marginals):
+        rows = positions[groups == group]
+        pmf, cdf, sf = _hypergeom_table(total, good, draws)
+        k = a[rows]
+        mode = int((draws + 1) * (good + 1) / float(total + 2))
+        pexact = pmf[k]
+        threshold = pexact / EPSILON
+        lower = k < mode
+        # the pmf rises up to the mode and falls after it, so the tables
+        # at least as extreme as k on the other side of the mode are a tail
+        first = mode + 1 + np.searchsorted(
+            -pmf[mode + 1:], -threshold, side='left'
+        )
+        last = np.searchsorted(pmf[:mode], threshold, side='right')
+        upper_tail = np.append(sf, 0)[first]
+        lower_tail = np.where(last > 0, cdf[np.maximum(last - 1, 0)], 0)
+        pvalue = np.where(
+            lower, cdf[k] + upper_tail, sf[k] + lower_tail
+        )
+        pmode = pmf[mode]
+        close = np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= \
+            1 - EPSILON
+        p[rows] = np.where(close, 1., np.minimum(pvalue, 1.0))
+    return oddsratio, p
+
+
+def zscores(means, bg_means, bg_std):
+    """
+    Returns the z-score of each position's mean against the mean and
+    standard deviation of the background at that position.
+
+    Parameters
+    ----------
+    means : list
+    bg_means : list
+    bg_std : list
+
+    Returns
+    -------
+    z_scores : numpy.ndarray
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.asarray(means, dtype=np.float64) -
+                np.asarray(bg_means, dtype=np.float64)) / \
+               np.asarray(bg_std, dtype=np.float64)
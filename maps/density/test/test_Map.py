@@ -3,8 +3,15 @@
 import os
 import pytest
 import pybedtools
+import pickle
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from density import Map
+from density import intervals
 from density import Peak
+from density import ReadDensity
+from density import normalization_functions as norm
 from pandas.testing import assert_series_equal
 
 ### Fixtures ###
@@ -12,6 +19,30 @@ curdir = os.path.dirname(__file__)
 
 ### These are for testing the interval/boundary regions.
 
+@pytest.fixture()
+def get_test_rbp():
+    return ReadDensity.ReadDensity(
+        pos=os.path.join(curdir, 'test_intervals/test_2000bp.pos.bw'),
+        neg=os.path.join(curdir, 'test_intervals/test_2000bp.neg.bw')
+    )
+
+@pytest.fixture()
+def get_se_annotations(tmpdir):
+    """ two small miso skipped exon files over the test_2000bp bigwigs """
+    a = tmpdir.join('a.miso')
+    a.write(
+        'event_name\n'
+        'chr1:51:100:+@chr1:301:350:+@chr1:501:600:+\n'
+        'chr1:101:150:-@chr1:401:450:-@chr1:801:900:-\n'
+        'chr1:11:60:+@chr1:201:250:+@chr1:1001:1100:+\n'
+    )
+    b = tmpdir.join('b.miso')
+    b.write(
+        'event_name\n'
+        'chr1:51:100:+@chr1:351:400:+@chr1:501:600:+\n'
+    )
+    return OrderedDict([(str(a), 'miso'), (str(b), 'miso')])
+
 @pytest.fixture()
 def get_peak_pos_chr1_0_10():
     return Peak.Peak(os.path.join(curdir, 'test_Peak/a_pos_chr1_0_10.bed.bb'))
@@ -155,4 +186,387 @@ def test_peak_values_p7():
     test_series = test_peak.values(
         'chr1', 0, 20, '+'
     )
-    assert_series_equal(test_series, expect_series)
\ No newline at end of file
+    assert_series_equal(test_series, expect_series)
+
+class ListBigBed:
+    """ stands in for an open bigbed, since pyBigWig can't write them """
+    def __init__(self, beds, lengths):
+        self.beds = beds
+        self.lengths = lengths
+
+    def chroms(self, chrom=None):
+        return self.lengths if chrom is None else self.lengths.get(chrom)
+
+    def entries(self, chrom, start, end):
+        entries = [
+            (s, e, '\t'.join(rest)) for c, s, e, rest in self.beds
+            if c == chrom and s < end and e > start
+        ]
+        return entries if len(entries) > 0 else None
+
+def test_peak_values_index():
+    print("peak values from the sorted peak arrays should be the same as "
+          "summing intervals.get_overlap() over each overlapping peak.")
+    beds = [
+        ('chr1', 0, 10, ('a', '0', '+')),
+        ('chr1', 5, 15, ('c', '0', '+')),
+        ('chr1', 40, 100, ('g', '0', '+')),
+        ('chr1', 5, 15, ('d', '0', '-')),
+        ('chr1', 12, 30, ('h', '.', '-')),
+        ('chr2', 0, 10, ('b', '0', '+')),
+    ]
+    test_peak = Peak.Peak(os.path.join(curdir, 'test_Peak/missing.bb'))
+    test_peak.peaks = ListBigBed(beds, {'chr1': 200, 'chr2': 50})
+    windows = [(0, 20), (9, 14), (10, 15), (0, 6), (30, 120), (0, 200)]
+    for score_type in ['simple', 'fraction_region', 'fraction_peak']:
+        for start, end in windows:
+            for strand in ['+', '-']:
+                region = pybedtools.create_interval_from_list(
+                    ['chr1', str(start), str(end), '.', '0', strand]
+                )
+                expect_series = pd.Series(data=0, index=range(end - start))
+                for c, s, e, rest in beds:
+                    if c == 'chr1' and rest[2] == strand and s < end and e > start:
+                        peak = pybedtools.create_interval_from_list(
+                            [c, str(s), str(e)] + list(rest)
+                        )
+                        expect_series += intervals.get_overlap(
+                            peak, region, score_type
+                        )
+                test_series = test_peak.values(
+                    'chr1', start, end, strand, score_type=score_type
+                )
+                # (weighted scores are floats even where no peaks overlap)
+                assert_series_equal(test_series, expect_series,
+                                    check_dtype=score_type == 'simple')
+    # missing chromosomes are all zeros
+    assert_series_equal(
+        test_peak.values('chr3', 0, 5, '+'), pd.Series([0, 0, 0, 0, 0])
+    )
+    matrix = test_peak.values_batch(
+        ['chr1', 'chr1', 'chr2'], [0, 9, 0], [20, 14, 10], ['+', '-', '+']
+    )
+    assert list(matrix[1, :5]) == list(test_peak.values('chr1', 9, 14, '-'))
+    assert list(matrix[2, :10]) == [1] * 10
+
+def test_peak_values_flatten():
+    print("overlapping peaks should be combined by their sum, min or max "
+          "score, and scored by their (numeric) names with region_name.")
+    beds = [
+        ('chr1', 0, 10, ('2.5', '0', '+')),
+        ('chr1', 5, 15, ('1', '0', '+')),
+        ('chr1', 8, 9, ('4', '0', '+')),
+    ]
+    test_peak = Peak.Peak(os.path.join(curdir, 'test_Peak/missing.bb'),
+                          score_type='region_name', flatten='max')
+    test_peak.peaks = ListBigBed(beds, {'chr1': 200})
+    expect = {
+        'sum': [2.5] * 5 + [3.5] * 3 + [7.5, 3.5] + [1] * 5 + [0] * 5,
+        'min': [2.5] * 5 + [1] * 10 + [0] * 5,
+        'max': [2.5] * 8 + [4, 2.5] + [1] * 5 + [0] * 5,
+    }
+    for flatten, values in expect.items():
+        assert_series_equal(
+            test_peak.values('chr1', 0, 20, '+', flatten=flatten),
+            pd.Series(values, dtype=float)
+        )
+        assert_series_equal(
+            test_peak.values('chr1', 0, 20, '-', flatten=flatten),
+            pd.Series([0.0] * 20)
+        )
+    assert_series_equal(
+        test_peak.values('chr1', 0, 20, '+', flatten=True,
+                         score_type='simple'),
+        pd.Series([1] * 15 + [0] * 5)
+    )
+    # values_batch() uses the peak's own score_type and flatten
+    matrix = test_peak.values_batch(
+        ['chr1', 'chr1'], [0, 6], [20, 10], ['+', '+'], offsets=[0, 3]
+    )
+    assert list(matrix[0]) == expect['max']
+    assert list(matrix[1, 3:7]) == expect['max'][6:10]
+    assert np.all(np.isnan(matrix[1, :3]))
+
+def test_peak_preload(monkeypatch):
+    print("a preloaded peak file shouldn't need its bigbed anymore, even "
+          "after being pickled.")
+    beds = [
+        ('chr1', 0, 10, ('a', '0', '+')),
+        ('chr1', 5, 15, ('d', '0', '-')),
+    ]
+    lengths = {'chr1': 200, 'chr2': 50}
+    monkeypatch.setattr(
+        Peak.pyBigWig, 'open', lambda f: ListBigBed(beds, lengths)
+    )
+    test_peak = Peak.Peak('peaks.bb', preload=True)
+    assert sorted(test_peak._peak_index.keys()) == [
+        ('chr1', '+'), ('chr1', '-'), ('chr2', '+'), ('chr2', '-')
+    ]
+    monkeypatch.setattr(
+        Peak.pyBigWig, 'open', lambda f: ListBigBed([], lengths)
+    )
+    unpickled = pickle.loads(pickle.dumps(test_peak))
+    assert_series_equal(
+        unpickled.values('chr1', 8, 12, '-'), pd.Series([1, 1, 1, 1])
+    )
+    assert unpickled.overlaps('chr1', 8, 12, '+')
+    assert not unpickled.overlaps('chr1', 15, 20, '+')
+
+def test_build_matrices_same_density(tmpdir):
+    print("when ip and input are the same object, the input matrix should "
+          "be a copy of the ip matrix instead of being built again.")
+    annotations = get_se_annotations(tmpdir)
+    rbp = get_test_rbp()
+    map_obj = Map.SkippedExon(
+        rbp, rbp, str(tmpdir.join('map.svg')), norm.get_density, annotations
+    )
+    built = []
+
+    def builder(**kwargs):
+        built.append(kwargs)
+        return pd.DataFrame([[1.0, 2.0]]), None
+
+    jobs = OrderedDict([
+        ('ip', (builder, dict(annotation='a', density=rbp))),
+        ('input', (builder, dict(annotation='a', density=rbp))),
+    ])
+    matrices = map_obj.build_matrices(jobs)
+    assert len(built) == 1
+    assert list(matrices.keys()) == ['ip', 'input']
+    assert matrices['ip'][0].equals(matrices['input'][0])
+    assert matrices['ip'][0] is not matrices['input'][0]
+
+    jobs['input'] = (builder, dict(annotation='a', density=get_test_rbp()))
+    map_obj.build_matrices(jobs)
+    assert len(built) == 3
+
+def test_build_matrices_shared_plan(tmpdir, monkeypatch):
+    print("the ip and input matrices of an annotation should be read from "
+          "windows computed once, and match building each one on its own.")
+    annotations = get_se_annotations(tmpdir)
+    ip, inp = get_test_rbp(), get_test_rbp()
+    map_obj = Map.SkippedExon(
+        ip, inp, str(tmpdir.join('map.svg')), norm.get_density, annotations
+    )
+    planned = []
+
+    def plan(**kwargs):
+        planned.append(kwargs['annotation'])
+        return Map.mtx.skipped_exon_plan(**kwargs)
+
+    monkeypatch.setitem(Map.mtx.PLANS, Map.mtx.skipped_exon, plan)
+    map_obj.create_matrices()
+    assert planned == list(annotations.keys())
+    for filename, filetype in annotations.items():
+        for clip, density in [('ip', ip), ('input', inp)]:
+            expected, _ = Map.mtx.skipped_exon(
+                filename, density, 50, 300, filetype
+            )
+            assert map_obj.raw_matrices[clip][filename].equals(expected)
+
+def test_create_matrices_cache_dir(tmpdir):
+    print("the parsed regions of each annotation should only be cached in "
+          "the map's cache_dir, if it has one.")
+    annotations = get_se_annotations(tmpdir)
+    Map.SkippedExon(
+        get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+        norm.get_density, annotations
+    ).create_matrices()
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'a.miso', 'b.miso'
+    ]
+    cache_dir = tmpdir.join('cache')
+    Map.SkippedExon(
+        get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+        norm.get_density, annotations, cache_dir=str(cache_dir)
+    ).create_matrices()
+    assert sorted(f.basename.split('.')[0] for f in cache_dir.listdir()) == [
+        'a', 'b'
+    ]
+
+### test building matrices in parallel ###
+
+def test_read_density_pickle():
+    rbp = get_test_rbp()
+    unpickled = pickle.loads(pickle.dumps(rbp))
+    assert unpickled.values('chr1', 95, 105, '-') == \
+        rbp.values('chr1', 95, 105, '-')
+
+def test_create_matrices_cores(tmpdir):
+    print("building matrices with several processes should give the same "
+          "matrices as building them one by one.")
+    annotations = get_se_annotations(tmpdir)
+    matrices = []
+    for cores in [1, 3]:
+        map_obj = Map.SkippedExon(
+            get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+            norm.get_density, annotations, cores=cores
+        )
+        map_obj.create_matrices()
+        matrices.append(map_obj.raw_matrices)
+    for clip in ['ip', 'input']:
+        for annotation in annotations.keys():
+            assert matrices[0][clip][annotation].shape == \
+                matrices[1][clip][annotation].shape
+            assert matrices[0][clip][annotation].equals(
+                matrices[1][clip][annotation]
+            )
+
+def test_create_matrices_chunks(tmpdir, monkeypatch):
+    print("splitting annotations into chunks of events should give the "
+          "same matrices (and in the same order) as building them at once.")
+    monkeypatch.setattr(Map, 'EVENTS_PER_CHUNK', 2)
+    annotations = get_se_annotations(tmpdir)
+    bed = tmpdir.join('regions.bed')
+    bed.write(
+        'chr1\t50\t60\tshort\t0\t+\n'
+        'chr1\t100\t350\tlong\t0\t-\n'
+        'chr1\t400\t410\tshort2\t0\t+\n'
+    )
+    maps = []
+    for cores in [1, 2]:
+        maps.append([
+            Map.SkippedExon(
+                get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+                norm.get_density, annotations, cores=cores
+            ),
+            Map.Bed(
+                get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+                norm.get_density, OrderedDict([(str(bed), 'bed')]),
+                cores=cores
+            )
+        ])
+        for map_obj in maps[-1]:
+            map_obj.create_matrices()
+    for serial, chunked in zip(maps[0], maps[1]):
+        for clip in ['ip', 'input']:
+            for annotation in serial.annotation.keys():
+                assert serial.raw_matrices[clip][annotation].equals(
+                    chunked.raw_matrices[clip][annotation]
+                )
+
+def test_create_matrices_events(tmpdir, monkeypatch):
+    print("matrices should be indexed by event id, and each event only "
+          "named (in the event table) once, even across chunks.")
+    monkeypatch.setattr(Map, 'EVENTS_PER_CHUNK', 1)
+    bed = tmpdir.join('regions.bed')
+    bed.write(
+        'chr1\t50\t60\tshort\t0\t+\n'
+        'chr1\t100\t110\tlong\t0\t-\n'
+        'chr1\t50\t60\tshort\t0\t+\n'
+    )
+    for cores in [1, 2]:
+        map_obj = Map.Bed(
+            get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+            norm.get_density, OrderedDict([(str(bed), 'bed')]), cores=cores
+        )
+        map_obj.create_matrices()
+        matrix = map_obj.raw_matrices['ip'][str(bed)]
+        events = map_obj.events[str(bed)]
+        assert list(matrix.index) == [0, 1]
+        assert list(events['name']) == [
+            'chr1:50-60:short:+', 'chr1:100-110:long:-'
+        ]
+        assert list(events['start']) == [50, 100]
+        assert list(events['strand']) == ['+', '-']
+        assert list(matrix.iloc[1]) == [4.0] * 10
+        assert (matrix.dtypes == 'float32').all()
+
+
+def test_permutation_sample_size(tmpdir, monkeypatch):
+    print("the background should be sampled as many events as the "
+          "condition has, even if some of its positions are padded.")
+    condition = tmpdir.join('condition.bed')
+    condition.write(
+        'chr1\t100\t110\tshort\t0\t+\n'
+        'chr1\t200\t230\tlong\t0\t+\n'
+        'chr1\t300\t320\tmedium\t0\t-\n'
+    )
+    background = tmpdir.join('background.bed')
+    background.write(''.join(
+        'chr1\t{}\t{}\tbg{}\t0\t+\n'.format(start, start + 30, start)
+        for start in range(400, 1400, 100)
+    ))
+    sample_sizes = []
+    permutation_bounds = norm.permutation_bounds
+
+    def recorded_permutation_bounds(bg_matrix, num_events, **kwargs):
+        sample_sizes.append(num_events)
+        return permutation_bounds(bg_matrix, num_events, **kwargs)
+
+    monkeypatch.setattr(
+        norm, 'permutation_bounds', recorded_permutation_bounds
+    )
+    # there's no bam to normalize the pseudocount by
+    monkeypatch.setattr(
+        ReadDensity.ReadDensity, 'pseudocount', lambda self: 0.1
+    )
+    map_obj = Map.MultiLengthBed(
+        get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+        norm.get_density,
+        OrderedDict([(str(condition), 'bed'), (str(background), 'bed')]),
+        upstream_offset=20, downstream_offset=20
+    )
+    map_obj.create_matrices()
+    map_obj.normalize_matrix()
+    map_obj.create_lines()
+    assert min(map_obj.num_events['ip'][str(condition)]) < 3
+    map_obj.set_background_and_calculate_significance(
+        [str(condition)], str(background), 'permutation',
+        num_permutations=10, seed=1
+    )
+    assert sample_sizes == [3]
+
+
+def test_permutation_seed(tmpdir, monkeypatch):
+    print("conditions with as many events should each be compared to "
+          "different random samples of the background, which are the same "
+          "every time with the same seed.")
+    conditions = []
+    for name in ['condition1', 'condition2']:
+        condition = tmpdir.join('{}.bed'.format(name))
+        condition.write(
+            'chr1\t100\t130\t{0}a\t0\t+\n'
+            'chr1\t200\t230\t{0}b\t0\t+\n'.format(name)
+        )
+        conditions.append(str(condition))
+    background = tmpdir.join('background.bed')
+    background.write(''.join(
+        'chr1\t{}\t{}\tbg{}\t0\t+\n'.format(start, start + 30, start)
+        for start in range(0, 2000, 50)
+    ))
+    samples = []
+    permutation_bounds = norm.permutation_bounds
+
+    def recorded_permutation_bounds(bg_matrix, num_events, **kwargs):
+        bounds = permutation_bounds(bg_matrix, num_events, **kwargs)
+        samples.append(bounds[2])
+        return bounds
+
+    monkeypatch.setattr(
+        norm, 'permutation_bounds', recorded_permutation_bounds
+    )
+    # there's no bam to normalize the pseudocount by
+    monkeypatch.setattr(
+        ReadDensity.ReadDensity, 'pseudocount', lambda self: 0.1
+    )
+    annotation = OrderedDict(
+        [(condition, 'bed') for condition in conditions] +
+        [(str(background), 'bed')]
+    )
+    for _ in range(2):
+        map_obj = Map.MultiLengthBed(
+            get_test_rbp(), get_test_rbp(), str(tmpdir.join('map.svg')),
+            norm.get_density, annotation,
+            upstream_offset=20, downstream_offset=20
+        )
+        map_obj.create_matrices()
+        map_obj.normalize_matrix()
+        map_obj.create_lines()
+        map_obj.set_background_and_calculate_significance(
+            conditions, str(background), 'permutation',
+            num_permutations=10, seed=1
+        )
+    assert not samples[0].equals(samples[1])
+    assert samples[0].equals(samples[2])
+    assert samples[1].equals(samples[3])
@@ -1,10 +1,12 @@
 #!/usr/env python
 
+import hashlib
 import os
 import pandas as pd
 import pybedtools
 import pytest
 from density import Feature
+from density import annotations
 
 ### Fixtures ###
 
@@ -174,3 +176,72 @@ def test_a3ss_rmats_feature():
                 assert is_longer(alt1, alt2)
                 assert shares_strand(alt1, alt2)
                 assert shares_a3ss_boundary(alt1, alt2)
+
+
+def test_read_regions():
+    print("regions read from whole annotation files at once should be the "
+          "same as reading each event with its Feature.")
+    for annotation, event, annotation_type in [
+        (a3ss_file_rmats, 'a3ss', 'rmats'),
+        (a5ss_file_rmats, 'a5ss', 'rmats'),
+        (mxe_file_rmats, 'mxe', 'rmats'),
+        (ri_file_rmats, 'ri', 'rmats'),
+        (se_file_miso, 'se', 'miso'),
+    ]:
+        names, regions = annotations.read_regions(
+            annotation, event, annotation_type
+        )
+        assert len(names) == len(set(names))
+        for region, intervals in zip(
+                regions,
+                annotations._feature_regions(names, event, annotation_type)
+        ):
+            assert region.equals(intervals)
+
+
+def test_read_regions_cache(tmpdir):
+    print("regions read again from their cache should be the same as the "
+          "parsed regions, and should be parsed again if the file changes.")
+    annotation = tmpdir.join('A3SS.MATS.JunctionCountOnly.txt')
+    with open(a3ss_file_rmats) as f:
+        lines = f.readlines()
+    annotation.write(''.join(lines[:200]))
+    cache_dir = tmpdir.join('cache')
+    parsed = annotations.read_regions(
+        str(annotation), 'a3ss', 'rmats', str(cache_dir)
+    )
+    assert len(cache_dir.listdir()) == 1
+    cached = annotations.read_regions(
+        str(annotation), 'a3ss', 'rmats', str(cache_dir)
+    )
+    assert list(cached[0]) == list(parsed[0])
+    for region, parsed_region in zip(cached[1], parsed[1]):
+        assert region.equals(parsed_region)
+
+    annotation.write(''.join(lines[:100]))
+    names, regions = annotations.read_regions(
+        str(annotation), 'a3ss', 'rmats', str(cache_dir)
+    )
+    assert list(names) == list(parsed[0][:99])
+    assert regions[0].equals(parsed[1][0].iloc[:99])
+    assert len(cache_dir.listdir()) == 1
+
+    print("sidecars of files whose names start with this file's prefix "
+          "shouldn't be removed as stale.")
+    path = hashlib.md5(str(annotation)).hexdigest()
+    other = tmpdir.join(
+        'A3SS.MATS.JunctionCountOnly.txt.{}.a3ss.rmats.x'.format(path)
+    )
+    other.write(''.join(lines[:50]))
+    annotations.read_regions(str(other), 'a3ss', 'rmats', str(cache_dir))
+    annotation.write(''.join(lines[:200]))
+    annotations.read_regions(str(annotation), 'a3ss', 'rmats', str(cache_dir))
+    assert len(cache_dir.listdir()) == 2
+    other.remove()
+
+    print("without a cache_dir, nothing should be written.")
+    annotations.read_regions(str(annotation), 'se', 'rmats')
+    assert len(cache_dir.listdir()) == 2
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'A3SS.MATS.JunctionCountOnly.txt', 'cache'
+    ]
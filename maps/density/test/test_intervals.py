@@ -3,6 +3,8 @@
 import os
 import pytest
 import pybedtools
+import pyBigWig
+import numpy as np
 import pandas as pd
 from density import intervals
 from density import ReadDensity
@@ -443,6 +445,250 @@ def test_junction_site_3(neg_chr1_95_100, neg_chr1_105_115, get_test_rbp):
     assert wiggle == [-4, -4, -4, -4, -4, -4, -4]
 
 
+### batched fetches ###
+
+def test_values_batch_1(get_test_rbp):
+    # overlapping and adjacent windows on both strands
+    batch = get_test_rbp.values_batch(
+        ['chr1', 'chr1', 'chr1', 'chr1'],
+        [95, 100, 95, 295],
+        [105, 110, 105, 305],
+        ['+', '+', '-', '-']
+    )
+    assert batch.shape == (4, 10)
+    np.testing.assert_array_equal(
+        batch[0], get_test_rbp.values('chr1', 95, 105, '+')
+    )
+    np.testing.assert_array_equal(
+        batch[1], get_test_rbp.values('chr1', 100, 110, '+')
+    )
+    np.testing.assert_array_equal(
+        batch[2], get_test_rbp.values('chr1', 95, 105, '-')
+    )
+    np.testing.assert_array_equal(
+        batch[3], get_test_rbp.values('chr1', 295, 305, '-')
+    )
+
+
+@pytest.fixture()
+def get_small_bigwigs(tmpdir):
+    """ pos/neg bigwigs over a 2000bp chromosome with the test_2000bp values """
+    curdir = os.path.dirname(__file__)
+    filenames = []
+    for strand in ['pos', 'neg']:
+        original = pyBigWig.open(
+            os.path.join(curdir, 'test_intervals/test_2000bp.{}.bw'.format(strand))
+        )
+        filename = str(tmpdir.join('small.{}.bw'.format(strand)))
+        small = pyBigWig.open(filename, 'w')
+        small.addHeader([('chr1', 2000)])
+        entries = original.intervals('chr1', 0, 2000)
+        small.addEntries(
+            ['chr1'] * len(entries),
+            [e[0] for e in entries],
+            ends=[min(e[1], 2000) for e in entries],
+            values=[e[2] for e in entries]
+        )
+        small.close()
+        filenames.append(filename)
+    return filenames
+
+
+def test_cached_values_1(get_test_rbp, get_small_bigwigs, tmpdir):
+    pos, neg = get_small_bigwigs
+    cache_dir = tmpdir.join('cache')
+    cached_rbp = ReadDensity.CachedReadDensity(
+        pos=pos, neg=neg, cache_dir=str(cache_dir)
+    )
+    for start, end, strand in [(95, 105, '+'), (95, 105, '-'),
+                               (295, 305, '-'), (0, 2000, '+')]:
+        np.testing.assert_array_equal(
+            cached_rbp.values('chr1', start, end, strand),
+            get_test_rbp.values('chr1', start, end, strand)
+        )
+    # runs off of the chromosome
+    assert len(cached_rbp.values('chr1', 1995, 2005, '+')) == 10
+    assert np.all(np.isnan(cached_rbp.values('chr1', 1995, 2005, '+')))
+    assert len(cache_dir.listdir()) == 2
+
+
+def test_cached_values_2(get_small_bigwigs, tmpdir, monkeypatch):
+    # a cache that can only hold one chromosome evicts the older one
+    monkeypatch.setattr(ReadDensity.ChromosomeCache, 'min_age', 0)
+    pos, neg = get_small_bigwigs
+    cache_dir = tmpdir.join('cache')
+    cached_rbp = ReadDensity.CachedReadDensity(
+        pos=pos, neg=neg, cache_dir=str(cache_dir), max_cache_size=1
+    )
+    cached_rbp.values('chr1', 0, 10, '+')
+    cached_rbp.values('chr1', 0, 10, '-')
+    assert len(cache_dir.listdir()) == 1
+    assert list(cached_rbp.values('chr1', 0, 10, '+')) == [3] * 10
+
+
+def test_cached_values_3(get_small_bigwigs, tmpdir):
+    # but never a chromosome used in the last min_age seconds
+    pos, neg = get_small_bigwigs
+    cache_dir = tmpdir.join('cache')
+    cached_rbp = ReadDensity.CachedReadDensity(
+        pos=pos, neg=neg, cache_dir=str(cache_dir), max_cache_size=1
+    )
+    cached_rbp.values('chr1', 0, 10, '+')
+    cached_rbp.values('chr1', 0, 10, '-')
+    assert len(cache_dir.listdir()) == 2
+
+
+def test_cached_values_4(get_small_bigwigs, tmpdir, monkeypatch):
+    # a chromosome evicted by another process after it was found is decoded
+    # again
+    pos, neg = get_small_bigwigs
+    cache_dir = tmpdir.join('cache')
+    ReadDensity.CachedReadDensity(
+        pos=pos, neg=neg, cache_dir=str(cache_dir)
+    ).values('chr1', 0, 10, '+')
+    utime = os.utime
+
+    def evict_then_utime(path, times):
+        if os.path.exists(path) and not evicted:
+            evicted.append(path)
+            os.remove(path)
+        utime(path, times)
+    evicted = []
+    monkeypatch.setattr(ReadDensity.os, 'utime', evict_then_utime)
+    cached_rbp = ReadDensity.CachedReadDensity(
+        pos=pos, neg=neg, cache_dir=str(cache_dir)
+    )
+    assert list(cached_rbp.values('chr1', 0, 10, '+')) == [3] * 10
+    assert len(evicted) == 1
+    assert len(cache_dir.listdir()) == 1
+
+
+def test_junction_sites_1(
+        pos_chr1_0_10, pos_chr1_15_20, neg_chr1_95_100, neg_chr1_105_115,
+        get_test_rbp
+):
+    batch = intervals.three_prime_sites(
+        get_test_rbp,
+        [pos_chr1_15_20, neg_chr1_95_100],
+        [pos_chr1_0_10, neg_chr1_105_115],
+        2, 8
+    )
+    assert list(batch[0]) == list(intervals.three_prime_site(
+        get_test_rbp, pos_chr1_15_20, pos_chr1_0_10, 2, 8
+    ))
+    assert list(batch[1]) == list(intervals.three_prime_site(
+        get_test_rbp, neg_chr1_95_100, neg_chr1_105_115, 2, 8
+    ))
+    batch = intervals.five_prime_sites(
+        get_test_rbp,
+        [pos_chr1_0_10, neg_chr1_105_115],
+        [pos_chr1_15_20, neg_chr1_95_100],
+        5, 5
+    )
+    assert list(batch[0]) == list(intervals.five_prime_site(
+        get_test_rbp, pos_chr1_0_10, pos_chr1_15_20, 5, 5
+    ))
+    assert list(batch[1]) == list(intervals.five_prime_site(
+        get_test_rbp, neg_chr1_105_115, neg_chr1_95_100, 5, 5
+    ))
+
+
+def test_junction_sites_out_1(
+        pos_chr1_0_10, pos_chr1_15_20, neg_chr1_95_100, neg_chr1_105_115,
+        get_test_rbp
+):
+    """ sites can be written straight into the columns of a float32 matrix """
+    out = np.zeros((2, 30), dtype=np.float32)
+    batch = intervals.five_prime_sites(
+        get_test_rbp,
+        [pos_chr1_0_10, neg_chr1_105_115],
+        [pos_chr1_15_20, neg_chr1_95_100],
+        5, 5, out=out[:, 10:20]
+    )
+    expected = intervals.five_prime_sites(
+        get_test_rbp,
+        [pos_chr1_0_10, neg_chr1_105_115],
+        [pos_chr1_15_20, neg_chr1_95_100],
+        5, 5
+    )
+    np.testing.assert_array_equal(batch, expected)
+    np.testing.assert_array_equal(out[:, 10:20], expected)
+    assert (out[:, :10] == 0).all() and (out[:, 20:] == 0).all()
+
+
+def test_junction_sites_unreadable_1(get_test_rbp):
+    """ sites on a chromosome missing from the bigwig are 0, as in values() """
+    upstream = pybedtools.create_interval_from_list(
+        ['chrZ', '0', '10', 'current', '0', '+']
+    )
+    downstream = pybedtools.create_interval_from_list(
+        ['chrZ', '15', '20', 'current', '0', '+']
+    )
+    batch = intervals.five_prime_sites(
+        get_test_rbp, [upstream], [downstream], 5, 5
+    )
+    expected = intervals.five_prime_site(
+        get_test_rbp, upstream, downstream, 5, 5
+    )
+    assert list(batch[0]) == list(expected)
+    assert (batch == 0).all()
+
+
+@pytest.mark.parametrize("strand", ['+', '-'])
+def test_values_batch_unreadable_1(get_small_bigwigs, strand):
+    """
+    windows running off the end of the chromosome are NaN (like values()),
+    without losing the windows merged into the same block as them
+    """
+    pos, neg = get_small_bigwigs
+    rbp = ReadDensity.ReadDensity(pos=pos, neg=neg)
+    out = np.empty((2, 10))
+    out.fill(-1)
+    batch = rbp.values_batch(
+        ['chr1', 'chr1'], [1985, 1995], [1995, 2005], [strand, strand],
+        out=out
+    )
+    np.testing.assert_array_equal(
+        batch[0], rbp.values('chr1', 1985, 1995, strand)
+    )
+    assert np.isnan(batch[1]).all()
+
+
+
+@pytest.mark.parametrize("exon_junction_site", ['3p', '5p'])
+@pytest.mark.parametrize("stop_at_midpoint", [False, True])
+def test_junction_sites_coords_1(exon_junction_site, stop_at_midpoint):
+    """ windows computed at once should match the per-interval windows """
+    rng = np.random.RandomState(0)
+    current, neighbors = [], []
+    for i in range(500):
+        start = rng.randint(0, 200)
+        end = start + rng.randint(0, 30)
+        strand = '+' if rng.rand() < 0.5 else '-'
+        current.append(pybedtools.create_interval_from_list(
+            ['chr1', str(start), str(end), 'i', '0', strand]
+        ))
+        if rng.rand() < 0.2:
+            neighbors.append(None)
+        else:
+            next_start = rng.randint(0, 200)
+            neighbors.append(pybedtools.create_interval_from_list(
+                ['chr1', str(next_start),
+                 str(next_start + rng.randint(0, 30)), 'n', '0', strand]
+            ))
+    for exon_offset, intron_offset in [(0, 0), (3, 4), (11, 0), (50, 300)]:
+        batch = intervals._junction_sites_coords(
+            neighbors, current, exon_offset, intron_offset,
+            exon_junction_site, stop_at_midpoint
+        )
+        expected = [
+            intervals._junction_site_coords(
+                neighbor, interval, exon_offset, intron_offset,
+                exon_junction_site, stop_at_midpoint
+            ) for neighbor, interval in zip(neighbors, current)
+        ]
+        for test, expect in zip(batch, zip(*expected)):
+            assert list(test) == list(expect)
 
 
 ### multiply by 100 tests ###
@@ -466,3 +712,46 @@ def test_get_scale_3(some_large_series_not_divisible):
 
 def test_get_scale_4(some_large_series_divisible):
     assert len(intervals.get_scale(some_large_series_divisible)) % 100 == 0
+
+
+def test_get_scales_1():
+    # expected values are from the original (per position) get_scale loop
+    scaled = intervals.get_scales(
+        [range(10), [5, 7, 9], range(7), [2], [1, 2, 3, 4]], scale_to=4
+    )
+    assert scaled.shape == (5, 4)
+    assert list(scaled[0]) == [0.5, 2.5, 5.0, 8.0]
+    assert list(scaled[1]) == [5.0, 5.666666666666667, 7.0, 9.0]
+    assert list(scaled[2]) == [0.0, 1.5, 3.5, 5.5]
+    assert list(scaled[3]) == [2, 2, 2, 2]
+    assert list(scaled[4]) == [1, 2, 3, 4]
+
+
+def test_get_scales_2():
+    scaled = intervals.get_scales(
+        [range(0, 1023), range(0, 1000)], scale_to=100
+    )
+    assert list(scaled[0, :3]) == [4.5, 14.5, 24.5]
+    assert list(scaled[0, -3:]) == [996.5, 1006.5, 1017.0]
+    assert list(scaled[1, :2]) == [4.0, 13.5]
+    # ragged rows (left-aligned in a matrix) are the same as a list
+    matrix = np.zeros((2, 1023))
+    matrix[0] = range(0, 1023)
+    matrix[1, :1000] = range(0, 1000)
+    np.testing.assert_array_equal(
+        intervals.get_scales(matrix, [1023, 1000]), scaled
+    )
+
+
+def test_clean_and_add_padding_1():
+    """ abs values, nans to 0 and pads, written into part of a buffer """
+    expected = [-1, -1, 1, 0, 2.5, -1]
+    assert list(intervals._clean_and_add_padding(
+        [-1, np.nan, 2.5], 2, 1
+    )) == expected
+    out = np.zeros(8)
+    wiggle = intervals._clean_and_add_padding(
+        np.array([-1, np.nan, 2.5]), 2, 1, out=out[1:7]
+    )
+    assert list(wiggle) == expected
+    assert list(out) == [0] + expected + [0]
@@ -1,10 +1,13 @@
 #!/usr/env python
 
 import os
+import numpy as np
 import pandas as pd
 import pybedtools
 import pytest
 from density import Feature
+from density import ReadDensity
+from density import matrix
 
 ### Fixtures ###
 
@@ -174,3 +177,175 @@ def test_a3ss_rmats_feature():
                 assert is_longer(alt1, alt2)
                 assert shares_strand(alt1, alt2)
                 assert shares_a3ss_boundary(alt1, alt2)
+
+
+def test_join_regions_1():
+    """
+    Tests that joining region matrices by event name gives the same
+    matrix as an outer merge of matrices labeled by event name.
+    """
+    regions = []
+    for names, value in [(['g3', 'g1'], 1), (['g2', 'g3'], 2), (['g0'], 3)]:
+        events = matrix.event_table(
+            names, ['chr1'] * len(names), [0] * len(names),
+            [10] * len(names), ['+'] * len(names)
+        )
+        region = pd.DataFrame(
+            np.arange(len(names) * 2).reshape(len(names), 2) + value * 10.
+        )
+        regions.append((region, events, matrix.count_events(region)))
+    joined, events, num_events = matrix.join_regions(regions)
+    merged = matrix.label_events(*regions[0][:2]).merge(
+        matrix.label_events(*regions[1][:2]),
+        how='outer', left_index=True, right_index=True
+    ).merge(
+        matrix.label_events(*regions[2][:2]),
+        how='outer', left_index=True, right_index=True
+    )
+    assert list(events['name']) == ['g0', 'g1', 'g2', 'g3']
+    np.testing.assert_array_equal(joined.values, merged.values)
+    assert list(matrix.label_events(joined, events).index) == \
+        list(merged.index)
+    assert list(num_events) == list(matrix.count_events(joined))
+
+
+def test_align_rows_1():
+    """
+    Tests that aligning an input matrix to the ip events gives the same
+    rows as reindexing the input matrix by event name.
+    """
+    ip_events = matrix.event_table(
+        ['g0', 'g1', 'g2', 'g3'], ['chr1'] * 4, [0] * 4, [10] * 4, ['+'] * 4
+    )
+    input_events = matrix.event_table(
+        ['g9', 'g2', 'g0', 'g3'], ['chr1'] * 4, [0] * 4, [10] * 4, ['+'] * 4
+    )
+    input_matrix = pd.DataFrame(
+        np.arange(6, dtype=np.float32).reshape(3, 2), index=[1, 2, 3]
+    )
+    aligned = matrix.align_rows(input_matrix, input_events, ip_events)
+    expected = matrix.label_events(input_matrix, input_events).reindex(
+        ip_events['name']
+    )
+    assert list(aligned.index) == [0, 1, 2, 3]
+    np.testing.assert_array_equal(aligned.values, expected.values)
+    assert np.isnan(aligned.values[1]).all()
+
+    assert matrix.align_rows(aligned, ip_events, ip_events) is aligned
+
+
+def test_count_events_1(monkeypatch):
+    """
+    Tests that events padded (-1) or missing (NaN) at a position aren't
+    counted there, whether or not the rows are counted in one block.
+    """
+    df = pd.DataFrame([
+        [-1, 0, 1, 2],
+        [np.nan, np.nan, 3, -1],
+        [0, 0, 0, 0]
+    ], dtype=np.float32)
+    num_events = matrix.count_events(df)
+    assert num_events.dtype == np.int32
+    assert list(num_events) == [1, 2, 3, 2]
+
+    monkeypatch.setattr(matrix, 'COUNT_ROWS', 2)
+    assert list(matrix.count_events(df)) == [1, 2, 3, 2]
+
+
+def test_build_with_plan_num_events_1(tmpdir):
+    """
+    Tests that the number of events counted while a matrix is built (from
+    its windows, or the rows of a scaled matrix) is what
+    count_events() counts on the built matrix, padded or not, and through
+    concat_chunks() of chunks that are scaled or repeat an event.
+    """
+    rbp = ReadDensity.ReadDensity(
+        pos=os.path.join(curdir, 'test_intervals/test_2000bp.pos.bw'),
+        neg=os.path.join(curdir, 'test_intervals/test_2000bp.neg.bw')
+    )
+    same_length = tmpdir.join('same_length.bed')
+    same_length.write(
+        'chr1\t100\t110\ta\t0\t+\n'
+        'chr1\t300\t310\tb\t0\t-\n'
+        'chrZ\t300\t310\tc\t0\t-\n'
+    )
+    different_length = tmpdir.join('different_length.bed')
+    different_length.write(
+        'chr1\t100\t110\ta\t0\t+\n'
+        'chr1\t200\t230\tb\t0\t+\n'
+        'chr1\t300\t300\tc\t0\t-\n'
+        'chr1\t400\t420\td\t0\t-\n'
+    )
+    builds = []
+    for bed in [same_length, different_length]:
+        builds.append((matrix.same_length_region, dict(
+            annotation=str(bed), annotation_type='bed', upstream_offset=5,
+            downstream_offset=5, scale=False
+        )))
+        builds.append((matrix.multi_length_regions, dict(
+            annotation=str(bed), annotation_type='bed', upstream_offset=20,
+            downstream_offset=20
+        )))
+    for builder, kwargs in builds:
+        (built, events, num_events), = matrix.build_with_plan(
+            builder, [rbp], **kwargs
+        )
+        assert num_events.dtype == np.int32
+        assert list(num_events) == list(matrix.count_events(built))
+
+    # the last chunk (scaled) repeats an event of the first
+    chunks = []
+    for lines in [['chr1\t200\t230\tb\t0\t+'],
+                  ['chr1\t100\t110\ta\t0\t+', 'chr1\t200\t230\tb\t0\t+',
+                   'chr1\t400\t420\td\t0\t-']]:
+        chunk = tmpdir.join('chunk{}.bed'.format(len(chunks)))
+        chunk.write('\n'.join(lines) + '\n')
+        chunks += matrix.build_with_plan(
+            matrix.same_length_region, [rbp], annotation=str(chunk),
+            annotation_type='bed', upstream_offset=0, downstream_offset=0,
+            scale=False
+        )
+    joined, events, num_events = matrix.concat_chunks(chunks)
+    assert len(joined) == 3
+    assert list(num_events) == list(matrix.count_events(joined))
+
+
+def test_read_intermediate_1(tmpdir):
+    """
+    Tests that matrices written to one .npz file are read back labeled by
+    event name, as they are when written to and read from csv.
+    """
+    events = matrix.event_table(
+        ['g0', 'g1', 'g2'], ['chr1', 'chr2', 'chr1'], [0, 5, 9],
+        [10, 15, 19], ['+', '-', '+']
+    )
+    raw = pd.DataFrame(
+        [[-1, 0.5, 1], [np.nan, 2, -1], [0, 0, 3]], dtype=np.float32
+    )
+    normed = raw.loc[[2, 0]]
+    sums = pd.Series([1.5, 2, 3], index=[0, 1, 2])
+    npz = str(tmpdir.join('a.intermediates.npz'))
+    matrix.write_intermediates(npz, {
+        'ip.raw_density': raw, 'normed_matrix': normed,
+        'ip.sum_coverage': sums
+    }, events)
+
+    csv = str(tmpdir.join('a.normed_matrix.txt'))
+    matrix.label_events(normed, events).to_csv(csv)
+    expected = matrix.read_intermediate(csv)
+    read = matrix.read_intermediate(npz)
+    assert list(read.index) == ['g2', 'g0']
+    assert list(read.index) == list(expected.index)
+    np.testing.assert_array_equal(read.values, expected.values)
+
+    read = matrix.read_intermediate(npz + ':ip.raw_density')
+    assert read.values.dtype == np.float32
+    np.testing.assert_array_equal(read.values, raw.values)
+    assert list(matrix.read_intermediate(npz, 'ip.sum_coverage')) == \
+        [1.5, 2, 3]
+    with pytest.raises(ValueError):
+        matrix.read_intermediate(npz, 'input.raw_density')
+
+    read_events = matrix.read_intermediate_events(npz)
+    for column in matrix.EVENT_COLUMNS:
+        assert list(read_events[column]) == list(events[column])
@@ -1,10 +1,12 @@
 #!/usr/env python
 
 import os
+import numpy as np
 import pandas as pd
 import pybedtools
 import pytest
 from density import Feature
+from density import normalization_functions as norm
 
 ### Fixtures ###
 
@@ -174,3 +176,210 @@ def test_a3ss_rmats_feature():
                 assert is_longer(alt1, alt2)
                 assert shares_strand(alt1, alt2)
                 assert shares_a3ss_boundary(alt1, alt2)
+
+
+def test_get_means_and_sems_1():
+    """
+    Tests that the (vectorized) outlier trimming drops int(nums * 0.025)
+    values from each end of every column, ignoring NaNs, exactly like
+    sorting and slicing each pandas column would.
+    """
+    df = pd.DataFrame({
+        'a': list(range(100)),
+        'b': [np.nan] * 50 + list(range(50)),
+        'c': [np.nan] * 99 + [3.0],
+        'd': [np.nan] * 100
+    }, columns=['a', 'b', 'c', 'd'])
+    means, sems, stds, merged = norm.get_means_and_sems(df, conf=0.95)
+    assert merged is None
+    expected = [df[col].dropna().sort_values() for col in df.columns]
+    expected[0] = expected[0][2:-2]
+    expected[1] = expected[1][1:-1]
+    for mean, sem, std, col in zip(means, sems, stds, expected):
+        np.testing.assert_array_equal(
+            [mean, sem, std], [col.mean(), col.sem(), col.std()]
+        )
+    assert means[0] == 49.5
+    assert means[2] == 3.0
+    assert np.isnan(sems[2])
+    assert np.isnan(means[3])
+
+
+def test_get_means_and_sems_2():
+    """
+    Tests that the trimmed means, sems and standard deviations are identical
+    to trimming each column separately with pandas.
+    """
+    rs = np.random.RandomState(0)
+    values = rs.randn(500, 20)
+    values[rs.rand(500, 20) < 0.3] = np.nan
+    df = pd.DataFrame(values)
+    means, sems, stds, _ = norm.get_means_and_sems(df, conf=0.9)
+    for i, col in df.iteritems():
+        col = col.dropna().sort_values()
+        dropnum = int(len(col) * 0.05)
+        col = col[dropnum:-dropnum]
+        assert means[i] == col.mean()
+        assert sems[i] == col.sem()
+        assert stds[i] == col.std()
+
+
+def test_permuted_trimmed_means_1():
+    """
+    Tests that the trimmed means of random samples drawn from a presorted
+    background are the same as those of the samples themselves.
+    """
+    rs = np.random.RandomState(0)
+    values = np.round(rs.randn(300, 10), 2)
+    values[rs.rand(300, 10) < 0.2] = np.nan
+    bg = pd.DataFrame(values)
+    samples = rs.randint(0, 300, size=(5, 120))
+    means = norm.permuted_trimmed_means(
+        norm.presort_background(bg), samples, conf=0.9
+    )
+    for sample, sample_means in zip(samples, means):
+        expected, _, _, _ = norm.get_means_and_sems(
+            bg.iloc[sample], conf=0.9
+        )
+        np.testing.assert_allclose(sample_means, expected, rtol=0, atol=1e-12)
+
+
+def test_bottom_top_values_1():
+    """
+    Tests that the bottom and top 10% are the 10th smallest and largest of
+    100 values, ignoring NaNs.
+    """
+    df = pd.DataFrame({
+        'a': list(range(100)) + [np.nan] * 10,
+        'b': list(range(100, 0, -1)) + [np.nan] * 10,
+        'c': [np.nan] * 110
+    }, columns=['a', 'b', 'c'])
+    bottom, top = norm.bottom_top_values_from_dataframe(df, 10, 10)
+    assert bottom[:2] == [9, 10]
+    assert top[:2] == [90, 91]
+    assert np.isnan(bottom[2]) and np.isnan(top[2])
+
+
+def test_permutation_bounds_1():
+    """
+    Tests that a seeded permutation test draws the same samples, no matter
+    how many processes calculate them.
+    """
+    rs = np.random.RandomState(0)
+    bg = pd.DataFrame(rs.randn(200, 15))
+    bottom, top, means = norm.permutation_bounds(
+        bg, 50, num_permutations=40, boundary_percent=5, seed=1
+    )
+    bottom2, top2, means2 = norm.permutation_bounds(
+        bg, 50, num_permutations=40, boundary_percent=5, seed=1, cores=2
+    )
+    assert means.shape == (40, 15)
+    np.testing.assert_array_equal(means.values, means2.values)
+    np.testing.assert_array_equal(bottom, bottom2)
+    np.testing.assert_array_equal(top, top2)
+    # the 2nd smallest/largest of the 40 means
+    np.testing.assert_array_equal(bottom, np.sort(means.values, axis=0)[1])
+    np.testing.assert_array_equal(top, np.sort(means.values, axis=0)[-2])
+
+
+def get_density_matrices():
+    """
+    Returns float32 ip and input matrices with NaNs (no density) and rows
+    ending early (-1), like the matrices built by matrix.py
+    """
+    rs = np.random.RandomState(0)
+    matrices = []
+    for _ in range(2):
+        values = (rs.exponential(1, (200, 40)) * (rs.rand(200, 40) < 0.5))
+        values = values.astype(np.float32)
+        values[rs.rand(200, 40) < 0.2] = np.nan
+        for row, end in enumerate(rs.randint(25, 41, size=200)):
+            values[row, end:] = -1
+        values[7] = 0
+        matrices.append(pd.DataFrame(values))
+    return matrices
+
+
+def test_normalization_kernels_1():
+    """
+    Tests that normalizing float32 matrices in place gives the same values
+    as cleaning and normalizing them as DataFrames, without changing the
+    matrices passed in.
+    """
+    ip, inp = get_density_matrices()
+    ip_copy, inp_copy = ip.copy(), inp.copy()
+    for threshold in [0, 5]:
+        pdf, _ = norm.calculate_pdf(norm.clean(ip), 0.3, threshold)
+        pdfi, _ = norm.calculate_pdf(norm.clean(inp), 0.2, threshold)
+        expected = pdf.sub(pdfi)
+        subtracted = norm.normalize_and_per_region_subtract(
+            ip, inp, 0.3, 0.2, threshold
+        )
+        assert subtracted.index.equals(expected.index)
+        np.testing.assert_array_equal(subtracted.values, expected.values)
+
+        expected = pdf.multiply(np.log2(pdf.div(pdfi)))
+        en = norm.pdf_entropy(ip, inp, 0.3, 0.2, threshold)
+        assert en.index.equals(expected.index)
+        np.testing.assert_array_equal(en.values, expected.values)
+
+    expected, _ = norm.calculate_abs_pdf(
+        norm.clean(ip).sub(norm.clean(inp)), 0.3
+    )
+    pdf = norm.per_region_subtract_and_normalize(ip, inp, 0.3, 0.2)
+    assert pdf.values.dtype == np.float32
+    np.testing.assert_allclose(pdf.values, expected.values, rtol=1e-6)
+    assert ip.equals(ip_copy) and inp.equals(inp_copy)
+
+
+def test_calculate_pdf_kept_rows_1():
+    """
+    Tests that calculate_pdf() and calculate_abs_pdf() give the same pdf as
+    filtering, pseudocounting and dividing the DataFrame row by row, along
+    with the mask of kept rows, and that a kept mask can be passed back in
+    as rows.
+    """
+    ip, inp = get_density_matrices()
+    ip = norm.clean(ip)
+    for threshold in [0, 5]:
+        df = ip[ip.sum(axis=1) >= threshold] + 0.3
+        expected = df.div(df.sum(axis=1), axis=0)
+        pdf, kept = norm.calculate_pdf(ip, 0.3, threshold)
+        assert pdf.index.equals(expected.index)
+        np.testing.assert_array_equal(pdf.values, expected.values)
+        assert list(kept) == list(ip.sum(axis=1) >= threshold)
+
+        same, same_kept = norm.calculate_pdf(ip, 0.3, rows=kept)
+        assert same.equals(pdf)
+        assert same_kept is kept
+
+    subtracted = ip.sub(norm.clean(inp))
+    summed = subtracted.abs().sum(axis=1) + 0.3 * subtracted.count(axis=1)
+    expected = subtracted.div(summed, axis=0)
+    pdf, kept = norm.calculate_abs_pdf(subtracted, 0.3)
+    assert kept.all()
+    np.testing.assert_allclose(pdf.values, expected.values, rtol=1e-6)
+
+
+def test_outlier_mask_1():
+    """
+    Tests that the outlier mask keeps the values that trimming each column
+    after dropping NaNs keeps, and that get_means_and_sems_with_merged()
+    masks and averages the same values.
+    """
+    df = norm.clean(get_density_matrices()[0])
+    df.iloc[:, 5] = np.nan
+    mask = norm.outlier_mask(df.values, 0.9)
+    means, sems, std, merged = norm.get_means_and_sems_with_merged(df, 0.9)
+    for position in df.columns:
+        column = df[position].dropna().sort_values()
+        dropnum = int(round(len(column) * ((1 - 0.9) / 2.0)))
+        column = column[dropnum:len(column) - dropnum]
+        np.testing.assert_array_equal(
+            np.sort(df[position].values[mask[:, position]]), column.values
+        )
+        assert merged[position].count() == len(column)
+        np.testing.assert_allclose(
+            [means[position], sems[position], std[position]],
+            [column.mean(), column.sem(), column.std()], rtol=1e-6
+        )
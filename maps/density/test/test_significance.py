@@ -0,0 +1,125 @@
+#!/usr/env python
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from density import significance
+
+### Fixtures ###
+
+
+def get_condition_and_background():
+    """
+    Returns a small condition and a larger background matrix of rounded
+    (so, often tied) values with NaNs, and one position where every value
+    is the same.
+    """
+    rs = np.random.RandomState(1)
+    matrices = []
+    for num_events, scale in [(300, 1.2), (2000, 1)]:
+        values = np.round(rs.exponential(scale, (num_events, 30)), 1)
+        values[rs.rand(num_events, 30) < 0.2] = np.nan
+        values[:, 3] = 0.5
+        matrices.append(pd.DataFrame(values))
+    return matrices
+
+
+def trimmed(df, conf=0.95):
+    """
+    Returns the trimmed, non-NaN values of each position of df, one column
+    at a time.
+    """
+    columns = []
+    for position in df.columns:
+        column = df[position].dropna().sort_values()
+        dropnum = int(round(len(column) * ((1 - conf) / 2.0)))
+        columns.append(column[dropnum:len(column) - dropnum])
+    return columns
+
+
+### Tests ###
+
+
+def test_trimmed_columns_1():
+    """
+    Tests that trimming every column at once keeps the same values as
+    trimming each column.
+    """
+    condition, _ = get_condition_and_background()
+    values, counts = significance.trimmed_columns(condition, 0.9)
+    for position, expected in enumerate(trimmed(condition, 0.9)):
+        expected = expected.sort_values().values
+        assert counts[position] == len(expected)
+        np.testing.assert_array_equal(
+            values[position, :counts[position]], expected
+        )
+        assert np.isnan(values[position, counts[position]:]).all()
+
+
+@pytest.mark.parametrize('alternative', ['greater', 'less', 'two-sided'])
+def test_mannwhitneyu_1(alternative, monkeypatch):
+    """
+    Tests that the batched Mann-Whitney U test matches scipy run on each
+    position's trimmed values, whether or not positions are ranked together.
+    """
+    condition, background = get_condition_and_background()
+    u, p = significance.mannwhitneyu(
+        condition, background, alternative=alternative
+    )
+    for position, (x, y) in enumerate(
+            zip(trimmed(condition), trimmed(background))
+    ):
+        if position == 3:
+            assert np.isnan(p[position])
+            continue
+        expected_u, expected_p = stats.mannwhitneyu(
+            x, y, alternative=alternative
+        )
+        assert u[position] == pytest.approx(expected_u)
+        assert p[position] == pytest.approx(expected_p, rel=1e-9)
+
+    monkeypatch.setattr(significance, 'BATCH_SIZE', 3000)
+    batched_u, batched_p = significance.mannwhitneyu(
+        condition, background, alternative=alternative
+    )
+    np.testing.assert_array_equal(batched_u, u)
+    np.testing.assert_array_equal(batched_p, p)
+
+
+def test_ks_2samp_1():
+    """
+    Tests that the batched KS test matches scipy run on each position's
+    trimmed values.
+    """
+    condition, background = get_condition_and_background()
+    d, p = significance.ks_2samp(condition, background)
+    for position, (x, y) in enumerate(
+            zip(trimmed(condition), trimmed(background))
+    ):
+        expected_d, expected_p = stats.ks_2samp(x, y)
+        assert d[position] == pytest.approx(expected_d)
+        assert p[position] == pytest.approx(expected_p, rel=1e-9)
+
+
+def test_fisher_exact_1():
+    """
+    Tests that the batched Fisher exact test matches scipy for random
+    tables (many sharing marginals), as well as tables with an empty row
+    or column and tables as likely as the most likely one.
+    """
+    rs = np.random.RandomState(2)
+    tables = []
+    for _ in range(500):
+        n1, n2 = rs.randint(1, 40), rs.randint(1, 200)
+        a, c = rs.randint(0, n1 + 1), rs.randint(0, n2 + 1)
+        tables.append([[a, n1 - a], [c, n2 - c]])
+    tables += [[[5, 5], [5, 5]], [[0, 10], [0, 30]], [[3, 0], [0, 4]]]
+    oddsratio, p = significance.fisher_exact(tables)
+    for i, table in enumerate(tables):
+        expected_oddsratio, expected_p = stats.fisher_exact(table)
+        assert p[i] == pytest.approx(expected_p, rel=1e-9)
+        if np.isnan(expected_oddsratio):
+            assert np.isnan(oddsratio[i])
+        else:
+            assert oddsratio[i] == expected_oddsratio
@@ -31,45 +31,47 @@ logger = logging.getLogger('plot_features')
 def run_make_peak(
         outfile, peak_file, norm_func, event, exon_or_upstream_offset,
         intron_or_downstream_offset,
-        confidence, annotation_dict, condition_list, bg_filename, test_method, scale
+        confidence, annotation_dict, condition_list, bg_filename, test_method, scale,
+        cores=1, num_permutations=1000, seed=None, score_type='simple',
+        flatten='sum', intermediate_format='csv'
 ):
     rbp = density.Peak.Peak(
-        peaks=peak_file
+        peaks=peak_file, preload=True, score_type=score_type, flatten=flatten
     )
     if event == 'se':
         map_obj = Map.SkippedExon(
             rbp, rbp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'a3ss':
         map_obj = Map.Alt3PSpliceSite(
             rbp, rbp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'a5ss':
         map_obj = Map.Alt5PSpliceSite(
             rbp, rbp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'ri':
         map_obj = Map.RetainedIntron(
             rbp, rbp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'mxe':
         map_obj = Map.MutuallyExclusiveExon(
             rbp, rbp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'cds':
         map_obj = Map.CDS(
@@ -77,7 +79,7 @@ def run_make_peak(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'metagene':
         map_obj = Map.Metagene(
@@ -85,7 +87,7 @@ def run_make_peak(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'bed':
         map_obj = Map.Bed(
@@ -93,7 +95,7 @@ def run_make_peak(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence, scale=scale
+            conf=confidence, scale=scale, cores=cores
         )
     if event == 'metagene':
         divide_hist = False
@@ -110,11 +112,13 @@ def run_make_peak(
     # for any condition we want to calculate pvalues for
     if ((len(condition_list) > 0) and (bg_filename is not None)):
         map_obj.set_background_and_calculate_significance(
-            condition_list, bg_filename, test_method
+            condition_list, bg_filename, test_method,
+            num_permutations=num_permutations, seed=seed,
+            intermediate_format=intermediate_format
         )
         num_heatmap += 1
 
-    map_obj.write_intermediates_to_csv()
+    map_obj.write_intermediates(intermediate_format)
     map_obj.plot(condition_list)
 
 
@@ -124,7 +128,8 @@ def run_make_density(
         norm_func, event, exon_or_upstream_offset,
         intron_or_downstream_offset, confidence,
         annotation_dict, condition_list, bg_filename, test_method,
-        scale
+        scale, cache_dir=None, max_cache_size=None, cores=1,
+        num_permutations=1000, seed=None, intermediate_format='csv'
 ):
     """
 
@@ -148,38 +153,64 @@ def run_make_density(
     condition_list :
         list of files
     bg_filename
+    cache_dir : basestring
+        if specified, decode each bigwig chromosome once into this directory
+        and memory-map it for this and any later runs, and cache the parsed
+        regions of each annotation file there.
+    max_cache_size : int
+        maximum size (bytes) of cache_dir before the least recently used
+        chromosomes are removed.
+    cores : int
+        number of processes used to build the ip/input matrices (and
+        to calculate permutations).
+    num_permutations : int
+        number of random background samples (permutation test only)
+    seed : int
+        seed for the random background samples (permutation test only)
+    intermediate_format : basestring
+        format of the intermediate matrices (see: Map.write_intermediates)
 
     Returns
     -------
 
     """
-    rbp = density.ReadDensity.ReadDensity(
-        pos=ip_pos_bw, neg=ip_neg_bw, bam=ip_bam
-    )
-    inp = density.ReadDensity.ReadDensity(
-        pos=input_pos_bw, neg=input_neg_bw, bam=input_bam
-    )
+    if cache_dir is not None:
+        rbp = density.ReadDensity.CachedReadDensity(
+            pos=ip_pos_bw, neg=ip_neg_bw, bam=ip_bam,
+            cache_dir=cache_dir, max_cache_size=max_cache_size
+        )
+        inp = density.ReadDensity.CachedReadDensity(
+            pos=input_pos_bw, neg=input_neg_bw, bam=input_bam,
+            cache_dir=cache_dir, max_cache_size=max_cache_size
+        )
+    else:
+        rbp = density.ReadDensity.ReadDensity(
+            pos=ip_pos_bw, neg=ip_neg_bw, bam=ip_bam
+        )
+        inp = density.ReadDensity.ReadDensity(
+            pos=input_pos_bw, neg=input_neg_bw, bam=input_bam
+        )
 
     if event == 'mxe':
         map_obj = Map.MutuallyExclusiveExon(
             rbp, inp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'a3ss':
         map_obj = Map.Alt3PSpliceSite(
             rbp, inp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'a5ss':
         map_obj = Map.Alt5PSpliceSite(
             rbp, inp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'ri':
         map_obj = Map.RetainedIntron(
@@ -187,7 +218,7 @@ def run_make_density(
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'bed':
         map_obj = Map.Bed(
@@ -195,7 +226,7 @@ def run_make_density(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence, scale=scale
+            conf=confidence, scale=scale, cores=cores
         )
     elif event == 'multi-length-bed':
         map_obj = Map.MultiLengthBed(
@@ -203,7 +234,7 @@ def run_make_density(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'atac':
         map_obj = Map.ATACIntron(
@@ -211,14 +242,14 @@ def run_make_density(
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores, cache_dir=cache_dir
         )
     elif event == 'se':
         map_obj = Map.SkippedExon(
             rbp, inp, outfile, norm_func,
             annotation_dict, exon_offset=exon_or_upstream_offset,
             intron_offset=intron_or_downstream_offset, min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'cds':
         map_obj = Map.CDS(
@@ -226,7 +257,7 @@ def run_make_density(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     elif event == 'metagene':
         map_obj = Map.Metagene(
@@ -234,7 +265,7 @@ def run_make_density(
             annotation_dict, upstream_offset=exon_or_upstream_offset,
             downstream_offset=intron_or_downstream_offset,
             min_density_threshold=0,
-            conf=confidence
+            conf=confidence, cores=cores
         )
     else:
         print("Invalid event choice.")
@@ -248,20 +279,23 @@ def run_make_density(
     # for any condition we want to calculate pvalues for
     if ((len(condition_list) > 0) and (bg_filename is not None)):
         map_obj.set_background_and_calculate_significance(
-            condition_list, bg_filename, test_method
+            condition_list, bg_filename, test_method,
+            num_permutations=num_permutations, seed=seed,
+            intermediate_format=intermediate_format
         )
 
-    map_obj.write_intermediates_to_csv()
+    map_obj.write_intermediates(intermediate_format)
     map_obj.plot(condition_list)
 
 
-def run_phastcons(outfile, phastcons, peak_file, masked_file, annotation):
+def run_phastcons(outfile, phastcons, peak_file, masked_file, annotation,
+                  intermediate_format='csv'):
     print("running phastcon maps")
     phast = density.ReadDensity.Phastcon(
         phastcon=phastcons
     )
     rbp = density.Peak.Peak(
-        peaks=peak_file
+        peaks=peak_file, preload=True
     )
 
     map_obj = Map.PhastconMap(
@@ -274,7 +308,7 @@ def run_phastcons(outfile, phastcons, peak_file, masked_file, annotation):
     )
     map_obj.create_matrices()
     map_obj.create_lines()
-    map_obj.write_intermediates_to_csv()
+    map_obj.write_intermediates(intermediate_format)
 
     map_obj.plot()
 
@@ -448,6 +482,72 @@ def main():
         help="Plot peak overlaps instead of read density",
         default=None,
     )
+    parser.add_argument(
+        "--peak_score_type",
+        help="(for --peak plots only) score of each position a peak "
+             "overlaps: simple (1), fraction_region (1/region length), "
+             "fraction_peak (1/peak length) or region_name (the peak's name "
+             "column, ie. -log10(p)) (default: simple)",
+        choices=density.Peak.SCORE_TYPES,
+        default='simple'
+    )
+    parser.add_argument(
+        "--peak_flatten",
+        help="(for --peak plots only) how the scores of peaks overlapping "
+             "the same position are combined: sum, min or max "
+             "(default: sum)",
+        choices=density.Peak.FLATTEN_TYPES,
+        default='sum'
+    )
+    parser.add_argument(
+        "--num_permutations", "--num-permutations",
+        help="(for --sigtest permutation only) number of times the "
+             "background is randomly sampled (default: 1000)",
+        default=1000,
+        type=int
+    )
+    parser.add_argument(
+        "--seed",
+        help="(for --sigtest permutation only) seed for the random "
+             "background samples, so that runs can be reproduced "
+             "(default: None)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--cores",
+        help="number of processes used to build the density (or peak) "
+             "matrices. Each annotation file's ip and input matrices are "
+             "built at the same time, and permutations are split across "
+             "them (default: 1)",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="(for density plots only) decode each bigwig chromosome once "
+             "into this directory and memory-map it, so later runs on the "
+             "same bigwigs skip decompressing them, and cache the parsed "
+             "regions of each annotation file there (default: no cache).",
+        default=None,
+    )
+    parser.add_argument(
+        "--max_cache_size",
+        help="maximum size (in GB) of --cache_dir before the least recently "
+             "used chromosomes are removed (default: 20)",
+        default=20,
+        type=float
+    )
+    parser.add_argument(
+        "--intermediate_format",
+        help="format of the intermediate matrices: csv writes each raw and "
+             "normalized matrix (and permutation sample) as text, npz "
+             "writes each annotation's matrices and events to one "
+             "compressed numpy file, which is much faster to write and "
+             "read for large annotations (default: csv)",
+        choices=Map.INTERMEDIATE_FORMATS,
+        default='csv'
+    )
 
     # Process arguments
     args = parser.parse_args()
@@ -537,7 +637,8 @@ def main():
     # beta: plot phastcon bigwig overlaps
     if phastcons is not None and peak_file is not None and event == 'phastcon':
         run_phastcons(
-            outfile, phastcons, peak_file, masked_file, annotation_dict
+            outfile, phastcons, peak_file, masked_file, annotation_dict,
+            args.intermediate_format
         )
     # plot peaks if the peak file is specified
     elif peak_file is not None:
@@ -545,7 +646,10 @@ def main():
         run_make_peak(
             outfile, peak_file, norm.get_density, event, exon_offset, intron_offset,
             confidence, annotation_dict, files_to_test, background_file,
-            test_method, scale
+            test_method, scale, args.cores,
+            args.num_permutations, args.seed,
+            args.peak_score_type, args.peak_flatten,
+            args.intermediate_format
         )
     # plot density maps
     else:
@@ -609,7 +713,9 @@ def main():
             outfile, ip_pos, ip_neg, ip_bam, input_pos, input_neg, input_bam,
             norm_func, event, exon_offset, intron_offset,
             confidence, annotation_dict, files_to_test, background_file,
-            test_method, scale
+            test_method, scale, args.cache_dir,
+            int(args.max_cache_size * 1024 ** 3), args.cores,
+            args.num_permutations, args.seed, args.intermediate_format
         )
 
 